@@ -9,6 +9,7 @@ from flask import Flask
 from flask_cors import CORS
 from flask_talisman import Talisman
 
+from API import caching, log_config
 from API.security.auth0_service import auth0_service
 
 load_dotenv()
@@ -51,12 +52,14 @@ def create_app():
     @app.after_request
     def add_headers(response):
         response.headers['X-XSS-Protection'] = '0'
-        response.headers['Cache-Control'] = 'no-store, max-age=0'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '0'
-        response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        if response.mimetype == 'text/html':
+            response.headers['Content-Type'] = \
+                'application/json; charset=utf-8'
         return response
 
+    log_config.init_app(app)
+    caching.init_app(app)
+
     ##########################################
     # CORS
     ##########################################
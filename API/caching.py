@@ -0,0 +1,81 @@
+"""
+This sets the HTTP caching headers of every response from a per-route
+policy. Endpoints opt in with the `cache_policy` decorator, everything
+else (and every non-GET request or error response) is sent as no-store.
+"""
+
+import os
+from functools import wraps
+
+from flask import Response, g, request
+
+SPOTS_MAX_AGE = int(os.environ.get("SPOTS_MAX_AGE", 5))
+
+
+class CachePolicy:
+    """
+    A Cache-Control value, and whether to answer conditional requests
+    with an ETag of the response body
+    """
+
+    def __init__(self, cache_control, etag=False):
+        self.cache_control = cache_control
+        self.etag = etag
+
+
+NO_STORE = CachePolicy("no-store, max-age=0")
+# GridFS files are never modified in place, a new upload gets a new id
+IMMUTABLE = CachePolicy("public, max-age=31536000, immutable")
+# live data that clients poll, revalidated with an ETag
+SHORT = CachePolicy(f"public, max-age={SPOTS_MAX_AGE}", etag=True)
+STATIC = CachePolicy("public, max-age=86400", etag=True)
+
+
+def cache_policy(policy):
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            g.cache_policy = policy
+            return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def not_modified(etag):
+    """
+    Return a 304 response if the request already has `etag`, otherwise
+    None, and send `etag` with the response either way. Lets an endpoint
+    answer a revalidation before it fetches anything.
+    """
+    g.etag = etag
+    if request.if_none_match.contains(etag):
+        return Response(status=304)
+    return None
+
+
+def apply_cache_policy(response):
+    policy = g.get("cache_policy", NO_STORE)
+    if request.method not in ("GET", "HEAD"):
+        policy = NO_STORE
+    # an error, e.g. a 404 before the spot or file exists, must not stick
+    status = response.status_code
+    if not (200 <= status < 300 or status == 304):
+        policy = NO_STORE
+    response.headers["Cache-Control"] = policy.cache_control
+    if g.get("etag") and policy is not NO_STORE:
+        response.set_etag(g.etag)
+    if policy is NO_STORE:
+        response.headers["Pragma"] = "no-cache"
+        response.headers["Expires"] = "0"
+    elif (policy.etag and response.status_code == 200
+          and not response.direct_passthrough):
+        if "ETag" not in response.headers:
+            response.add_etag()
+        response.make_conditional(request)
+    return response
+
+
+def init_app(app):
+    app.after_request(apply_cache_policy)
@@ -3,18 +3,67 @@ This is the file containing all of the endpoints for our flask app.
 The endpoint called `endpoints` will return all available endpoints.
 """
 
+import hmac
+import logging
+import mimetypes
+import os
 from http import HTTPStatus
-from flask import Flask, g, send_file
+from flask import Flask, Request, Response, g, request
 from flask_cors import CORS
 from flask_restx import Resource, Api
 import werkzeug.exceptions as wz
+from werkzeug.wsgi import wrap_file
 
 import db.data as db
+from db.uploads import MAX_UPLOAD_SIZE, UploadTooLarge
+from API import caching, log_config, metrics
+from API.caching import cache_policy
+from API.live_feed import LiveFeed
 from API.security.guards import (authorization_guard,
                                  permissions_guard, hotspots_permissions)
-from API.parsers import spotParser, factorParser, reviewParser
+from API.security.token_cache import token_cache
+from API.parsers import (spotParser, factorParser, reviewParser,
+                         reviewPageParser, streamParser, fileParser)
+
+LOG = logging.getLogger(__name__)
+
+# this module is the app's entry point (gunicorn, flask run), importing
+# the API package leaves logging alone
+log_config.configure()
+
+
+# routes whose file parts are spot images, streamed into GridFS
+UPLOAD_ENDPOINTS = {"spots_spot_create", "spots_spot_update"}
+# room for the text fields and part headers next to one upload
+FORM_OVERHEAD = 64 * 1024
+
+
+class UploadRequest(Request):
+    """
+    Streams the file parts of a spot image form into GridFS as they are
+    parsed, instead of buffering them in memory or a temporary file.
+    Other routes keep werkzeug's default, and MAX_CONTENT_LENGTH bounds
+    every request.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type,
+                         filename=None, content_length=None):
+        if self.endpoint not in UPLOAD_ENDPOINTS:
+            return super()._get_file_stream(
+                total_content_length, content_type, filename,
+                content_length)
+        return db.open_upload(filename)
+
+    def _load_form_data(self):
+        try:
+            super()._load_form_data()
+        except UploadTooLarge as error:
+            raise wz.RequestEntityTooLarge(str(error))
+
 
 app = Flask(__name__)
+app.request_class = UploadRequest
+app.config["MAX_CONTENT_LENGTH"] = MAX_UPLOAD_SIZE + FORM_OVERHEAD
 
 authorizations = {
     'bearerAuth': {
@@ -28,6 +77,9 @@ authorizations = {
 
 app.config['ERROR_404_HELP'] = False
 CORS(app)
+log_config.init_app(app)
+caching.init_app(app)
+metrics.init_app(app)
 api = Api(app, authorizations=authorizations)
 spots_ns = api.namespace("spots", description="adjust spots")
 factors_ns = api.namespace("spot_factors",
@@ -35,6 +87,52 @@ factors_ns = api.namespace("spot_factors",
 review_ns = api.namespace("spot_review", description="adjust review for spot")
 spot_factor_types_ns = api.namespace(
     "spot_factor_types", description="adjust review for spot")  # hateoas
+admin_ns = api.namespace("admin", description="operate the api")
+
+live_feed = LiveFeed(db.invalidation_bus, db.get_live_factors)
+
+# require "Authorization: Bearer <METRICS_TOKEN>" on /metrics if set
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+
+
+def cache_stats():
+    return {"spot_meta": db.spot_meta_cache.stats(),
+            "spot_factors": db.spot_factor_cache.stats(),
+            "token": token_cache.stats()}
+
+
+def per_cache(stat):
+    return lambda: {(name,): stats[stat]
+                    for name, stats in cache_stats().items()}
+
+
+def hit_ratios():
+    ratios = {}
+    for name, stats in cache_stats().items():
+        lookups = stats["hits"] + stats["misses"]
+        ratios[(name,)] = stats["hits"] / lookups if lookups else None
+    return ratios
+
+
+metrics.Gauge("hotspots_cache_hits_total", "Cache lookups answered",
+              ("cache",), per_cache("hits"), kind="counter")
+metrics.Gauge("hotspots_cache_misses_total", "Cache lookups missed",
+              ("cache",), per_cache("misses"), kind="counter")
+metrics.Gauge("hotspots_cache_hit_ratio", "Hits over lookups since start",
+              ("cache",), hit_ratios)
+metrics.Gauge("hotspots_mongo_pool_connections",
+              "Connections of this worker's pool, by state", ("state",),
+              lambda: {(state,): db.get_pool_stats()[state]
+                       for state in ("open", "checked_out")})
+metrics.Gauge("hotspots_mongo_pool_checkout_failures_total",
+              "Connection checkouts that timed out or failed", (),
+              lambda: {(): db.get_pool_stats()["checkout_failures"]},
+              kind="counter")
+metrics.Gauge("hotspots_factor_buffer_depth",
+              "Spots with factor submissions not written yet", (),
+              lambda: {(): db.factor_buffer.stats()["depth"]})
+metrics.Gauge("hotspots_live_feed_clients", "Connected /spots/stream clients",
+              (), lambda: {(): live_feed.stats()["clients"]})
 
 
 @api.route('/hello')
@@ -52,21 +150,76 @@ class HelloWorld(Resource):
         return {"Hola": "Mundo"}
 
 
+@api.route('/metrics', doc=False)
+class Metrics(Resource):
+    """
+    Prometheus scrape endpoint for this worker
+    """
+    def get(self):
+        if METRICS_TOKEN and not hmac.compare_digest(
+                request.headers.get("Authorization", ""),
+                f"Bearer {METRICS_TOKEN}"):
+            raise (wz.Unauthorized("Metrics token required."))
+        return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
 @spots_ns.route('/list')
 class SpotList(Resource):
     @api.response(HTTPStatus.OK, 'Success')
     @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
+    @cache_policy(caching.SHORT)
     def get(self):
         """
         Returns all spots
         """
-        spots = db.get_spots()
+        # the body must be at the version the ETag is sent for
+        version = db.get_spots_version()
+        not_modified = caching.not_modified(db.get_spots_etag(version))
+        if not_modified:
+            return not_modified
+        spots = db.get_spots(version)
         if spots is None:
             raise (wz.NotFound("Spots not found."))
         else:
             return spots
 
 
+@spots_ns.route('/stream')
+class SpotStream(Resource):
+    """
+    This endpoint pushes live factor changes instead of polling /spots/list
+    """
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.BAD_REQUEST, 'Invalid spot id')
+    @api.response(HTTPStatus.SERVICE_UNAVAILABLE,
+                  'Too many clients, or a sync worker')
+    @api.doc(parser=streamParser)
+    def get(self):
+        """
+        Streams factor changes of all spots, or of `spots`, as
+        Server-Sent Events
+        """
+        if not request.environ.get("wsgi.multithread"):
+            # a sync worker would serve nothing else until its timeout
+            raise (wz.ServiceUnavailable(
+                "The live feed needs a gthread or gevent worker."))
+        args = streamParser.parse_args()
+        spots = None
+        if args['spots']:
+            spots = {db.spot_key(spot_id)
+                     for spot_id in args['spots'].split(",")}
+            if None in spots:
+                raise (wz.BadRequest("Invalid spot id."))
+        client = live_feed.connect(spots)
+        if client is None:
+            raise (wz.ServiceUnavailable("Too many live feed clients."))
+        response = Response(live_feed.stream(client),
+                            mimetype="text/event-stream",
+                            headers={"X-Accel-Buffering": "no"})
+        response.call_on_close(lambda: live_feed.disconnect(client))
+        return response
+
+
 @spots_ns.route('/create')
 class SpotCreate(Resource):
     @api.response(HTTPStatus.OK, 'Success')
@@ -79,7 +232,7 @@ class SpotCreate(Resource):
         Creates a new spot
         """
         args = spotParser.parse_args()
-        print(args)
+        LOG.debug("%s", args)
         spot_response = db.add_spot(args['spotName'], args['spotAddress'],
                                     args['spotCapacity'], args['spotImage'],
                                     args['spotImageUpload'])
@@ -96,11 +249,19 @@ class SpotDetail(Resource):
     """
     @api.response(HTTPStatus.OK, 'Success')
     @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
+    @cache_policy(caching.SHORT)
     def get(self, spot_id):
         """
         Returns a details of a spot
         """
-        spot_details = db.get_spot_detail(spot_id)
+        version = db.get_spot_version(spot_id)
+        if version is None:
+            raise (wz.NotFound(f"Spot {spot_id} detail not found."))
+        etag = db.get_spot_etag(spot_id, version)
+        not_modified = caching.not_modified(etag)
+        if not_modified:
+            return not_modified
+        spot_details = db.get_spot_detail(spot_id, version)
         if spot_details == db.NOT_FOUND:
             raise (wz.NotFound(f"Spot {spot_id} detail not found."))
         else:
@@ -114,6 +275,7 @@ class SpotUpdate(Resource):
     """
     @api.response(HTTPStatus.OK, 'Success')
     @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
+    @api.response(HTTPStatus.NOT_ACCEPTABLE, 'A duplicate key')
     @api.doc(parser=spotParser, security='bearerAuth')
     @authorization_guard
     @permissions_guard([hotspots_permissions.admin])
@@ -129,6 +291,8 @@ class SpotUpdate(Resource):
                                        args['spotImageUpload'])
         if spot_response == db.NOT_FOUND:
             raise (wz.NotFound(f"Spot {spot_id} not found."))
+        elif spot_response == db.DUPLICATE:
+            raise (wz.NotAcceptable("Spot already exists."))
         else:
             return f"{spot_response} added."
 
@@ -145,13 +309,14 @@ class SpotDelete(Resource):
     @permissions_guard([hotspots_permissions.admin])
     def delete(self, spot_id):
         """
-        Delete a spot
+        Delete a spot with its reviews and image.
+        Returns counts of deleted spots, reviews, files and chunks.
         """
         spot_response = db.delete_spot(spot_id)
         if spot_response == db.NOT_FOUND:
             raise (wz.NotFound(f"Spot {spot_id} not found."))
         else:
-            return f"{spot_response} deleted."
+            return spot_response
 
 
 @factors_ns.route('/update/<spot_id>')
@@ -198,7 +363,7 @@ class ReviewCreate(Resource):
             spotID = args["spotID"]
             raise (wz.NotFound(f"Spot {spotID} doesn't exist"))
         else:
-            print("ReviewCreate", review_response)
+            LOG.debug("ReviewCreate %s", review_response)
             return review_response
 
 
@@ -228,15 +393,26 @@ class ReviewDelete(Resource):
 class ReviewSpot(Resource):
     @api.response(HTTPStatus.OK, 'Success')
     @api.response(HTTPStatus.NOT_ACCEPTABLE, 'A duplicate key')
+    @api.doc(parser=reviewPageParser)
+    @cache_policy(caching.SHORT)
     def get(self, spot_id):
         """
-        Get review for specific spot
+        Get a page of reviews for specific spot.
+        The next page's cursor is returned in the X-Next-Cursor header.
         """
-        spot_review_response = db.get_review_by_spot(str(spot_id))
+        args = reviewPageParser.parse_args()
+        limit = db.review_page_limit(args['limit'])
+        fields = args['fields'].split(",") if args['fields'] else None
+        spot_review_response = db.get_review_by_spot(str(spot_id), limit,
+                                                     args['after'],
+                                                     args['order'], fields)
         if spot_review_response == db.NOT_FOUND:
             raise (wz.NotFound(f"Reviews for spot {spot_id} not found."))
-        else:
-            return spot_review_response
+        headers = {}
+        cursor = db.get_review_cursor(spot_review_response, limit)
+        if cursor:
+            headers['X-Next-Cursor'] = cursor
+        return spot_review_response, HTTPStatus.OK, headers
 
 
 @review_ns.route('/update/<review_id>')
@@ -265,14 +441,45 @@ class ReviewUpdate(Resource):
             return f"{review_response} factor updated."
 
 
+def file_response(grid_out):
+    """
+    Stream a GridFS file chunk by chunk, answering Range requests with 206
+    and If-None-Match / If-Modified-Since with 304
+    """
+    metadata = grid_out.metadata or {}
+    mimetype = (metadata.get("contentType")
+                or mimetypes.guess_type(grid_out.filename or "")[0]
+                or "application/octet-stream")
+    body = wrap_file(request.environ, grid_out,
+                     buffer_size=grid_out.chunk_size)
+    response = Response(body, mimetype=mimetype, direct_passthrough=True)
+    response.content_length = grid_out.length
+    response.last_modified = grid_out.upload_date
+    response.set_etag(getattr(grid_out, "md5", None) or str(grid_out._id))
+    if grid_out.filename:
+        response.headers.set("Content-Disposition", "inline",
+                             filename=grid_out.filename)
+    return response.make_conditional(request.environ, accept_ranges=True,
+                                     complete_length=grid_out.length)
+
+
 @api.route('/file/<file_id>')
 class File(Resource):
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.response(HTTPStatus.PARTIAL_CONTENT, 'Range of the file')
+    @api.response(HTTPStatus.NOT_MODIFIED, 'Not Modified')
+    @api.response(HTTPStatus.NOT_FOUND, 'Not Found')
+    @api.doc(parser=fileParser)
+    @cache_policy(caching.IMMUTABLE)
     def get(self, file_id):
-        response = db.get_file(file_id)
-        print(response)
-        if response == db.NOT_FOUND:
+        """
+        Stream a stored file, or a resized WebP variant of an image
+        """
+        args = fileParser.parse_args()
+        grid_out = db.get_file(file_id, args['variant'])
+        if grid_out == db.NOT_FOUND:
             raise (wz.NotFound(f"File {file_id} not found."))
-        return send_file(response[0], attachment_filename=response[1])
+        return file_response(grid_out)
 
 
 @spot_factor_types_ns.route('/get')
@@ -281,6 +488,7 @@ class HATEOASSpotFactors(Resource):
     This endpoint returns a pick list of spot factors
     """
     @api.response(HTTPStatus.OK, 'Success')
+    @cache_policy(caching.STATIC)
     def get(self):
         """
         Return Spot factors
@@ -328,3 +536,104 @@ class HATEOASSpotFactors(Resource):
             }
         }
         return factors
+
+
+@admin_ns.route('/token_cache')
+class AdminTokenCache(Resource):
+    """
+    This endpoint inspects and flushes this worker's validated-token cache
+    """
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.doc(security='bearerAuth')
+    @authorization_guard
+    @permissions_guard([hotspots_permissions.admin])
+    def get(self):
+        """
+        Return token cache size and hit/miss counters
+        """
+        return token_cache.stats()
+
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.doc(security='bearerAuth')
+    @authorization_guard
+    @permissions_guard([hotspots_permissions.admin])
+    def delete(self):
+        """
+        Flush the token cache
+        """
+        token_cache.clear()
+        return "Token cache flushed."
+
+
+@admin_ns.route('/factor_buffer')
+class AdminFactorBuffer(Resource):
+    """
+    This endpoint reports and flushes this worker's factor write buffer
+    """
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.doc(security='bearerAuth')
+    @authorization_guard
+    @permissions_guard([hotspots_permissions.admin])
+    def get(self):
+        """
+        Return buffer depth and flush latency
+        """
+        return db.factor_buffer.stats()
+
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.doc(security='bearerAuth')
+    @authorization_guard
+    @permissions_guard([hotspots_permissions.admin])
+    def post(self):
+        """
+        Write all buffered factor submissions now
+        """
+        return f"{db.factor_buffer.flush()} spots flushed."
+
+
+@admin_ns.route('/spot_cache')
+class AdminSpotCache(Resource):
+    """
+    This endpoint reports and clears the spot metadata and factor caches
+    """
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.doc(security='bearerAuth')
+    @authorization_guard
+    @permissions_guard([hotspots_permissions.admin])
+    def get(self):
+        """
+        Return size and hit ratio of both spot caches, and how many
+        invalidations this worker published and received
+        """
+        return {"meta": db.spot_meta_cache.stats(),
+                "factors": db.spot_factor_cache.stats(),
+                "invalidation": db.invalidation_bus.stats(),
+                "live_feed": live_feed.stats()}
+
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.doc(security='bearerAuth')
+    @authorization_guard
+    @permissions_guard([hotspots_permissions.admin])
+    def delete(self):
+        """
+        Clear both spot caches
+        """
+        db.spot_meta_cache.clear()
+        db.spot_factor_cache.clear()
+        return "Spot caches cleared."
+
+
+@admin_ns.route('/mongo_pool')
+class AdminMongoPool(Resource):
+    """
+    This endpoint reports this worker's MongoDB connection pool
+    """
+    @api.response(HTTPStatus.OK, 'Success')
+    @api.doc(security='bearerAuth')
+    @authorization_guard
+    @permissions_guard([hotspots_permissions.admin])
+    def get(self):
+        """
+        Return connections open and checked out, and checkout wait times
+        """
+        return db.get_pool_stats()
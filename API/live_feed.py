@@ -0,0 +1,180 @@
+"""
+This pushes live factor changes to clients over Server-Sent Events, so
+they don't have to poll /spots/list. Changes come from the invalidation
+bus, are coalesced to at most one message per spot per tick and are only
+sent as the fields that changed since the last message.
+"""
+import json
+import os
+import queue
+import threading
+
+from db.models import SPOT_FACTORS
+
+LIVE_FEED_TICK = float(os.environ.get("LIVE_FEED_TICK", 1))
+LIVE_FEED_HEARTBEAT = float(os.environ.get("LIVE_FEED_HEARTBEAT", 15))
+# messages a client may fall behind before it is dropped
+LIVE_FEED_QUEUE_SIZE = int(os.environ.get("LIVE_FEED_QUEUE_SIZE", 64))
+LIVE_FEED_MAX_CLIENTS = int(os.environ.get("LIVE_FEED_MAX_CLIENTS", 100))
+LIVE_FIELDS = SPOT_FACTORS + ["numFactorEntries"]
+# ask browsers to reconnect after 3s
+RETRY_MS = 3000
+
+
+def sse_frame(data, event=None, id=None):
+    frame = ""
+    if event:
+        frame += f"event: {event}\n"
+    if id is not None:
+        frame += f"id: {id}\n"
+    return frame + f"data: {json.dumps(data)}\n\n"
+
+
+class FeedClient:
+    """
+    One connected client, `spots` is the set of spot ids it follows or
+    None for every spot
+    """
+
+    def __init__(self, spots=None, queue_size=LIVE_FEED_QUEUE_SIZE):
+        self.spots = spots
+        self.queue = queue.Queue(queue_size)
+        self.dropped = False
+
+    def wants(self, spot_id):
+        return self.spots is None or spot_id in self.spots
+
+    def send(self, frame):
+        """
+        Queue a frame, dropping the client if its queue is full
+        """
+        if self.dropped:
+            return
+        try:
+            self.queue.put_nowait(frame)
+        except queue.Full:
+            self.dropped = True
+
+
+class LiveFeed:
+    """
+    Fans spot factor changes out to the connected clients.
+    `load_factors(spot_ids)` returns {spot_id: spot} for the spots that
+    still exist.
+    """
+
+    def __init__(self, bus, load_factors, tick=LIVE_FEED_TICK,
+                 heartbeat=LIVE_FEED_HEARTBEAT,
+                 max_clients=LIVE_FEED_MAX_CLIENTS):
+        self.load_factors = load_factors
+        self.tick = tick
+        self.heartbeat = heartbeat
+        self.max_clients = max_clients
+        self.messages = 0
+        self.dropped_clients = 0
+        self._clients = set()
+        self._changed = set()
+        self._last = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        bus.subscribe(self.on_spot_changed)
+
+    def on_spot_changed(self, event):
+        if event["factors"]:
+            with self._lock:
+                self._changed.add(event["spotID"])
+
+    def connect(self, spots=None):
+        """
+        Register a client, None if there are already `max_clients`
+        """
+        with self._lock:
+            if len(self._clients) >= self.max_clients:
+                return None
+            client = FeedClient(spots)
+            self._clients.add(client)
+        self._ensure_started()
+        return client
+
+    def disconnect(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def stream(self, client):
+        """
+        Generate the SSE frames of a client until it disconnects or is
+        dropped for falling behind
+        """
+        try:
+            yield f"retry: {RETRY_MS}\n\n"
+            while not client.dropped:
+                try:
+                    yield client.queue.get(timeout=self.heartbeat)
+                except queue.Empty:
+                    # a comment line keeps proxies from closing the stream
+                    yield ": heartbeat\n\n"
+            yield sse_frame({"reason": "too slow"}, event="dropped")
+        finally:
+            self.disconnect(client)
+
+    def publish_changes(self):
+        """
+        Send what changed since the last tick, returns the number of spots
+        """
+        with self._lock:
+            changed, self._changed = self._changed, set()
+            clients = list(self._clients)
+        if not changed:
+            return 0
+        spots = self.load_factors(changed) if clients else {}
+        for spot_id in changed:
+            spot = spots.get(spot_id)
+            if spot is None:
+                self._last.pop(spot_id, None)
+                frame = sse_frame({"spotID": spot_id}, event="deleted")
+            else:
+                delta = self._delta(spot_id, spot)
+                if not delta:
+                    continue
+                self.messages += 1
+                frame = sse_frame(delta, event="factors", id=self.messages)
+            for client in clients:
+                if client.wants(spot_id):
+                    client.send(frame)
+        for client in clients:
+            if client.dropped:
+                self.dropped_clients += 1
+                self.disconnect(client)
+        return len(changed)
+
+    def stats(self):
+        return {"clients": len(self._clients), "tick": self.tick,
+                "messages": self.messages,
+                "dropped_clients": self.dropped_clients}
+
+    def _delta(self, spot_id, spot):
+        last = self._last.get(spot_id, {})
+        current = {field: spot[field] for field in LIVE_FIELDS
+                   if field in spot}
+        delta = {field: value for field, value in current.items()
+                 if last.get(field) != value}
+        self._last[spot_id] = current
+        if delta:
+            delta["spotID"] = spot_id
+        return delta
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stop.wait(self.tick):
+            self.publish_changes()
@@ -0,0 +1,170 @@
+"""
+This configures logging for the API and the db modules it imports:
+- records are handed to a queue in the request thread and written to
+  stdout by a background listener, so a request never waits on stdout
+- one JSON object per line (LOG_FORMAT=text for humans), carrying the
+  request ID of the request that logged it
+- LOG_LEVEL sets the default level, LOG_LEVELS overrides it per module,
+  e.g. LOG_LEVELS="db.db_connect=DEBUG,werkzeug=WARNING"
+- LOG_DEBUG_SAMPLE_RATE keeps only that fraction of DEBUG records
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+
+from flask import g, has_request_context, request
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO")
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")
+LOG_DEBUG_SAMPLE_RATE = float(os.environ.get("LOG_DEBUG_SAMPLE_RATE", 1))
+REQUEST_ID_HEADER = "X-Request-ID"
+# accept a proxy's request ID only if it can't break a log line
+VALID_REQUEST_ID = re.compile(r"[\w.-]{1,64}")
+
+listener = None
+settings = {}
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Adds the request ID and drops sampled-out DEBUG records. Runs in the
+    thread that logs, where the request context is available.
+    """
+
+    def __init__(self, debug_sample_rate=LOG_DEBUG_SAMPLE_RATE):
+        super().__init__()
+        self.debug_sample_rate = debug_sample_rate
+
+    def filter(self, record):
+        if (record.levelno <= logging.DEBUG
+                and self.debug_sample_rate < 1
+                and random.random() >= self.debug_sample_rate):
+            return False
+        record.request_id = (g.get("request_id", "-")
+                             if has_request_context() else "-")
+        return True
+
+
+class LocalQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler for a listener in the same process: only merges the
+    message arguments, formatting happens in the listener thread
+    """
+
+    def prepare(self, record):
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+
+class JSONFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "request_id": getattr(record, "request_id", "-"),
+            "message": record.getMessage()
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+    def formatTime(self, record, datefmt=None):
+        return time.strftime("%Y-%m-%dT%H:%M:%S",
+                             time.gmtime(record.created)) \
+            + f".{int(record.msecs):03d}Z"
+
+
+def parse_levels(levels):
+    """
+    "module=LEVEL,..." to {module: LEVEL}
+    """
+    parsed = {}
+    for item in levels.split(","):
+        if "=" in item:
+            name, level = item.split("=", 1)
+            parsed[name.strip()] = level.strip().upper()
+    return parsed
+
+
+def configure(level=LOG_LEVEL, levels=LOG_LEVELS, format=LOG_FORMAT,
+              stream=None):
+    """
+    Route every log record through a queue to `stream` (stdout).
+    Safe to call again, the previous listener is stopped first.
+    """
+    global listener
+    stop()
+    settings.update(level=level, levels=levels, format=format, stream=stream)
+    records = queue.SimpleQueue()
+    handler = LocalQueueHandler(records)
+    handler.addFilter(RequestContextFilter())
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JSONFormatter() if format == "json" else
+                        logging.Formatter("%(asctime)s %(levelname)s "
+                                          "%(name)s [%(request_id)s] "
+                                          "%(message)s"))
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(level.upper())
+    for name, module_level in parse_levels(levels).items():
+        logging.getLogger(name).setLevel(module_level)
+    listener = logging.handlers.QueueListener(records, output,
+                                              respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+def stop():
+    """
+    Write out the queued records and stop the listener
+    """
+    global listener
+    if listener is not None:
+        listener.stop()
+        listener = None
+
+
+atexit.register(stop)
+
+
+def restart_after_fork():
+    # the listener thread doesn't survive a fork
+    if listener is not None:
+        configure(**settings)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=restart_after_fork)
+
+
+def start_request():
+    request_id = request.headers.get(REQUEST_ID_HEADER, "")
+    if not VALID_REQUEST_ID.fullmatch(request_id):
+        request_id = uuid.uuid4().hex
+    g.request_id = request_id
+
+
+def add_request_id(response):
+    if g.get("request_id"):
+        response.headers[REQUEST_ID_HEADER] = g.request_id
+    return response
+
+
+def init_app(app):
+    """
+    Give every request of `app` an ID, taken from the X-Request-ID header
+    when a proxy already set one, and echo it in the response
+    """
+    app.before_request(start_request)
+    app.after_request(add_request_id)
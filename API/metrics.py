@@ -0,0 +1,215 @@
+"""
+This records latency histograms and counters in memory and renders them
+in the Prometheus text format for GET /metrics. Recording is a bisect and
+an add under a lock; gauges are only computed when scraped.
+Every gunicorn worker keeps its own metrics, so Prometheus should scrape
+each worker (or sum what it gets over time).
+"""
+import bisect
+import threading
+import time
+from functools import wraps
+
+from flask import g, request
+from pymongo import monitoring
+
+# seconds, from a cache hit to a slow Atlas query
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1, 2.5, 5, 10)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = []
+
+
+def format_labels(names, values):
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{escape(value)}"'
+                     for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+def escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"') \
+        .replace("\n", "\\n")
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(float(bound) for bound in buckets)
+        self._series = {}
+        self._lock = threading.Lock()
+        registry.append(self)
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = \
+                    [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][index] += 1
+            series[1] += value
+            series[2] += 1
+
+    def time(self, *labels):
+        return Timer(self, labels)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}",
+                 f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = [(labels, list(counts), total, count)
+                      for labels, (counts, total, count)
+                      in self._series.items()]
+        for labels, counts, total, count in sorted(series):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),),
+                                           counts):
+                cumulative += bucket_count
+                bucket_labels = format_labels(
+                    self.labelnames + ("le",),
+                    labels + (format_value(bound),))
+                lines.append(f"{self.name}_bucket{bucket_labels} "
+                             f"{cumulative}")
+            label_text = format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {total}")
+            lines.append(f"{self.name}_count{label_text} {count}")
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start,
+                               *self.labels)
+
+
+class Gauge:
+    """
+    Values read at scrape time: `collect()` returns {labels tuple: value}
+    """
+
+    def __init__(self, name, help, labelnames, collect, kind="gauge"):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.collect = collect
+        self.kind = kind
+        registry.append(self)
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}",
+                f"# TYPE {self.name} {self.kind}"] + [
+            f"{self.name}{format_labels(self.labelnames, labels)} "
+            f"{format_value(value)}"
+            for labels, value in sorted(self.collect().items())
+            if value is not None]
+
+
+def render():
+    lines = []
+    for metric in registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+
+# ids of the histograms a `timed` call is running for, per thread
+timing = threading.local()
+
+
+def timed(histogram):
+    """
+    Decorator observing the duration of every call, labelled with the
+    function name. Calls made while another function timed in the same
+    histogram runs aren't observed, the caller's duration includes them.
+    """
+    def decorator(function):
+        name = function.__name__
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            running = timing.__dict__.setdefault("histograms", set())
+            if id(histogram) in running:
+                return function(*args, **kwargs)
+            running.add(id(histogram))
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                running.discard(id(histogram))
+                histogram.observe(time.perf_counter() - start, name)
+
+        return wrapper
+
+    return decorator
+
+
+request_seconds = Histogram(
+    "hotspots_request_duration_seconds",
+    "Time to handle a request, by endpoint, method and status",
+    ("endpoint", "method", "status"))
+db_function_seconds = Histogram(
+    "hotspots_db_function_duration_seconds",
+    "Time spent in each db_connect function", ("function",))
+mongo_command_seconds = Histogram(
+    "hotspots_mongo_command_duration_seconds",
+    "MongoDB command round trips, by command and outcome",
+    ("command", "outcome"))
+jwks_fetch_seconds = Histogram(
+    "hotspots_jwks_fetch_duration_seconds",
+    "Time to download the Auth0 JWKS", ("outcome",))
+
+
+class CommandTimer(monitoring.CommandListener):
+    """
+    Observes the duration of every MongoDB command
+    """
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        mongo_command_seconds.observe(event.duration_micros / 1e6,
+                                      event.command_name, "ok")
+
+    def failed(self, event):
+        mongo_command_seconds.observe(event.duration_micros / 1e6,
+                                      event.command_name, "error")
+
+
+command_timer = CommandTimer()
+
+
+def init_app(app):
+    """
+    Time every request of `app`
+    """
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+
+    @app.after_request
+    def observe_request(response):
+        start = g.get("request_start")
+        if start is not None:
+            request_seconds.observe(time.perf_counter() - start,
+                                    request.endpoint or "unmatched",
+                                    request.method, response.status_code)
+        return response
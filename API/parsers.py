@@ -1,6 +1,8 @@
 from flask_restx import reqparse
 import werkzeug
 
+from db.images import IMAGE_VARIANTS
+
 spotParser = reqparse.RequestParser()
 spotParser.add_argument('spotName', type=str, location='form')
 spotParser.add_argument('spotImage', type=str, location='form')
@@ -16,6 +18,25 @@ reviewParser.add_argument('reviewTitle', type=str, location='form')
 reviewParser.add_argument('reviewText', type=str, location='form')
 reviewParser.add_argument('reviewRating', type=int, location='form')
 
+reviewPageParser = reqparse.RequestParser()
+reviewPageParser.add_argument('limit', type=int, location='args',
+                              help='reviews per page (max 100)')
+reviewPageParser.add_argument('after', type=str, location='args',
+                              help='reviewCursor of the previous page')
+reviewPageParser.add_argument('order', type=str, location='args',
+                              choices=('asc', 'desc'), default='asc')
+reviewPageParser.add_argument('fields', type=str, location='args',
+                              help='comma separated review fields')
+
+fileParser = reqparse.RequestParser()
+fileParser.add_argument('variant', type=str, location='args',
+                        choices=tuple(IMAGE_VARIANTS),
+                        help='resized WebP version of an image')
+
+streamParser = reqparse.RequestParser()
+streamParser.add_argument('spots', type=str, location='args',
+                          help='comma separated spot ids, all if omitted')
+
 # each will be a number from 1 to 10
 factorParser = reqparse.RequestParser()
 factorParser.add_argument('factorAvailability', type=int, location='form')
@@ -4,6 +4,7 @@ This handles authentication
 
 from http import HTTPStatus
 import jwt
+from API.security.jwks import JWKSKeyStore
 from API.security.utils import json_abort, audience, domain
 
 
@@ -15,16 +16,19 @@ class Auth0Service:
         self.audience = None
         self.algorithm = 'RS256'
         self.jwks_uri = None
+        self.jwks_store = None
 
     def initialize(self, auth0_domain, auth0_audience):
         self.issuer_url = f'https://{auth0_domain}/'
-        self.jwks_uri = f'{self.issuer_url}.well-known/jwks.json'
+        jwks_uri = f'{self.issuer_url}.well-known/jwks.json'
+        if self.jwks_store is None or jwks_uri != self.jwks_uri:
+            self.jwks_store = JWKSKeyStore(jwks_uri)
+        self.jwks_uri = jwks_uri
         self.audience = auth0_audience
 
     def get_signing_key(self, token):
         try:
-            jwks_client = jwt.PyJWKClient(self.jwks_uri)
-            return jwks_client.get_signing_key_from_jwt(token).key
+            return self.jwks_store.get_signing_key_from_jwt(token).key
         except Exception as error:
             json_abort(HTTPStatus.INTERNAL_SERVER_ERROR, {
                 "error": "signing_key_unavailable",
@@ -6,6 +6,7 @@ import jwt
 from flask import request, g
 
 from API.security.auth0_service import auth0_service
+from API.security.token_cache import token_cache
 from API.security.utils import json_abort
 
 unauthorized_error = {
@@ -50,7 +51,10 @@ def authorization_guard(function):
     @wraps(function)
     def decorator(*args, **kwargs):
         token = get_bearer_token_from_request()
-        validated_token = auth0_service.validate_jwt(token)
+        validated_token = token_cache.get(token)
+        if validated_token is None:
+            validated_token = auth0_service.validate_jwt(token)
+            token_cache.put(token, validated_token)
         user_id = validated_token["sub"]
         permissions = validated_token["permissions"]
         g.access_token = validated_token
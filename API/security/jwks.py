@@ -0,0 +1,155 @@
+"""
+This caches the Auth0 JSON Web Key Set (JWKS) used to verify tokens.
+One store is shared by the whole process so the key set is fetched once
+per TTL instead of once per authenticated request.
+"""
+
+import json
+import os
+import threading
+import time
+import urllib.request
+
+import jwt
+
+from API.metrics import jwks_fetch_seconds
+
+JWKS_CACHE_TTL = int(os.environ.get("JWKS_CACHE_TTL", 600))
+JWKS_MAX_STALE = int(os.environ.get("JWKS_MAX_STALE", 86400))
+JWKS_MIN_REFRESH_INTERVAL = int(os.environ.get("JWKS_MIN_REFRESH_INTERVAL",
+                                               30))
+JWKS_FETCH_TIMEOUT = 5
+
+
+class JWKSKeyStore:
+    """
+    Signing keys from a JWKS endpoint, indexed by `kid`.
+    - keys are served from memory until `ttl` seconds after the last fetch
+    - an unknown `kid` forces a refresh (key rotation), at most once every
+      `min_refresh_interval` seconds
+    - only one refresh runs at a time, concurrent callers wait for it
+    - expired keys keep being served (and are revalidated in the
+      background) for up to `max_stale` seconds if the issuer is down,
+      never after that
+    - expired keys are refetched at most once every
+      `min_refresh_interval` seconds too, so a down issuer isn't hammered
+    """
+
+    def __init__(self, jwks_uri, ttl=JWKS_CACHE_TTL,
+                 max_stale=JWKS_MAX_STALE,
+                 min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+                 timeout=JWKS_FETCH_TIMEOUT):
+        self.jwks_uri = jwks_uri
+        self.ttl = ttl
+        self.max_stale = max_stale
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self.fetch_count = 0
+        self._keys = {}
+        self._fetched_at = None
+        self._last_attempt = None
+        self._error = None
+        self._inflight = None
+        self._lock = threading.Lock()
+
+    def get_signing_key_from_jwt(self, token):
+        header = jwt.get_unverified_header(token)
+        return self.get_signing_key(header.get("kid"))
+
+    def get_signing_key(self, kid):
+        """
+        Return the PyJWK for `kid`, fetching the key set only when needed
+        """
+        age = self._age()
+        if age is not None and age >= self.ttl \
+                and age < self.ttl + self.max_stale and kid in self._keys:
+            # stale-while-revalidate: answer now, refresh behind us
+            self._refresh_in_background()
+        elif (age is None or age >= self.ttl or kid not in self._keys) \
+                and (self._inflight is not None or self._can_refresh()):
+            # joins the refresh already running, if any
+            self._refresh()
+
+        keys = self._usable_keys()
+        key = keys.get(kid)
+        if key is not None:
+            return key
+        if self._error is not None and not keys:
+            raise jwt.PyJWKClientError(
+                f'Unable to fetch signing keys: "{self._error}"')
+        raise jwt.PyJWKClientError(
+            f'Unable to find a signing key that matches: "{kid}"')
+
+    def clear(self):
+        with self._lock:
+            self._keys = {}
+            self._fetched_at = None
+            self._last_attempt = None
+            self._error = None
+
+    def _age(self):
+        fetched_at = self._fetched_at
+        return None if fetched_at is None else time.monotonic() - fetched_at
+
+    def _usable_keys(self):
+        """
+        The keys, unless the last successful fetch is more than `max_stale`
+        seconds past the TTL
+        """
+        age = self._age()
+        if age is None or age >= self.ttl + self.max_stale:
+            return {}
+        return self._keys
+
+    def _can_refresh(self):
+        last_attempt = self._last_attempt
+        return (last_attempt is None or time.monotonic() - last_attempt
+                >= self.min_refresh_interval)
+
+    def _refresh_in_background(self):
+        if self._inflight is not None or not self._can_refresh():
+            return
+        thread = threading.Thread(target=self._refresh, daemon=True)
+        thread.start()
+
+    def _refresh(self):
+        """
+        Fetch the key set. The first caller does the fetch, everyone who
+        arrives while it is running waits for that result instead.
+        """
+        with self._lock:
+            inflight = self._inflight
+            leader = inflight is None
+            if leader:
+                inflight = self._inflight = threading.Event()
+        if not leader:
+            inflight.wait(self.timeout)
+            return
+
+        try:
+            self._last_attempt = time.monotonic()
+            keys = self._fetch()
+            with self._lock:
+                self._keys = keys
+                self._fetched_at = time.monotonic()
+                self._error = None
+        except Exception as error:
+            self._error = error
+        finally:
+            with self._lock:
+                self._inflight = None
+            inflight.set()
+
+    def _fetch(self):
+        self.fetch_count += 1
+        start = time.perf_counter()
+        outcome = "error"
+        try:
+            with urllib.request.urlopen(self.jwks_uri,
+                                        timeout=self.timeout) as response:
+                jwk_set = jwt.PyJWKSet.from_dict(json.load(response))
+            outcome = "ok"
+        finally:
+            jwks_fetch_seconds.observe(time.perf_counter() - start, outcome)
+        return {key.key_id: key for key in jwk_set.keys
+                if key.key_id and key.public_key_use in ("sig", None)}
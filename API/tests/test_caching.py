@@ -0,0 +1,91 @@
+"""
+This file holds the tests for caching.py.
+"""
+
+from unittest import TestCase
+from flask import Flask, abort
+
+from API import caching
+from API.caching import cache_policy
+
+
+def make_app():
+    app = Flask(__name__)
+    app.fetches = 0
+    caching.init_app(app)
+
+    @app.route("/live", methods=["GET", "PUT"])
+    @cache_policy(caching.SHORT)
+    def live():
+        return {"factorAvailability": 3}
+
+    @app.route("/image")
+    @cache_policy(caching.IMMUTABLE)
+    def image():
+        return b"abcde"
+
+    @app.route("/versioned")
+    @cache_policy(caching.SHORT)
+    def versioned():
+        not_modified = caching.not_modified("spots-1")
+        if not_modified:
+            return not_modified
+        app.fetches += 1
+        return {"factorAvailability": 3}
+
+    @app.route("/missing")
+    @cache_policy(caching.IMMUTABLE)
+    def missing():
+        abort(404)
+
+    @app.route("/private")
+    def private():
+        return {"userID": "abcde"}
+
+    return app
+
+
+class CachingTestCase(TestCase):
+    def setUp(self):
+        self.app = make_app()
+        self.client = self.app.test_client()
+
+    def test_default_is_no_store(self):
+        response = self.client.get("/private")
+        self.assertEqual(response.headers["Cache-Control"],
+                         "no-store, max-age=0")
+        self.assertEqual(response.headers["Pragma"], "no-cache")
+
+    def test_immutable(self):
+        response = self.client.get("/image")
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        self.assertNotIn("Pragma", response.headers)
+
+    def test_short_max_age_with_etag(self):
+        response = self.client.get("/live")
+        self.assertIn("max-age=", response.headers["Cache-Control"])
+        etag = response.headers["ETag"]
+        response = self.client.get("/live", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+
+    def test_errors_are_no_store(self):
+        response = self.client.get("/missing")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(response.headers["Cache-Control"],
+                         "no-store, max-age=0")
+        self.assertNotIn("ETag", response.headers)
+
+    def test_mutations_are_no_store(self):
+        response = self.client.put("/live")
+        self.assertEqual(response.headers["Cache-Control"],
+                         "no-store, max-age=0")
+        self.assertNotIn("ETag", response.headers)
+
+    def test_not_modified_skips_fetch(self):
+        response = self.client.get("/versioned")
+        self.assertEqual(response.headers["ETag"], '"spots-1"')
+        response = self.client.get("/versioned",
+                                   headers={"If-None-Match": '"spots-1"'})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers["ETag"], '"spots-1"')
+        self.assertEqual(self.app.fetches, 1)
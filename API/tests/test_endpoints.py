@@ -6,6 +6,9 @@ from unittest import TestCase
 import API.endpoints as ep
 import json
 from io import BytesIO
+from flask import request
+import werkzeug.exceptions as wz
+from db.uploads import GridFSUpload
 from API.security.utils import get_auth0_token, get_access_token_for_test_user
 
 userToken = "Bearer " + get_access_token_for_test_user() # this gives a token for the test user johndoe1 who has the admin role
@@ -237,6 +240,8 @@ class EndpointTestCase(TestCase):
         
         response = self.client.get(spotImage)
         self.assertEqual(response.status_code, 200)
+        # sniffed from the content, not the .jpg name
+        self.assertEqual(response.mimetype, "application/octet-stream")
         print(response)
         
         self.spotData['spotImageUpload'] = (BytesIO(b"abcdefg"), 'test1.jpg')
@@ -258,4 +263,29 @@ class EndpointTestCase(TestCase):
         
         response = self.client.get(spotImage2)
         self.assertEqual(response.status_code, 404)
-        print(response)
\ No newline at end of file
+        print(response)
+
+    def test_stream_needs_threaded_worker(self):
+        response = self.client.get("/spots/stream")
+        self.assertEqual(response.status_code, 503)
+        response = self.client.get(
+            "/spots/stream", environ_overrides={"wsgi.multithread": True},
+            buffered=False)
+        self.assertEqual(response.status_code, 200)
+        response.close()
+
+    def test_uploads_stream_only_on_image_routes(self):
+        def file_stream(path, size=3):
+            data = {"spotImageUpload": (BytesIO(b"a" * size), "test.jpg")}
+            with self.app.test_request_context(path, method="POST",
+                                               data=data):
+                stream = request.files["spotImageUpload"].stream
+                stream.close()
+                return stream
+
+        self.assertIsInstance(file_stream("/spots/create"), GridFSUpload)
+        self.assertNotIsInstance(file_stream("/spot_review/create"),
+                                 GridFSUpload)
+        with self.assertRaises(wz.RequestEntityTooLarge):
+            file_stream("/spot_review/create",
+                        self.app.config["MAX_CONTENT_LENGTH"] + 1)
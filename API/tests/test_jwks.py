@@ -0,0 +1,155 @@
+"""
+This file holds the tests for security/jwks.py.
+It serves a JWKS document from a local HTTP server instead of Auth0.
+"""
+
+from unittest import TestCase
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from API.security.jwks import JWKSKeyStore
+
+
+def make_jwk(kid):
+    private_key = rsa.generate_private_key(public_exponent=65537,
+                                           key_size=2048)
+    jwk = json.loads(jwt.algorithms.RSAAlgorithm.to_jwk(
+        private_key.public_key()))
+    jwk.update({"kid": kid, "use": "sig", "alg": "RS256"})
+    return private_key, jwk
+
+
+class LocalJWKS:
+    """
+    A stand-in for the issuer's /.well-known/jwks.json endpoint
+    """
+
+    def __init__(self):
+        self.keys = []
+        self.requests = 0
+        self.delay = 0
+        self.down = False
+        jwks = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                jwks.requests += 1
+                time.sleep(jwks.delay)
+                if jwks.down:
+                    self.send_error(503)
+                    return
+                body = json.dumps({"keys": jwks.keys}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.uri = f"http://127.0.0.1:{self.server.server_port}/jwks.json"
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class JWKSKeyStoreTestCase(TestCase):
+    def setUp(self):
+        self.jwks = LocalJWKS()
+        self.private_key, jwk = make_jwk("key-1")
+        self.jwks.keys = [jwk]
+
+    def tearDown(self):
+        self.jwks.close()
+
+    def make_token(self, kid="key-1", private_key=None):
+        return jwt.encode({"sub": "abcde"}, private_key or self.private_key,
+                          algorithm="RS256", headers={"kid": kid})
+
+    def test_fetches_once_within_ttl(self):
+        store = JWKSKeyStore(self.jwks.uri, ttl=60)
+        token = self.make_token()
+        for _ in range(5):
+            key = store.get_signing_key_from_jwt(token)
+            claims = jwt.decode(token, key.key, algorithms="RS256")
+            self.assertEqual(claims["sub"], "abcde")
+        self.assertEqual(self.jwks.requests, 1)
+
+    def test_unknown_kid_refreshes(self):
+        store = JWKSKeyStore(self.jwks.uri, ttl=60, min_refresh_interval=0)
+        store.get_signing_key("key-1")
+        rotated_key, jwk = make_jwk("key-2")
+        self.jwks.keys.append(jwk)
+        token = self.make_token("key-2", rotated_key)
+        key = store.get_signing_key_from_jwt(token)
+        self.assertEqual(key.key_id, "key-2")
+        self.assertEqual(self.jwks.requests, 2)
+
+    def test_unknown_kid_refresh_is_throttled(self):
+        store = JWKSKeyStore(self.jwks.uri, ttl=60, min_refresh_interval=60)
+        store.get_signing_key("key-1")
+        for _ in range(3):
+            with self.assertRaises(jwt.PyJWKClientError):
+                store.get_signing_key("no-such-key")
+        self.assertEqual(self.jwks.requests, 1)
+
+    def test_concurrent_refresh_is_shared(self):
+        self.jwks.delay = 0.2
+        store = JWKSKeyStore(self.jwks.uri, ttl=60)
+        results = []
+
+        def fetch():
+            results.append(store.get_signing_key("key-1").key_id)
+
+        threads = [threading.Thread(target=fetch) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, ["key-1"] * 10)
+        self.assertEqual(self.jwks.requests, 1)
+
+    def test_stale_keys_served_when_issuer_down(self):
+        store = JWKSKeyStore(self.jwks.uri, ttl=0, max_stale=60,
+                             min_refresh_interval=0)
+        store.get_signing_key("key-1")
+        self.jwks.down = True
+        key = store.get_signing_key("key-1")
+        self.assertEqual(key.key_id, "key-1")
+
+    def test_refresh_of_expired_keys_is_throttled(self):
+        store = JWKSKeyStore(self.jwks.uri, ttl=0, max_stale=0.1,
+                             min_refresh_interval=60)
+        store.get_signing_key("key-1")
+        self.jwks.down = True
+        time.sleep(0.1)
+        for _ in range(3):
+            with self.assertRaises(jwt.PyJWKClientError):
+                store.get_signing_key("key-1")
+        self.assertEqual(self.jwks.requests, 1)
+
+    def test_keys_past_max_stale_not_served(self):
+        store = JWKSKeyStore(self.jwks.uri, ttl=0, max_stale=0.1,
+                             min_refresh_interval=0)
+        store.get_signing_key("key-1")
+        self.jwks.down = True
+        time.sleep(0.1)
+        with self.assertRaises(jwt.PyJWKClientError):
+            store.get_signing_key("key-1")
+        self.assertEqual(self.jwks.requests, 2)
+
+    def test_no_keys_when_issuer_unreachable(self):
+        self.jwks.down = True
+        store = JWKSKeyStore(self.jwks.uri)
+        with self.assertRaises(jwt.PyJWKClientError):
+            store.get_signing_key("key-1")
@@ -0,0 +1,100 @@
+"""
+This file holds the tests for live_feed.py.
+"""
+
+from unittest import TestCase
+import json
+
+from API.live_feed import LiveFeed
+from db.invalidation import LocalBus, spot_event
+
+SPOT_A = "5f1f0000000000000000000a"
+SPOT_B = "5f1f0000000000000000000b"
+
+
+def spot(availability, entries=1):
+    return {"factorAvailability": availability, "factorNoiseLevel": 3,
+            "factorTemperature": 3, "factorAmbiance": 3,
+            "numFactorEntries": entries, "spotName": "TEST SPOT"}
+
+
+def frames(client):
+    sent = []
+    while not client.queue.empty():
+        sent.append(client.queue.get_nowait())
+    return sent
+
+
+def data(frame):
+    return json.loads(frame.split("data: ", 1)[1])
+
+
+class LiveFeedTestCase(TestCase):
+    def setUp(self):
+        self.bus = LocalBus()
+        self.spots = {SPOT_A: spot(1), SPOT_B: spot(1)}
+        self.feed = LiveFeed(
+            self.bus, lambda ids: {spot_id: self.spots[spot_id]
+                                   for spot_id in ids
+                                   if spot_id in self.spots},
+            tick=60, heartbeat=0.01, max_clients=2)
+        self.feed._ensure_started = lambda: None
+
+    def test_coalesced_deltas(self):
+        client = self.feed.connect()
+        for availability in (2, 3, 4):
+            self.spots[SPOT_A] = spot(availability, availability)
+            self.bus.publish(spot_event(SPOT_A, meta=False))
+        self.feed.publish_changes()
+        sent = frames(client)
+        self.assertEqual(len(sent), 1)
+        self.assertEqual(data(sent[0])["factorAvailability"], 4)
+        self.spots[SPOT_A] = spot(4, 5)
+        self.bus.publish(spot_event(SPOT_A, meta=False))
+        self.feed.publish_changes()
+        self.assertEqual(data(frames(client)[0]),
+                         {"spotID": SPOT_A, "numFactorEntries": 5})
+
+    def test_subscribed_spots(self):
+        client = self.feed.connect({SPOT_B})
+        self.bus.publish(spot_event(SPOT_A))
+        self.bus.publish(spot_event(SPOT_B))
+        self.bus.publish(spot_event(SPOT_B, meta=False, factors=False,
+                                    reviews=True))
+        self.feed.publish_changes()
+        sent = frames(client)
+        self.assertEqual([data(frame)["spotID"] for frame in sent], [SPOT_B])
+
+    def test_deleted_spot(self):
+        client = self.feed.connect()
+        del self.spots[SPOT_A]
+        self.bus.publish(spot_event(SPOT_A))
+        self.feed.publish_changes()
+        self.assertTrue(frames(client)[0].startswith("event: deleted"))
+
+    def test_slow_client_dropped(self):
+        slow = self.feed.connect()
+        slow.queue.maxsize = 1
+        fast = self.feed.connect()
+        self.bus.publish(spot_event(SPOT_A))
+        self.bus.publish(spot_event(SPOT_B))
+        self.feed.publish_changes()
+        self.assertTrue(slow.dropped)
+        self.assertEqual(len(frames(fast)), 2)
+        self.assertEqual(self.feed.stats()["clients"], 1)
+        stream = self.feed.stream(slow)
+        sent = list(stream)
+        self.assertTrue(sent[-1].startswith("event: dropped"))
+
+    def test_heartbeat(self):
+        client = self.feed.connect()
+        stream = self.feed.stream(client)
+        self.assertTrue(next(stream).startswith("retry:"))
+        self.assertEqual(next(stream), ": heartbeat\n\n")
+        stream.close()
+        self.assertEqual(self.feed.stats()["clients"], 0)
+
+    def test_max_clients(self):
+        self.feed.connect()
+        self.feed.connect()
+        self.assertIsNone(self.feed.connect())
@@ -0,0 +1,78 @@
+"""
+This file holds the tests for log_config.py.
+"""
+
+from unittest import TestCase
+import io
+import json
+import logging
+
+from flask import Flask
+
+from API import log_config
+
+LOG = logging.getLogger("db.test_log_config")
+
+
+class LogConfigTestCase(TestCase):
+    def setUp(self):
+        self.root_handlers = logging.getLogger().handlers
+        self.root_level = logging.getLogger().level
+        self.out = io.StringIO()
+
+    def tearDown(self):
+        log_config.stop()
+        logging.getLogger().handlers = self.root_handlers
+        logging.getLogger().setLevel(self.root_level)
+        LOG.setLevel(logging.NOTSET)
+
+    def records(self):
+        log_config.stop()
+        return [json.loads(line) for line in self.out.getvalue().splitlines()]
+
+    def test_json_lines(self):
+        log_config.configure(level="INFO", stream=self.out)
+        LOG.info("Fetch %s", {"spotName": "A"})
+        LOG.debug("not logged")
+        records = self.records()
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]["message"], "Fetch {'spotName': 'A'}")
+        self.assertEqual(records[0]["logger"], "db.test_log_config")
+        self.assertEqual(records[0]["request_id"], "-")
+
+    def test_module_levels(self):
+        self.assertEqual(log_config.parse_levels("db=DEBUG, werkzeug=warning"),
+                         {"db": "DEBUG", "werkzeug": "WARNING"})
+        log_config.configure(level="WARNING", levels="db=DEBUG",
+                             stream=self.out)
+        LOG.debug("logged")
+        logging.getLogger("other").info("not logged")
+        self.assertEqual([r["message"] for r in self.records()], ["logged"])
+        logging.getLogger("db").setLevel(logging.NOTSET)
+
+    def test_debug_sampling(self):
+        log_config.configure(level="DEBUG", stream=self.out)
+        handler = logging.getLogger().handlers[0]
+        handler.filters[0].debug_sample_rate = 0
+        LOG.debug("sampled out")
+        LOG.info("kept")
+        self.assertEqual([r["message"] for r in self.records()], ["kept"])
+
+    def test_request_id(self):
+        app = Flask(__name__)
+        log_config.init_app(app)
+
+        @app.route("/")
+        def index():
+            LOG.warning("in request")
+            return "ok"
+
+        log_config.configure(level="INFO", stream=self.out)
+        client = app.test_client()
+        response = client.get("/", headers={"X-Request-ID": "abc-123"})
+        self.assertEqual(response.headers["X-Request-ID"], "abc-123")
+        response = client.get("/", headers={"X-Request-ID": "no spaces"})
+        generated = response.headers["X-Request-ID"]
+        self.assertEqual(len(generated), 32)
+        self.assertEqual([r["request_id"] for r in self.records()],
+                         ["abc-123", generated])
@@ -0,0 +1,72 @@
+"""
+This file holds the tests for metrics.py.
+"""
+
+from unittest import TestCase
+
+from API import metrics
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self):
+        self.registry = list(metrics.registry)
+
+    def tearDown(self):
+        metrics.registry[:] = self.registry
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_seconds", "Test latency",
+                                      ("route",), buckets=(0.5, 1))
+        for value in (0.25, 0.5, 0.75, 5):
+            histogram.observe(value, "list")
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{route="list",le="0.5"} 2', lines)
+        self.assertIn('test_seconds_bucket{route="list",le="1.0"} 3', lines)
+        self.assertIn('test_seconds_bucket{route="list",le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_sum{route="list"} 6.5', lines)
+        self.assertIn('test_seconds_count{route="list"} 4', lines)
+
+    def test_timed(self):
+        histogram = metrics.Histogram("test_function_seconds", "Test",
+                                      ("function",))
+
+        @metrics.timed(histogram)
+        def fetch():
+            raise ValueError()
+
+        with self.assertRaises(ValueError):
+            fetch()
+        self.assertIn('test_function_seconds_count{function="fetch"} 1',
+                      histogram.render())
+
+    def test_nested_calls_are_not_timed(self):
+        histogram = metrics.Histogram("test_nested_seconds", "Test",
+                                      ("function",))
+
+        @metrics.timed(histogram)
+        def fetch():
+            return 1
+
+        @metrics.timed(histogram)
+        def update():
+            return fetch() + fetch()
+
+        self.assertEqual(update(), 2)
+        fetch()
+        lines = histogram.render()
+        self.assertIn('test_nested_seconds_count{function="update"} 1', lines)
+        self.assertIn('test_nested_seconds_count{function="fetch"} 1', lines)
+
+    def test_gauge(self):
+        gauge = metrics.Gauge("test_ratio", "Test", ("cache",),
+                              lambda: {("a",): 0.5, ("b",): None,
+                                       ('say "hi"',): 1})
+        self.assertEqual(gauge.render()[2:], [
+            'test_ratio{cache="a"} 0.5',
+            'test_ratio{cache="say \\"hi\\""} 1'])
+
+    def test_render(self):
+        text = metrics.render()
+        self.assertTrue(text.endswith("\n"))
+        self.assertIn("# TYPE hotspots_request_duration_seconds histogram",
+                      text)
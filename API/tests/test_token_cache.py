@@ -0,0 +1,50 @@
+"""
+This file holds the tests for security/token_cache.py.
+"""
+
+from unittest import TestCase
+import time
+
+from API.security.token_cache import TokenCache
+
+TEST_CLAIMS = {"sub": "abcde", "permissions": []}
+
+
+def claims(expires_in=60):
+    return dict(TEST_CLAIMS, exp=int(time.time()) + expires_in)
+
+
+class TokenCacheTestCase(TestCase):
+    def setUp(self):
+        self.cache = TokenCache(max_size=2)
+
+    def test_hit_and_miss(self):
+        self.assertIsNone(self.cache.get("token-a"))
+        self.cache.put("token-a", claims())
+        self.assertEqual(self.cache.get("token-a")["sub"], "abcde")
+        stats = self.cache.stats()
+        self.assertEqual(stats["hits"], 1)
+        self.assertEqual(stats["misses"], 1)
+
+    def test_expired_token_is_a_miss(self):
+        self.cache.put("token-a", claims(expires_in=-1))
+        self.assertIsNone(self.cache.get("token-a"))
+        self.assertEqual(self.cache.stats()["size"], 0)
+
+    def test_token_without_exp_not_cached(self):
+        self.cache.put("token-a", dict(TEST_CLAIMS))
+        self.assertIsNone(self.cache.get("token-a"))
+
+    def test_max_size_evicts_least_recently_used(self):
+        self.cache.put("token-a", claims())
+        self.cache.put("token-b", claims())
+        self.cache.get("token-a")
+        self.cache.put("token-c", claims())
+        self.assertIsNotNone(self.cache.get("token-a"))
+        self.assertIsNone(self.cache.get("token-b"))
+        self.assertEqual(self.cache.stats()["evictions"], 1)
+
+    def test_clear(self):
+        self.cache.put("token-a", claims())
+        self.cache.clear()
+        self.assertIsNone(self.cache.get("token-a"))
@@ -0,0 +1,70 @@
+"""
+Compares the print() calls a spot detail request used to make with the
+LOG.debug calls that replaced them, per request: with DEBUG disabled (the
+default), and with DEBUG enabled going through the queue handler.
+stdout is an unbuffered /dev/null, as on a platform that sets
+PYTHONUNBUFFERED so logs aren't lost when a worker dies.
+Run with `python -m benchmarks.bench_logging` from the repo root.
+"""
+import io
+import logging
+import os
+import sys
+import timeit
+from datetime import datetime
+
+from bson import ObjectId
+
+from API import log_config
+
+REQUESTS = 20000
+REPEAT = 5
+
+SPOT = {
+    "_id": ObjectId(),
+    "spotName": "Bobst Library",
+    "spotImage": f"https://hotspotsapi.herokuapp.com/file/{ObjectId()}",
+    "spotAddress": "70 Washington Square S, New York, NY 10012",
+    "spotCapacity": "Large",
+    "spotCreation": "2022-05-09",
+    "spotUpdate": datetime.now(),
+    "factorAvailability": 2.5,
+    "factorNoiseLevel": 1.0,
+    "factorTemperature": 3.0,
+    "factorAmbiance": 4.0,
+    "numFactorEntries": 4,
+    "factorDate": "2022-05-09"
+}
+
+LOG = logging.getLogger("db.db_connect")
+
+
+def with_print(out):
+    print("LOCAL_DB", "1", file=out)
+    print("Fetch", SPOT, file=out)
+
+
+def with_logging():
+    LOG.debug("LOCAL_DB %s", "1")
+    LOG.debug("Fetch %s", SPOT)
+
+
+def per_request(func):
+    best = min(timeit.repeat(func, number=REQUESTS, repeat=REPEAT))
+    return best / REQUESTS * 1e6
+
+
+def main():
+    out = io.TextIOWrapper(io.FileIO(os.devnull, "w"), write_through=True)
+    results = [("print", per_request(lambda: with_print(out)))]
+    log_config.configure(level="INFO", stream=out)
+    results.append(("debug off", per_request(with_logging)))
+    log_config.configure(level="DEBUG", stream=out)
+    results.append(("debug on", per_request(with_logging)))
+    log_config.stop()
+    for name, micros in results:
+        print(f"{name:10} {micros:8.2f} us per request", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Compares the old json.dumps/json.loads round trip with db.serializer on
+10k spot documents, including the final encode Flask-RESTX does.
+Run with `python benchmarks/bench_serializer.py` from the repo root.
+"""
+import json
+import timeit
+from datetime import datetime
+
+import bson.json_util as bsutil
+from bson import ObjectId
+
+from db.serializer import to_json
+
+NUM_SPOTS = 10000
+REPEAT = 5
+
+
+def make_spots(n):
+    now = datetime.now()
+    return [{
+        "_id": ObjectId(),
+        "spotName": f"Spot {i}",
+        "spotImage": f"https://hotspotsapi.herokuapp.com/file/{ObjectId()}",
+        "spotAddress": "6 MetroTech Center, Brooklyn, NY 11201",
+        "spotCapacity": "Medium",
+        "spotCreation": "2022-05-09",
+        "spotUpdate": now,
+        "factorAvailability": 2.5,
+        "factorNoiseLevel": 1.0,
+        "factorTemperature": 3.0,
+        "factorAmbiance": 4.0,
+        "numFactorEntries": 4,
+        "factorDate": "2022-05-09"
+    } for i in range(n)]
+
+
+def round_trip(spots):
+    body = [json.loads(json.dumps(doc, default=bsutil.default))
+            for doc in spots]
+    return json.dumps(body)
+
+
+def single_pass(spots):
+    return json.dumps([to_json(doc) for doc in spots])
+
+
+def main():
+    spots = make_spots(NUM_SPOTS)
+    assert round_trip(spots) == single_pass(spots)
+    for name, func in (("dumps/loads", round_trip),
+                       ("to_json", single_pass)):
+        best = min(timeit.repeat(lambda: func(spots), number=1,
+                                 repeat=REPEAT))
+        print(f"{name:12} {best * 1000:8.1f} ms per {NUM_SPOTS} spots")
+
+
+if __name__ == "__main__":
+    main()
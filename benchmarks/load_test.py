@@ -0,0 +1,151 @@
+"""
+Measures how many concurrent connections one gunicorn worker serves.
+Starts the API with a single worker of each class given, hits `--path`
+from `--concurrency` client threads for `--duration` seconds and reports
+throughput, latency and how many requests the worker served at once,
+estimated as throughput x fastest request (the time a request takes when
+it doesn't wait in the worker's queue).
+Run from the repo root, against a database the API can reach:
+    python benchmarks/load_test.py --workers sync gevent
+--db-latency adds that many milliseconds to every database call, to see
+how the workers behave against a remote database (e.g. Atlas) from a
+local one:
+    python benchmarks/load_test.py --workers sync gthread --db-latency 50
+or against a server that is already running:
+    python benchmarks/load_test.py --url http://127.0.0.1:8000
+"""
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+PORT = 8765
+DB_LATENCY_ENV = "LOAD_TEST_DB_LATENCY_MS"
+
+
+def hit(url, duration, latencies, errors):
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        start = time.perf_counter()
+        try:
+            with urllib.request.urlopen(url, timeout=30) as response:
+                response.read()
+        except (urllib.error.URLError, OSError):
+            errors.append(1)
+            continue
+        latencies.append(time.perf_counter() - start)
+
+
+def run_load(url, concurrency, duration):
+    latencies, errors = [], []
+    clients = [threading.Thread(target=hit,
+                                args=(url, duration, latencies, errors))
+               for _ in range(concurrency)]
+    start = time.perf_counter()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.perf_counter() - start
+    if not latencies:
+        return {"requests": 0, "errors": len(errors)}
+    latencies.sort()
+    throughput = len(latencies) / elapsed
+    return {
+        "requests": len(latencies),
+        "errors": len(errors),
+        "rps": throughput,
+        "p50_ms": latencies[len(latencies) // 2] * 1000,
+        "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+        "concurrent": throughput * latencies[0]
+    }
+
+
+def wait_until_up(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            urllib.request.urlopen(url, timeout=1).read()
+            return True
+        except (urllib.error.URLError, OSError):
+            time.sleep(0.2)
+    return False
+
+
+def app_with_db_latency():
+    """
+    The API with every database access delayed by LOAD_TEST_DB_LATENCY_MS,
+    each get_db() call standing for one round trip
+    """
+    import db.db_connect as dbc
+    from API.endpoints import app
+
+    latency = float(os.environ.get(DB_LATENCY_ENV, 0)) / 1000
+    get_db = dbc.get_db
+
+    def slow_get_db():
+        time.sleep(latency)
+        return get_db()
+
+    dbc.get_db = slow_get_db
+    return app
+
+
+def serve(worker_class, db_latency=0):
+    env = dict(os.environ, GUNICORN_WORKER_CLASS=worker_class,
+               WEB_CONCURRENCY="1", PORT=str(PORT))
+    app = "API.endpoints:app"
+    if db_latency:
+        env[DB_LATENCY_ENV] = str(db_latency)
+        app = "benchmarks.load_test:app_with_db_latency()"
+    return subprocess.Popen([sys.executable, "-m", "gunicorn", "-c",
+                             "gunicorn.conf.py", app],
+                            env=env, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+
+
+def report(name, result):
+    if not result["requests"]:
+        print(f"{name:8} no successful requests, {result['errors']} errors")
+        return
+    print(f"{name:8} {result['rps']:8.1f} req/s  p50 {result['p50_ms']:7.1f}"
+          f" ms  p99 {result['p99_ms']:7.1f} ms  concurrent "
+          f"{result['concurrent']:6.1f}  errors {result['errors']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--path", default="/spots/list")
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--workers", nargs="+", default=["sync", "gevent"],
+                        help="worker classes to start and compare")
+    parser.add_argument("--db-latency", type=float, default=0,
+                        help="milliseconds added to every database call")
+    parser.add_argument("--url", help="test this server instead")
+    args = parser.parse_args()
+
+    if args.url:
+        report("server", run_load(args.url + args.path, args.concurrency,
+                                  args.duration))
+        return
+    url = f"http://127.0.0.1:{PORT}{args.path}"
+    for worker_class in args.workers:
+        server = serve(worker_class, args.db_latency)
+        try:
+            if not wait_until_up(url):
+                print(f"{worker_class:8} server did not start")
+                continue
+            report(worker_class, run_load(url, args.concurrency,
+                                          args.duration))
+        finally:
+            server.terminate()
+            server.wait()
+
+
+if __name__ == "__main__":
+    main()
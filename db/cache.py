@@ -0,0 +1,149 @@
+"""
+This holds the in-process cache for spot documents and the backends it
+can be stored in. Values and versions must be JSON-ready (see
+db.serializer) so that a shared backend such as Redis can store them too.
+"""
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+SPOT_CACHE_SIZE = int(os.environ.get("SPOT_CACHE_SIZE", 1024))
+SPOT_META_TTL = float(os.environ.get("SPOT_META_TTL", 300))
+SPOT_FACTOR_TTL = float(os.environ.get("SPOT_FACTOR_TTL", 5))
+SPOT_CACHE_BACKEND = os.environ.get("SPOT_CACHE_BACKEND", "memory")
+REDIS_URL = os.environ.get("REDIS_URL")
+
+
+class MemoryBackend:
+    """
+    LRU dict bounded to `max_size` entries, each with its own expiry
+    """
+
+    def __init__(self, max_size=SPOT_CACHE_SIZE):
+        self.max_size = max_size
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {"size": len(self._entries), "max_size": self.max_size,
+                "evictions": self.evictions}
+
+
+class RedisBackend:
+    """
+    Entries stored in Redis so every worker shares them.
+    `redis` is a redis-py compatible client, Redis bounds the size itself
+    (maxmemory-policy allkeys-lru).
+    """
+
+    def __init__(self, redis, prefix="hotspots:"):
+        self.redis = redis
+        self.prefix = prefix
+
+    def get(self, key):
+        value = self.redis.get(self.prefix + key)
+        return None if value is None else json.loads(value)
+
+    def set(self, key, value, ttl):
+        self.redis.set(self.prefix + key, json.dumps(value),
+                       ex=max(1, math.ceil(ttl)))
+
+    def delete(self, *keys):
+        if keys:
+            self.redis.delete(*[self.prefix + key for key in keys])
+
+    def clear(self):
+        keys = list(self.redis.scan_iter(match=self.prefix + "*"))
+        if keys:
+            self.redis.delete(*keys)
+
+    def stats(self):
+        return {"backend": "redis"}
+
+
+def get_backend(namespace):
+    """
+    Backend chosen by SPOT_CACHE_BACKEND (memory or redis)
+    """
+    if SPOT_CACHE_BACKEND == "redis":
+        import redis
+        return RedisBackend(redis.Redis.from_url(REDIS_URL),
+                            prefix=f"hotspots:{namespace}:")
+    return MemoryBackend()
+
+
+class Cache:
+    """
+    Named cache with one TTL for all of its entries, counting hits and
+    misses. Callers load missing values themselves and `set` them.
+    An entry can carry the version of the data it was loaded at: a `get`
+    asking for another version is a miss.
+    """
+
+    def __init__(self, name, ttl, backend=None):
+        self.name = name
+        self.ttl = ttl
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, version=None):
+        entry = self.backend.get(key)
+        if entry is not None and version is not None \
+                and entry["version"] != version:
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return entry["value"]
+
+    def set(self, key, value, version=None):
+        if value is not None and self.ttl > 0:
+            self.backend.set(key, {"version": version, "value": value},
+                             self.ttl)
+
+    def invalidate(self, *keys):
+        self.backend.delete(*keys)
+
+    def clear(self):
+        self.backend.clear()
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        stats = {"ttl": self.ttl, "hits": self.hits, "misses": self.misses,
+                 "hit_ratio": round(self.hits / lookups, 3) if lookups else 0}
+        stats.update(self.backend.stats())
+        return stats
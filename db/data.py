@@ -1,10 +1,23 @@
 # from hashlib import new
+import logging
 import os
+import shutil
+from bson.errors import InvalidId
 import db.db_connect as dbc
-from db.models import SPOT_FACTORS
+import db.images as images
+import db.indexes as indexes
+import db.invalidation as invalidation
+import db.uploads as uploads
+from db.cache import (Cache, get_backend, SPOT_META_TTL,
+                      SPOT_FACTOR_TTL)
+from db.factor_buffer import FactorBuffer
+from db.models import (SPOT_FACTORS, FACTOR_FIELDS, REVIEW_DOCUMENT,
+                       LIGHT_SPOT_DOCUMENT)
 from dotenv import load_dotenv
 from datetime import datetime
 
+LOG = logging.getLogger(__name__)
+
 load_dotenv()
 
 TEST_MODE = os.environ.get("TEST_MODE")
@@ -16,39 +29,227 @@ else:
     DB_NAME = os.environ.get("MONGO_PROD")
     URLNAME = "https://hotspotsapi.herokuapp.com"
 
-print("Using DB:", DB_NAME)
-
 OK = 0
 NOT_FOUND = 1
 DUPLICATE = 2
 
-client = dbc.get_client()
-print(client)
+REVIEW_PAGE_SIZE = dbc.REVIEW_PAGE_SIZE
+MAX_REVIEW_PAGE_SIZE = 100
+# one GridFS chunk, the most an upload copied into GridFS holds in memory
+UPLOAD_COPY_SIZE = 255 * 1024
+
+if os.environ.get("ENSURE_INDEXES") == "1":
+    indexes.ensure_indexes_in_background(dbc.get_db())
+
+# spot metadata rarely changes, live factors change all the time
+META_FIELDS = list(LIGHT_SPOT_DOCUMENT)
+ALL_SPOTS = "all"
+spot_meta_cache = Cache("spot_meta", SPOT_META_TTL,
+                        get_backend("spot_meta"))
+spot_factor_cache = Cache("spot_factors", SPOT_FACTOR_TTL,
+                          get_backend("spot_factors"))
+
+
+def write_buffered_factors(updates, batch_id):
+    failed = dbc.bulk_update_spot_factors(updates, batch_id)
+    for spot_id in {spot_id for spot_id, _, _, _ in updates}:
+        publish_spot_change(spot_id, meta=False)
+    return failed
+
+
+factor_buffer = FactorBuffer(write_buffered_factors)
+
+
+def spot_key(spot_id):
+    """
+    Canonical cache key of a spot id, or None if it isn't a valid id
+    """
+    try:
+        return str(dbc.convert_to_object_id(spot_id))
+    except InvalidId:
+        return None
+
+
+def invalidate_spot(*spot_ids, meta=True, factors=True):
+    keys = [key for key in map(spot_key, spot_ids) if key] + [ALL_SPOTS]
+    if meta:
+        spot_meta_cache.invalidate(*keys)
+    if factors:
+        spot_factor_cache.invalidate(*keys)
+
+
+def on_spot_changed(event):
+    """
+    Drop what this worker cached about a spot changed by any worker
+    """
+    invalidate_spot(event["spotID"], meta=event["meta"],
+                    factors=event["factors"])
+
+
+invalidation_bus = invalidation.get_bus(
+    lambda: dbc.get_db()['spots'])
+invalidation_bus.subscribe(on_spot_changed)
+invalidation_bus.start()
+
+
+def publish_spot_change(spot_id, meta=True, factors=True, reviews=False):
+    invalidation_bus.publish(
+        invalidation.spot_event(spot_id, meta, factors, reviews))
+
+
+def split_spot(spot):
+    meta = {"_id": spot["_id"]}
+    factors = {"_id": spot["_id"]}
+    for field, value in spot.items():
+        if field in META_FIELDS:
+            meta[field] = value
+        elif field != "_id":
+            factors[field] = value
+    return meta, factors
+
+
+def merge_spot(meta, factors):
+    """
+    Build a fresh spot from its cached parts, with today's factor reset and
+    this worker's buffered submissions applied
+    """
+    spot = dict(meta)
+    spot.update(factors or {})
+    dbc.apply_factor_reset(spot, dbc.get_today())
+    if factor_buffer.enabled:
+        apply_pending_factors(spot)
+    return spot
+
+
+def get_spots(version=None):
+    """
+    return all spots in spots collection.
+    With the list `version` (see get_spots_version) the cached list is
+    only used if it was loaded at that version.
+    """
+    meta_version = factor_version = None
+    if version is not None:
+        meta_version, factor_version = version[0], "%d.%d" % version
+    metas = spot_meta_cache.get(ALL_SPOTS, meta_version)
+    if metas is None:
+        spots = [split_spot(spot) for spot in dbc.get_all_spots()]
+        metas = [meta for meta, _ in spots]
+        factors = {meta["_id"]["$oid"]: spot_factors
+                   for meta, spot_factors in spots}
+        spot_meta_cache.set(ALL_SPOTS, metas, meta_version)
+        spot_factor_cache.set(ALL_SPOTS, factors, factor_version)
+    else:
+        factors = spot_factor_cache.get(ALL_SPOTS, factor_version)
+        if factors is None:
+            factors = {spot["_id"]["$oid"]: spot
+                       for spot in dbc.get_all_spots(FACTOR_FIELDS)}
+            spot_factor_cache.set(ALL_SPOTS, factors, factor_version)
+    return [merge_spot(meta, factors.get(meta["_id"]["$oid"]))
+            for meta in metas]
+
+
+def get_cached_spot(spot_id, version=None):
+    """
+    Read-through lookup of one spot, None if it doesn't exist.
+    With the spot's `version` (see get_spot_version) cached metadata is
+    only used if it was loaded at that metaVersion, cached factors at
+    that spotVersion.
+    """
+    key = spot_key(spot_id)
+    if key is None:
+        return None
+    spot_version, meta_version = version or (None, None)
+    meta = spot_meta_cache.get(key, meta_version)
+    factors = spot_factor_cache.get(key, spot_version)
+    if meta is None:
+        spot = dbc.fetch_spot_details(key)
+        if spot is None:
+            return None
+        meta, factors = split_spot(spot)
+        spot_meta_cache.set(key, meta, meta_version)
+        spot_factor_cache.set(key, factors, spot_version)
+    elif factors is None:
+        factors = dbc.fetch_spot_details(key, FACTOR_FIELDS)
+        if factors is None:
+            spot_meta_cache.invalidate(key)
+            return None
+        spot_factor_cache.set(key, factors, spot_version)
+    return merge_spot(meta, factors)
+
+
+def get_live_factors(spot_ids):
+    """
+    Current spots of `spot_ids` that still exist, by spot id
+    """
+    spots = {}
+    for spot_id in spot_ids:
+        spot = get_cached_spot(spot_id)
+        if spot is not None:
+            spots[spot_id] = spot
+    return spots
+
+
+def get_spots_version():
+    """
+    Version of the spot list, read without fetching any spot
+    """
+    return dbc.get_spots_version()
+
+
+def get_spots_etag(version=None):
+    """
+    ETag of the spot list at `version`, the current one if not given.
+    It changes with every spot write, at the daily factor reset and with
+    every submission still in this worker's factor buffer, which the list
+    shows. With nothing buffered it is the same on every worker.
+    """
+    if version is None:
+        version = get_spots_version()
+    meta_version, live_version = version
+    etag = f"spots-{meta_version}.{live_version}-{dbc.get_today()}"
+    generation = factor_buffer.generation()
+    return etag if generation is None else f"{etag}-{generation}"
+
+
+def get_spot_version(spot_id):
+    """
+    Versions of one spot, (spotVersion, metaVersion), or None if the spot
+    doesn't exist
+    """
+    return dbc.get_spot_version(spot_id)
 
 
-def get_spots():
+def get_spot_etag(spot_id, version=None):
     """
-    return all spots in spots collection
+    ETag of one spot's detail at `version`, the current one if not given,
+    or None if the spot doesn't exist
     """
-    return dbc.get_all_spots()
+    if version is None:
+        version = get_spot_version(spot_id)
+        if version is None:
+            return None
+    today = dbc.get_today()
+    pending = factor_buffer.pending(spot_id, today) if factor_buffer.enabled \
+        else None
+    pending_count = pending[0] if pending else 0
+    return f"{spot_id}-{version[0]}-{today}-{pending_count}"
 
 
 def add_spot(spotName, spotAddress, spotCapacity, spotImage, spotImageUpload):
     """
     create a new spot document
     """
+    spotImageFile = store_spot_image(spotImage, spotImageUpload)
     if spotImageUpload:
-        filename = spotImageUpload.filename
-        id = str(dbc.save_file(filename, spotImageUpload))
-        spotImage = f"{URLNAME}/file/{id}"
+        spotImage = file_url(spotImageFile)
 
     today = datetime.today().date().strftime('%Y-%m-%d')
     now = str(datetime.now().strftime('%Y-%m-%d'))
-    print("Creating new spot document")
-    print("Today is", today)
+    LOG.debug("Creating new spot document, today is %s", today)
     spot_document = {
         "spotName": spotName,
         "spotImage": spotImage,
+        "spotImageFile": spotImageFile,
         "spotAddress": spotAddress,
         "spotCapacity": spotCapacity,
         "spotCreation": now,
@@ -58,23 +259,33 @@ def add_spot(spotName, spotAddress, spotCapacity, spotImage, spotImageUpload):
         "factorTemperature": 0,
         "factorAmbiance": 0,
         "numFactorEntries": 0,
-        "factorDate": today
+        "factorSums": {f_field: 0 for f_field in SPOT_FACTORS},
+        "factorDate": today,
+        "spotVersion": 0,
+        "metaVersion": 0
     }
 
     response = dbc.create_spot(spot_document)
-    print("Add Spot Response:", response)
+    LOG.debug("Add Spot Response: %s", response)
     if response is None:
+        if spotImageFile:
+            dbc.release_file(spotImageFile)
         return DUPLICATE
+    publish_spot_change(response)
     return response
 
 
-def get_spot_detail(spot_id):
-    response = dbc.fetch_spot_details(spot_id)
+def get_spot_detail(spot_id, version=None):
+    response = get_cached_spot(spot_id, version)
     if response is None:
         return NOT_FOUND
-    reviews = get_review_by_spot(spot_id)
+    # the spot's ETag comes from its version on the primary
+    reviews = get_review_by_spot(spot_id, primary=True)
     if reviews is not NOT_FOUND:
         response["reviews"] = reviews
+        response["reviewCount"] = dbc.count_reviews_by_spot(spot_id,
+                                                            primary=True)
+        response["reviewCursor"] = get_review_cursor(reviews)
     return response
 
 
@@ -83,54 +294,71 @@ def update_spot(spot_id, spotName, spotAddress, spotCapacity,
     """
     Update spot attribute
     """
+    spotImageFile = store_spot_image(spotImage, spotImageUpload)
     if spotImageUpload:
-        filename = spotImageUpload.filename
-        id = str(dbc.save_file(filename, spotImageUpload))
-        spotImage = f"{URLNAME}/file/{id}"
+        spotImage = file_url(spotImageFile)
 
     spot_document = {
         "spotName": spotName,
         "spotImage": spotImage,
+        "spotImageFile": spotImageFile,
         "spotAddress": spotAddress,
         "spotCapacity": spotCapacity,
         "spotUpdate": str(datetime.now())
     }
     response = dbc.update_spot(spot_id, spot_document)
-    if response is None:
-        return NOT_FOUND
+    if response is None or response is False:
+        if spotImageFile:
+            dbc.release_file(spotImageFile)
+        return NOT_FOUND if response is None else DUPLICATE
+    publish_spot_change(spot_id)
     return response
 
 
 def update_spot_factors(spot_id, factor_update):
-    spot_id = dbc.convert_to_object_id(spot_id)
-    spot_document = dbc.check_document_exist("_id", spot_id, "spots")
-    if not spot_document:
-        return NOT_FOUND
-    # we won't have more than one bc we look by id
-    new_spot_doc = spot_document[0]
-    today = datetime.today().date()
-    date = datetime.strptime(new_spot_doc["factorDate"], '%Y-%m-%d').date()
-    if date != today:
-        # reset everything to 0, doesn't matter for the average
-        print("Resetting factors with today's data: %s", today)
-        new_spot_doc["numFactorEntries"] = 0
-        new_spot_doc["factorDate"] = today
-        for f_field in SPOT_FACTORS:
-            new_spot_doc[f_field] = 0
-
-    N = new_spot_doc["numFactorEntries"]
-    new_spot_doc["numFactorEntries"] += 1
+    """
+    Add one crowd-sourced factor submission to a spot
+    """
+    sums = {}
     for f_field in SPOT_FACTORS:
-        old_avg = new_spot_doc[f_field]
         new_value = factor_update[f_field]
         if new_value < 1:
             new_value = 0
         elif new_value > 5:
             new_value = 5
-        new_spot_doc[f_field] = get_average(old_avg, N, new_value)
+        sums[f_field] = new_value
+
+    if factor_buffer.enabled:
+        if not dbc.spot_exists(spot_id):
+            return NOT_FOUND
+        factor_buffer.add(spot_id, dbc.get_today(), sums)
+        return dbc.convert_to_object_id(spot_id)
 
-    dbc.update_spot_factor(spot_id, new_spot_doc)
-    return spot_id
+    response = dbc.update_spot_factor(spot_id, 1, sums)
+    if response is None:
+        return NOT_FOUND
+    publish_spot_change(spot_id, meta=False)
+    return response["_id"]
+
+
+def apply_pending_factors(spot):
+    """
+    Fold buffered submissions that aren't written yet into a spot read
+    from the database, so a client sees its own factor update right away.
+    """
+    pending = factor_buffer.pending(spot["_id"]["$oid"], spot["factorDate"])
+    if pending is None:
+        return spot
+    count, sums = pending
+    n = spot["numFactorEntries"]
+    spot_sums = spot.get("factorSums") or {}
+    spot["numFactorEntries"] = n + count
+    spot["factorSums"] = {}
+    for f_field in SPOT_FACTORS:
+        old_sum = spot_sums.get(f_field, spot[f_field] * n)
+        spot["factorSums"][f_field] = old_sum + sums[f_field]
+        spot[f_field] = spot["factorSums"][f_field] / (n + count)
+    return spot
 
 
 def get_average(old_average, n, new_value):
@@ -139,15 +367,13 @@ def get_average(old_average, n, new_value):
 
 def delete_spot(spot_id):
     """
-    Deletes a flavor
+    Deletes a spot with its reviews and image.
+    Returns counts of deleted spots, reviews, files and chunks.
     """
     response = dbc.delete_spot(spot_id)
     if response is None:
         return NOT_FOUND
-    reviews = dbc.get_review_by_spot(spot_id)
-    if reviews:
-        for review in reviews:
-            delete_review(review["_id"]["$oid"], None, True)
+    publish_spot_change(spot_id)
     return response
 
 
@@ -165,11 +391,12 @@ def add_review(spotID, reviewTitle, reviewText, reviewRating, user_id):
         "reviewRating": reviewRating,
         "userID": user_id
     }
-    print("Create review object", review_object)
+    LOG.debug("Create review object %s", review_object)
     response = dbc.create_review(spotID, review_object)
     if not response:
         return NOT_FOUND
-    print("Add Review response: ", response)
+    LOG.debug("Add Review response: %s", response)
+    publish_review_change(spotID)
     return response
 
 
@@ -177,18 +404,57 @@ def delete_review(reviewID, user_id, admin):
     """
     Deletes a review
     """
+    review = get_review_owner(reviewID)
     response = dbc.delete_review(reviewID, user_id, admin)
     if response is None:
         return NOT_FOUND
+    publish_review_change(review["spotID"])
+    return response
+
+
+def get_review_owner(review_id):
+    """
+    Owner and spot of a review, None if it doesn't exist
+    """
+    try:
+        return dbc.fetch_review_owner(dbc.convert_to_object_id(review_id))
+    except InvalidId:
+        return None
+
+
+def publish_review_change(*spot_ids):
+    for spot_id in set(spot_ids):
+        if spot_id:
+            publish_spot_change(spot_id, meta=False, factors=False,
+                                reviews=True)
+
+
+def get_review_by_spot(spot_id, limit=REVIEW_PAGE_SIZE, after=None,
+                       order="asc", fields=None, primary=False):
+    """
+    Get one page of reviews by spot id
+    """
+    limit = review_page_limit(limit)
+    if fields:
+        fields = [field for field in fields if field in REVIEW_DOCUMENT]
+    response = dbc.get_review_by_spot(spot_id, limit, after,
+                                      order == "desc", fields, primary)
+    if response is None or (not response and not after):
+        return NOT_FOUND
     return response
 
 
-def get_review_by_spot(spot_id):
+def review_page_limit(limit):
+    return max(1, min(limit or REVIEW_PAGE_SIZE, MAX_REVIEW_PAGE_SIZE))
+
+
+def get_review_cursor(reviews, limit=REVIEW_PAGE_SIZE):
     """
-    Get review by spot id
+    Return the cursor for the page after `reviews`, or None if it's the last
     """
-    response = dbc.get_review_by_spot(spot_id)
-    return response if response is not None else NOT_FOUND
+    if reviews == NOT_FOUND or len(reviews) < limit:
+        return None
+    return reviews[-1]["_id"]["$oid"]
 
 
 def update_review(review_id, spot_id, reviewTitle,
@@ -200,12 +466,93 @@ def update_review(review_id, spot_id, reviewTitle,
         "reviewRating": reviewRating,
         "reviewUpdate": str(datetime.now())
     }
+    review = get_review_owner(review_id)
     response = dbc.update_review(review_id, review_document, user_id)
     if response is None:
         return NOT_FOUND
+    publish_review_change(review["spotID"], spot_id)
     return response
 
 
-def get_file(file_id):
-    file = dbc.fetch_file(file_id)
+def get_pool_stats():
+    return dbc.pool_monitor.stats()
+
+
+def file_url(file_id):
+    return f"{URLNAME}/file/{file_id}"
+
+
+def store_spot_image(spotImage, spotImageUpload):
+    """
+    Reference the image a spot is saved with: the upload, or one of our
+    files given by URL. Returns the file id, None for an external URL.
+    """
+    if spotImageUpload:
+        return save_image(spotImageUpload)
+    if spotImage and spotImage.startswith(f"{URLNAME}/file/"):
+        return dbc.retain_file(spotImage.split("/")[-1])
+    return None
+
+
+def open_upload(filename):
+    """
+    Writable GridFS upload for a file part of a request, see db/uploads.py
+    """
+    return dbc.open_upload(filename)
+
+
+def save_image(upload):
+    """
+    Store an uploaded image with its resized variants, return its file id.
+    An image already stored gets one more reference instead of a copy.
+    `upload` is usually already streamed into GridFS by the request (see
+    open_upload), anything else is copied into GridFS chunk by chunk.
+    Raises uploads.UploadTooLarge over MAX_UPLOAD_SIZE.
+    """
+    filename = upload.filename
+    stream = getattr(upload, "stream", upload)
+    if not isinstance(stream, uploads.GridFSUpload):
+        stream = open_upload(filename)
+        shutil.copyfileobj(upload, stream, UPLOAD_COPY_SIZE)
+    sha256 = stream.sha256.hexdigest()
+    content_type = stream.content_type
+    # the sha256 index is unique over referenced uploads: when the same
+    # image is uploaded twice at once only one is stored, the other
+    # upload finds it the next time round
+    while True:
+        id = dbc.acquire_file(sha256)
+        if id is not None:
+            LOG.debug("%s is already stored as %s", filename, id)
+            stream.close()
+            return str(id)
+        id = stream.finish({"sha256": sha256, "refCount": 1,
+                            "contentType": content_type})
+        if id is not None:
+            break
+    variants = {}
+    if images.available() and content_type.startswith("image/"):
+        try:
+            stream.seek(0)
+            variants = images.make_variants(stream)
+        except ValueError as error:
+            LOG.warning("Stored %s without variants: %s", filename, error)
+    stream.close()
+    stem = filename.rsplit(".", 1)[0]
+    for variant, (content, width, height) in variants.items():
+        dbc.save_file(f"{stem}.{variant}.{images.VARIANT_EXTENSION}",
+                      content, {"variantOf": id, "variant": variant,
+                                "contentType": images.VARIANT_CONTENT_TYPE,
+                                "width": width, "height": height})
+    return str(id)
+
+
+def get_file(file_id, variant=None):
+    """
+    Stored file, or its image `variant` when it has one
+    """
+    file = None
+    if variant:
+        file = dbc.fetch_file_variant(file_id, variant)
+    if file is None:
+        file = dbc.fetch_file(file_id)
     return file if file is not None else NOT_FOUND
@@ -2,18 +2,22 @@
 This file contains some common MongoDB code.
 """
 import os
-import json
-import logging as LOG
+import logging
 import pymongo as pm
 import bson.json_util as bsutil
 import gridfs
-from io import BytesIO
 from bson.errors import InvalidId
 from dotenv import load_dotenv
 from datetime import datetime
 
+from API.metrics import command_timer, db_function_seconds, timed
 from API.security.utils import json_abort
-from db.models import RESET_FACTORS
+from db.models import RESET_FACTORS, SPOT_FACTORS, FACTOR_FIELDS
+from db.pool_monitor import PoolMonitor
+from db.serializer import to_json
+from db.uploads import GridFSUpload, MAX_UPLOAD_SIZE
+
+LOG = logging.getLogger(__name__)
 
 load_dotenv()
 
@@ -31,31 +35,126 @@ if TEST_MODE == "0":
 else:
     DB_NAME = os.environ.get("MONGO_PROD")
     URLNAME = "https://hotspotsapi.herokuapp.com"
-print("Using DB:", DB_NAME)
 
 
+REVIEW_PAGE_SIZE = 20
+# buffered factor batches each spot remembers, see bulk_update_spot_factors
+FACTOR_BATCH_HISTORY = 20
+# everything but internal bookkeeping
+SPOT_PROJECTION = {"factorBatches": 0}
+USE_TRANSACTIONS = os.environ.get("MONGO_TRANSACTIONS") == "1"
+
+# fs.files filters: uploads whose last reference was released, and files
+# stored before reference counting
+UNREFERENCED = {"metadata.refCount": {"$lte": 0}}
+LEGACY = {"metadata.refCount": {"$exists": False}}
+
+# connection pool, see README "Connection pool"
+MONGO_MAX_POOL_SIZE = int(os.environ.get("MONGO_MAX_POOL_SIZE", 100))
+MONGO_MIN_POOL_SIZE = int(os.environ.get("MONGO_MIN_POOL_SIZE", 0))
+MONGO_WAIT_QUEUE_TIMEOUT_MS = os.environ.get("MONGO_WAIT_QUEUE_TIMEOUT_MS")
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(
+    os.environ.get("MONGO_SERVER_SELECTION_TIMEOUT_MS", 30000))
+# e.g. "zstd,snappy", needs the zstandard / python-snappy packages
+MONGO_COMPRESSORS = os.environ.get("MONGO_COMPRESSORS")
+MONGO_READ_PREFERENCE = os.environ.get("MONGO_READ_PREFERENCE", "primary")
+# send list, review and file reads to secondaries
+MONGO_REPLICA_READS = os.environ.get("MONGO_REPLICA_READS") == "1"
+# 90 is the smallest value MongoDB accepts
+MONGO_MAX_STALENESS_SECONDS = int(
+    os.environ.get("MONGO_MAX_STALENESS_SECONDS", 90))
+
 client = None
+client_pid = None
+pool_monitor = PoolMonitor(MONGO_MAX_POOL_SIZE)
+
+
+def client_options():
+    """
+    MongoClient keyword arguments from the MONGO_* environment variables
+    """
+    options = {
+        "maxPoolSize": MONGO_MAX_POOL_SIZE,
+        "minPoolSize": MONGO_MIN_POOL_SIZE,
+        "serverSelectionTimeoutMS": MONGO_SERVER_SELECTION_TIMEOUT_MS,
+        "readPreference": MONGO_READ_PREFERENCE,
+        "event_listeners": [pool_monitor, command_timer]
+    }
+    if MONGO_WAIT_QUEUE_TIMEOUT_MS:
+        options["waitQueueTimeoutMS"] = int(MONGO_WAIT_QUEUE_TIMEOUT_MS)
+    if MONGO_COMPRESSORS:
+        options["compressors"] = MONGO_COMPRESSORS
+    return options
 
 
 def get_client():
     """
     This provides a uniform way to get the client across all uses.
-    Returns a mongo client object... maybe we shouldn't?
+    Returns this process's mongo client, created on first use so that
+    every forked worker gets its own connection pool.
     Also set global client variable.
     """
-    global client
+    global client, client_pid
+    if client is not None and client_pid == os.getpid():
+        return client
     LOCAL_DB = os.environ.get("LOCAL_DB")
-    print("LOCAL_DB", LOCAL_DB)
+    # on first use, once the entry point has configured logging
+    LOG.info("Using DB: %s", DB_NAME)
+    LOG.debug("LOCAL_DB %s", LOCAL_DB)
     if LOCAL_DB == "0":
         LOG.info("Local DB")
-        client = pm.MongoClient()
+        client = pm.MongoClient(**client_options())
     else:
         client = pm.MongoClient(f"mongodb+srv://{username}:{passwd}"
                                 + f"@{cloud_db_url}/" + DB_NAME
-                                + f"?{db_params}", connect=False)
+                                + f"?{db_params}", connect=False,
+                                **client_options())
+    client_pid = os.getpid()
     return client
 
 
+def get_db():
+    """
+    Database reading from the primary whatever MONGO_READ_PREFERENCE says,
+    see get_replica_db for reads that may lag
+    """
+    return get_client().get_database(
+        DB_NAME, read_preference=pm.ReadPreference.PRIMARY)
+
+
+def get_replica_db():
+    """
+    Database for reads that may lag behind the last write by up to
+    MONGO_MAX_STALENESS_SECONDS: review pages and file contents.
+    Anything cached, or sent under an ETag built from the spot versions on
+    the primary (spot lists, spot details with their reviews, the
+    variants of a file), ownership checks and read-after-write read from
+    get_db(), or a lagging body would be pinned to a newer ETag.
+    Uses MONGO_READ_PREFERENCE unless MONGO_REPLICA_READS is set.
+    """
+    if not MONGO_REPLICA_READS:
+        return get_client()[DB_NAME]
+    read_preference = pm.read_preferences.SecondaryPreferred(
+        max_staleness=MONGO_MAX_STALENESS_SECONDS)
+    return get_client().get_database(
+        DB_NAME, read_preference=read_preference)
+
+
+def forget_client():
+    """
+    Drop the client inherited from the parent process after a fork, its
+    sockets belong to the parent
+    """
+    global client, client_pid, pool_monitor
+    client = None
+    client_pid = None
+    pool_monitor = PoolMonitor(MONGO_MAX_POOL_SIZE)
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=forget_client)
+
+
 def generate_id():
     """
     Generates a Mongo ObjectID
@@ -70,41 +169,155 @@ def convert_to_object_id(flavor_id):
     return bsutil.ObjectId(flavor_id)
 
 
-def reset_factor():
-    today = datetime.today().date().strftime('%Y-%m-%d')
-    reset_factor = RESET_FACTORS
-    reset_factor["factorDate"] = today
+def get_today():
+    return datetime.today().date().strftime('%Y-%m-%d')
+
+
+def reset_factor(today=None):
+    reset_factor = dict(RESET_FACTORS)
+    reset_factor["factorSums"] = dict(RESET_FACTORS["factorSums"])
+    reset_factor["factorDate"] = today or get_today()
     return reset_factor
 
 
-def check_document_exist(field, field_value, collection):
-    cursor = list(client[DB_NAME][collection].find({field: field_value}))
-    return cursor if len(cursor) > 0 else False
+def apply_factor_reset(doc, today):
+    """
+    Show a spot whose factors are from an earlier day as reset, without
+    writing it back. The next factor submission persists the reset.
+    """
+    if doc.get("factorDate") != today:
+        doc.update(reset_factor(today))
+    return doc
+
+
+@timed(db_function_seconds)
+def reset_stale_factors():
+    """
+    Persist the daily factor reset for every stale spot with one write.
+    Reads never need this, it only tidies the stored documents and is
+    meant to be run once at the day boundary (e.g. a scheduled job).
+    """
+    today = get_today()
+    filter = {"spotName": {"$exists": True}, "factorDate": {"$ne": today}}
+    new_values = {"$set": reset_factor(today)}
+    return get_db()['spots'].update_many(filter, new_values)
+
+
+@timed(db_function_seconds)
+def document_exists(field, field_value, collection):
+    """
+    Check a matching document exists, fetching nothing but its _id
+    """
+    filter = {field: field_value}
+    found = get_db()[collection].find_one(filter, {"_id": 1})
+    return found is not None
+
+
+@timed(db_function_seconds)
+def fetch_document(field, field_value, collection, fields=None):
+    """
+    Fetch one matching document, with only `fields` if given
+    """
+    projection = dict.fromkeys(fields, 1) if fields else None
+    filter = {field: field_value}
+    return get_db()[collection].find_one(filter, projection)
+
+
+def fetch_review_owner(review_id):
+    """
+    Fetch only the owner and spot of a review, for permission checks
+    """
+    return fetch_document("_id", review_id, "reviews", ["userID", "spotID"])
+
+
+@timed(db_function_seconds)
+def get_spots_version():
+    """
+    Version of the spot list, (meta version, live version) from the meta
+    document. The meta version is bumped when a spot is created, edited
+    or deleted, the live version by the other writes that change a
+    spot's spotVersion: factor writes (once per buffered flush) and
+    reviews.
+    """
+    meta = get_db()['meta'].find_one({"_id": "spots"}) or {}
+    return meta.get("version", 0), meta.get("liveVersion", 0)
+
+
+@timed(db_function_seconds)
+def get_spot_version(spot_id):
+    """
+    Versions of one spot, (spotVersion, metaVersion), or None if the spot
+    doesn't exist. spotVersion changes with every write to the spot,
+    metaVersion only when its metadata is edited.
+    """
+    try:
+        spot_id = convert_to_object_id(spot_id)
+    except InvalidId:
+        return None
+    spot = fetch_document("_id", spot_id, "spots",
+                          ["spotVersion", "metaVersion"])
+    if spot is None:
+        return None
+    return spot.get("spotVersion", 0), spot.get("metaVersion", 0)
+
+
+@timed(db_function_seconds)
+def bump_spots_version(session=None, meta=True):
+    """
+    Mark the spot list changed, not its metadata unless `meta`
+    """
+    field = "version" if meta else "liveVersion"
+    get_db()['meta'].update_one(
+        {"_id": "spots"}, {"$inc": {field: 1}}, upsert=True,
+        session=session)
+
+
+@timed(db_function_seconds)
+def bump_spot_version(spot_id):
+    """
+    Mark a spot changed by a write that doesn't touch its document,
+    e.g. a review of the spot
+    """
+    try:
+        filter = {"_id": convert_to_object_id(spot_id)}
+    except InvalidId:
+        return None
+    response = get_db()['spots'].update_one(
+        filter, {"$inc": {"spotVersion": 1}})
+    if response.matched_count:
+        # the spot list shows spotVersion
+        bump_spots_version(meta=False)
+    return response
 
 
-def get_all_spots():
+@timed(db_function_seconds)
+def get_all_spots(fields=None):
+    """
+    Return every spot, with only `fields` if given
+    """
     filter = {"spotName": {"$exists": True}}
-    spots_cursor = client[DB_NAME]['spots'].find(filter)
+    projection = dict.fromkeys(fields, 1) if fields else SPOT_PROJECTION
+    # cached and sent under the spots version, so never from a secondary
+    spots_cursor = get_db()['spots'].find(filter, projection)
+    today = get_today()
+    with_factors = not fields or "factorDate" in fields
     output_spots = []
     for doc in spots_cursor:
-        today = datetime.today().date().strftime('%Y-%m-%d')
-        factorDate = doc["factorDate"]
-        if factorDate != today:
-            print("DC Connect, Wrong date")
-            new_spot_factors = reset_factor()
-            update_spot_factor(doc["_id"], new_spot_factors)
-        json_dump = json.dumps(doc, default=bsutil.default)
-        output_spots.append(json.loads(json_dump))
+        if with_factors:
+            apply_factor_reset(doc, today)
+        output_spots.append(to_json(doc))
     return output_spots
 
 
+@timed(db_function_seconds)
 def create_spot(spot_document):
     """
     Adds a new spot document to collection
     """
     LOG.info("Attempting spot creation")
     try:
-        client[DB_NAME]['spots'].insert_one(spot_document)
+        get_db()['spots'].insert_one(spot_document)
+        bump_spots_version()
         LOG.info("Successfully created flavor " + str(spot_document["_id"]))
         return str(spot_document["_id"])
     except pm.errors.DuplicateKeyError:
@@ -112,24 +325,33 @@ def create_spot(spot_document):
         return None
 
 
-def fetch_spot_details(spot_id):
+@timed(db_function_seconds)
+def spot_exists(spot_id):
+    try:
+        return document_exists("_id", convert_to_object_id(spot_id), "spots")
+    except InvalidId:
+        return False
+
+
+@timed(db_function_seconds)
+def fetch_spot_details(spot_id, fields=None):
     try:
         find_object = {"_id": convert_to_object_id(spot_id)}
-        response = client[DB_NAME]['spots'].find_one(find_object)
+        projection = dict.fromkeys(fields, 1) if fields else SPOT_PROJECTION
+        response = get_db()['spots'].find_one(find_object, projection)
         if not response:
             return None
-        print("Fetch", response)
+        LOG.debug("Fetch %s", response)
     except (pm.errors.CursorNotFound, InvalidId):
         LOG.error("Unable to find flavor with id " + spot_id)
+        return None
 
-    today = datetime.today().date().strftime('%Y-%m-%d')
-    if response["factorDate"] != today:
-        resetted = reset_factor()
-        update_spot_factor(response["_id"], resetted)
-    json_response = json.loads(json.dumps(response, default=bsutil.default))
-    return json_response
+    if not fields or "factorDate" in fields:
+        apply_factor_reset(response, get_today())
+    return to_json(response)
 
 
+@timed(db_function_seconds)
 def update_spot(spot_id, spot_document):
     """
     Update spot object to database
@@ -137,76 +359,111 @@ def update_spot(spot_id, spot_document):
     LOG.info("Attempting spot update")
     try:
         spot_id = convert_to_object_id(spot_id)
-        spot = check_document_exist("_id", spot_id, "spots")
+        spot = fetch_document("_id", spot_id, "spots",
+                              ["spotImage", "spotImageFile"])
         if not spot:
             return None
+        # a new upload, even of the same image, holds its own reference
+        replaced = "spotImage" in spot_document and bool(
+            spot_document.get("spotImageFile")
+            or spot_document["spotImage"] != spot.get("spotImage"))
+        if replaced:
+            spot_document.setdefault("spotImageFile", None)
         else:
-            delete_spot_image(spot)
+            spot_document.pop("spotImageFile", None)
         filter = {"_id": spot_id}
-        new_values = {"$set": spot_document}
-        spot_update = client[DB_NAME]['spots'].update_one(filter, new_values)
+        new_values = {"$set": spot_document,
+                      "$inc": {"spotVersion": 1, "metaVersion": 1}}
+        spot_update = get_db()['spots'].update_one(filter, new_values)
+        bump_spots_version()
+        # release the old image only once nothing points to it any more
+        if replaced:
+            delete_spot_image(spot)
         LOG.info("Successfully updated spot" + str(spot_id))
-        print(spot_update)
+        LOG.debug("%s", spot_update)
         return spot_update
+    except pm.errors.DuplicateKeyError:
+        LOG.error("Duplicate key, unable to rename spot " + str(spot_id))
+        return False
     except (pm.errors.CursorNotFound, InvalidId):
         LOG.error("Error occurred while updating DB, try again later")
         return None
 
 
+@timed(db_function_seconds)
 def delete_spot(spot_id):
     """
-    Delete spot from database
+    Delete a spot together with its reviews and its image file.
+    Returns counts of what was removed, or None if the spot doesn't exist.
+    With MONGO_TRANSACTIONS=1 everything is removed in one transaction.
     """
     LOG.info("Attempting spot deletion")
     try:
         spot_id = convert_to_object_id(spot_id)
-        spot = check_document_exist("_id", spot_id, "spots")
-        if not spot:
-            return None
-        else:
-            delete_spot_image(spot)
-        filter = {"_id": convert_to_object_id(spot_id)}
-        spot_deletion = client[DB_NAME]['spots'].delete_one(filter)
-        LOG.info("Successfully deleted spot " + str(spot_id))
-        return spot_deletion
-    except (pm.errors.CursorNotFound, InvalidId):
+    except InvalidId:
         LOG.error("Spot does not exist in DB")
         return None
+    if USE_TRANSACTIONS:
+        with get_client().start_session() as session:
+            return session.with_transaction(
+                lambda session: delete_spot_cascade(spot_id, session))
+    return delete_spot_cascade(spot_id)
+
+
+def delete_spot_cascade(spot_id, session=None):
+    spot = get_db()['spots'].find_one_and_delete(
+        {"_id": spot_id}, projection={"spotImage": 1, "spotImageFile": 1},
+        session=session)
+    if spot is None:
+        return None
+    review_deletion = get_db()['reviews'].delete_many(
+        {"spotID": str(spot_id)}, session=session)
+    files, chunks = delete_spot_image(spot, session)
+    bump_spots_version(session)
+    LOG.info("Successfully deleted spot " + str(spot_id))
+    return {"spots": 1, "reviews": review_deletion.deleted_count,
+            "files": files, "chunks": chunks}
 
 
-def delete_spot_image(spot):
-    if not spot[0].get("spotImage"):
-        return
-    image = spot[0]["spotImage"]
+def delete_spot_image(spot, session=None):
+    """
+    Release the spot's image if it is stored in our GridFS.
+    Returns counts of deleted files and chunks.
+    """
+    if spot.get("spotImageFile"):
+        return release_file(spot["spotImageFile"], session)
+    # spots created before spotImageFile only have the URL, its file is
+    # theirs unless it is counted, then spotImageFile has been set
+    image = spot.get("spotImage")
     if image and URLNAME in image:
-        # delete the old image and save new one
         old_image_id = image.split("/")[-1]
-        delete_file(old_image_id)
+        return delete_file(old_image_id, session, only_if=LEGACY) or (0, 0)
+    return 0, 0
 
 
+@timed(db_function_seconds)
 def create_review(spotID, review_object):
-    try:
-        spotID = convert_to_object_id(spotID)
-        if not check_document_exist("_id", spotID, "spots"):
-            return None
-    except (pm.errors.CursorNotFound, InvalidId):
+    if not spot_exists(spotID):
         return None
-    response = client[DB_NAME]['reviews'].insert_one(review_object)
-    print("Create Review", response)
+    response = get_db()['reviews'].insert_one(review_object)
+    bump_spot_version(spotID)
+    LOG.debug("Create Review %s", response)
     return str(review_object["_id"])
 
 
+@timed(db_function_seconds)
 def delete_review(review_id, user_id, admin):
     LOG.info("Attempting review deletion")
     try:
         review_id = convert_to_object_id(review_id)
-        review_cursor = check_document_exist("_id", review_id, "reviews")
-        if not review_cursor:
+        review = fetch_review_owner(review_id)
+        if not review:
             return None
         elif not admin:
-            check_user_id_on_review(review_cursor, user_id)
+            check_user_id_on_review(review, user_id)
         filter = {"_id": convert_to_object_id(review_id)}
-        review_deletion = client[DB_NAME]['reviews'].delete_one(filter)
+        review_deletion = get_db()['reviews'].delete_one(filter)
+        bump_spot_version(review.get("spotID"))
         LOG.info("Successfully deleted review " + str(review_id))
         return review_deletion
     except (pm.errors.CursorNotFound, InvalidId):
@@ -214,21 +471,37 @@ def delete_review(review_id, user_id, admin):
         return None
 
 
-def get_review_by_spot(spot_id):
+@timed(db_function_seconds)
+def get_review_by_spot(spot_id, limit=REVIEW_PAGE_SIZE, after=None,
+                       descending=False, fields=None, primary=False):
+    """
+    Return one page of a spot's reviews ordered by _id.
+    `after` is the _id of the last review on the previous page, a `limit`
+    of 0 returns every review and `fields` limits the returned fields.
+    `primary` reads them from the primary, see get_replica_db.
+    """
+    filter = {"spotID": spot_id}
     try:
-        review_cursor = check_document_exist("spotID", spot_id, "reviews")
-        if not review_cursor:
-            return None
-    except (pm.errors.CursorNotFound, InvalidId):
+        if after:
+            operator = "$lt" if descending else "$gt"
+            filter["_id"] = {operator: convert_to_object_id(after)}
+    except InvalidId:
         return None
+    projection = dict.fromkeys(fields, 1) if fields else None
+    order = pm.DESCENDING if descending else pm.ASCENDING
+    db = get_db() if primary else get_replica_db()
+    review_cursor = db['reviews'].find(filter, projection)
+    review_cursor = review_cursor.sort("_id", order).limit(limit)
+    return [to_json(review) for review in review_cursor]
 
-    reviews = []
-    for review in review_cursor:
-        json_dump = json.dumps(review, default=bsutil.default)
-        reviews.append(json.loads(json_dump))
-    return reviews
 
+@timed(db_function_seconds)
+def count_reviews_by_spot(spot_id, primary=False):
+    db = get_db() if primary else get_replica_db()
+    return db['reviews'].count_documents({"spotID": spot_id})
 
+
+@timed(db_function_seconds)
 def update_review(review_id, review_document, user_id):
     """
     Update review object to database
@@ -236,30 +509,32 @@ def update_review(review_id, review_document, user_id):
     LOG.info("Attempting review update")
     try:
         review_id = convert_to_object_id(review_id)
-        review_cursor = check_document_exist("_id", review_id, "reviews")
-        if not review_cursor:
+        review = fetch_review_owner(review_id)
+        if not review:
             return None
         else:
-            check_user_id_on_review(review_cursor, user_id)
+            check_user_id_on_review(review, user_id)
         filter = {"_id": review_id}
         new_values = {"$set": review_document}
         review_update = update_document(filter, new_values, "reviews")
+        for spot_id in {review.get("spotID"), review_document.get("spotID")}:
+            bump_spot_version(spot_id)
         LOG.info("Successfully updated review" + str(review_id))
-        print(review_update)
+        LOG.debug("%s", review_update)
         return review_update
     except (pm.errors.CursorNotFound, InvalidId):
         return None
 
 
-def check_user_id_on_review(review_cursor, user_id):
-    for review in review_cursor:
-        if review["userID"] != user_id:
-            json_abort(403, {"message": "Permission denied"})
+def check_user_id_on_review(review, user_id):
+    if review.get("userID") != user_id:
+        json_abort(403, {"message": "Permission denied"})
 
 
+@timed(db_function_seconds)
 def update_document(filter, new_values, collection):
     try:
-        return client[DB_NAME][collection].update_one(filter, new_values)
+        return get_db()[collection].update_one(filter, new_values)
     except pm.errors.KeyNotFound:
         LOG.error("Flavor does not exist in DB")
         return None
@@ -268,43 +543,257 @@ def update_document(filter, new_values, collection):
         return None
 
 
+@timed(db_function_seconds)
 def get_spot_factor(spot_id, factorName):
     query = {"_id": convert_to_object_id(spot_id)}
     projection = {factorName: 1}
-    return client[DB_NAME]['spots'].find_one(query, projection)[factorName]
+    return get_db()['spots'].find_one(query, projection)[factorName]
 
 
-def update_spot_factor(spot_id, updateFactorDocument):
-    filter = {"_id": convert_to_object_id(spot_id)}
-    new_values = {"$set": updateFactorDocument}
-    return client[DB_NAME]['spots'].update_one(filter, new_values)
+def factor_update_pipeline(today, count, sums, batch_id=None):
+    """
+    Update pipeline adding `count` submissions whose factor values add up
+    to `sums` to a spot. Running sums start over when the spot's factors
+    are from an earlier day, and the averages are derived from the sums.
+    A `batch_id` is added to the spot's recent factorBatches.
+    """
+    same_day = {"$eq": ["$factorDate", today]}
+    running_count = {"$ifNull": ["$numFactorEntries", 0]}
+    add_stage = {
+        "factorDate": today,
+        "numFactorEntries": {"$add": [
+            {"$cond": [same_day, running_count, 0]}, count]}
+    }
+    for f_field in SPOT_FACTORS:
+        # spots written before running sums existed only store the average
+        running_sum = {"$ifNull": [f"$factorSums.{f_field}", {"$multiply": [
+            {"$ifNull": [f"${f_field}", 0]}, running_count]}]}
+        add_stage[f"factorSums.{f_field}"] = {"$add": [
+            {"$cond": [same_day, running_sum, 0]}, sums[f_field]]}
+    average_stage = {
+        f_field: {"$divide": [f"$factorSums.{f_field}", "$numFactorEntries"]}
+        for f_field in SPOT_FACTORS
+    }
+    average_stage["spotVersion"] = {"$add": [
+        {"$ifNull": ["$spotVersion", 0]}, 1]}
+    if batch_id is not None:
+        average_stage["factorBatches"] = {"$slice": [{"$concatArrays": [
+            {"$ifNull": ["$factorBatches", []]}, [batch_id]]},
+            -FACTOR_BATCH_HISTORY]}
+    return [{"$set": add_stage}, {"$set": average_stage}]
+
+
+@timed(db_function_seconds)
+def update_spot_factor(spot_id, count, sums):
+    """
+    Atomically add factor submissions to a spot in one round trip.
+    Returns the spot's new factors, or None if the spot doesn't exist.
+    """
+    try:
+        filter = {"_id": convert_to_object_id(spot_id)}
+    except InvalidId:
+        return None
+    pipeline = factor_update_pipeline(get_today(), count, sums)
+    projection = dict.fromkeys(FACTOR_FIELDS, 1)
+    response = get_db()['spots'].find_one_and_update(
+        filter, pipeline, projection=projection,
+        return_document=pm.ReturnDocument.AFTER)
+    if response is not None:
+        bump_spots_version(meta=False)
+    return response
+
+
+@timed(db_function_seconds)
+def bulk_update_spot_factors(updates, batch_id):
+    """
+    Write buffered factor submissions, a list of
+    (spot_id, day, count, sums), with a single bulk_write.
+    Each spot remembers the last FACTOR_BATCH_HISTORY batch ids it took,
+    so writing a batch again only applies what didn't land the first time.
+    Returns the updates that failed and can be retried.
+    """
+    today = get_today()
+    stale = [update for update in updates if update[1] != today]
+    if stale:
+        # reads already show an earlier day's factors as reset
+        LOG.warning("Dropping %d factor submissions for %d spots from "
+                    "an earlier day", sum(update[2] for update in stale),
+                    len(stale))
+    updates = [update for update in updates if update[1] == today]
+    requests = [
+        pm.UpdateOne({"_id": convert_to_object_id(spot_id),
+                      "factorBatches": {"$ne": batch_id}},
+                     factor_update_pipeline(day, count, sums, batch_id))
+        for spot_id, day, count, sums in updates
+    ]
+    if not requests:
+        return []
+    try:
+        get_db()['spots'].bulk_write(requests, ordered=False)
+    except pm.errors.BulkWriteError as error:
+        failed = {write_error["index"]
+                  for write_error in error.details["writeErrors"]}
+        LOG.error("%d of %d factor updates failed: %s", len(failed),
+                  len(requests), error.details["writeErrors"][:1])
+        failed = [updates[index] for index in sorted(failed)]
+    else:
+        failed = []
+    if len(failed) < len(requests):
+        # once per flush; not part of the batch, a failure here mustn't
+        # write it again
+        try:
+            bump_spots_version(meta=False)
+        except pm.errors.PyMongoError as error:
+            LOG.error("Unable to bump the spots version: %s", error)
+    return failed
+
+
+@timed(db_function_seconds)
+def save_file(name, file, metadata=None):
+    gfs = gridfs.GridFS(get_db())
+    if metadata is None:
+        return gfs.put(file, filename=name)
+    return gfs.put(file, filename=name, metadata=metadata)
+
+
+def open_upload(name, max_size=MAX_UPLOAD_SIZE):
+    """
+    Writable upload streaming into GridFS, see db/uploads.py
+    """
+    return GridFSUpload(get_db(), name, max_size)
 
 
-def save_file(name, file):
-    gfs = gridfs.GridFS(client[DB_NAME])
-    id = gfs.put(file, filename=name)
-    return id
+@timed(db_function_seconds)
+def acquire_file(sha256):
+    """
+    Add a reference to the stored upload whose content hashes to `sha256`.
+    Returns its id, or None if no such file is stored.
+    """
+    found = get_db()['fs.files'].find_one_and_update(
+        {"metadata.sha256": sha256, "metadata.refCount": {"$gte": 1}},
+        {"$inc": {"metadata.refCount": 1}}, projection={"_id": 1})
+    return found["_id"] if found else None
 
 
-def delete_file(id):
+@timed(db_function_seconds)
+def retain_file(id):
+    """
+    Add a reference to a stored upload for a spot saved with its URL
+    rather than an upload. A file stored before reference counting starts
+    counting from the spots already showing it, which get spotImageFile
+    too. Returns the id as a string, or None if no such upload is stored.
+    """
     try:
         id = convert_to_object_id(id)
-        client[DB_NAME]['fs.files'].delete_one({"_id": id})
-        client[DB_NAME]['fs.chunks'].delete_one({"files_id": id})
+    except InvalidId:
+        return None
+    files = get_db()['fs.files']
+    upload = {"_id": id, "metadata.variantOf": {"$exists": False}}
+    if files.find_one_and_update(
+            dict(upload, **{"metadata.refCount": {"$gte": 1}}),
+            {"$inc": {"metadata.refCount": 1}}, projection={"_id": 1}):
+        return str(id)
+    file = files.find_one(upload, {"metadata": 1})
+    if file is None or "refCount" in (file.get("metadata") or {}):
+        # missing, or its last reference is being released
+        return None
+    owners = get_db()['spots'].update_many(
+        {"spotImage": {"$regex": f"/file/{id}$"}},
+        {"$set": {"spotImageFile": str(id)},
+         "$inc": {"spotVersion": 1, "metaVersion": 1}})
+    if owners.modified_count:
+        bump_spots_version()
+    metadata = dict(file.get("metadata") or {},
+                    refCount=owners.matched_count + 1)
+    files.update_one({"_id": id, "metadata.refCount": {"$exists": False}},
+                     {"$set": {"metadata": metadata}})
+    return str(id)
+
+
+@timed(db_function_seconds)
+def release_file(id, session=None):
+    """
+    Drop a reference to a stored upload, deleting it with its variants and
+    chunks once nothing references it.
+    Returns counts of deleted files and chunks.
+    """
+    try:
+        id = convert_to_object_id(id)
+    except InvalidId:
+        return 0, 0
+    released = get_db()['fs.files'].find_one_and_update(
+        {"_id": id, "metadata.refCount": {"$gte": 1}},
+        {"$inc": {"metadata.refCount": -1}},
+        projection={"metadata.refCount": 1},
+        return_document=pm.ReturnDocument.AFTER, session=session)
+    if released is None or released["metadata"]["refCount"] > 0:
+        return 0, 0
+    return delete_file(id, session, only_if=UNREFERENCED) or (0, 0)
+
+
+@timed(db_function_seconds)
+def delete_file(id, session=None, only_if=None):
+    """
+    Delete a GridFS file, its image variants and all of their chunks.
+    With `only_if`, only if the file document also matches that filter,
+    e.g. UNREFERENCED keeps an upload acquired again in the meantime.
+    Returns counts of deleted files and chunks.
+    """
+    try:
+        id = convert_to_object_id(id)
+        filter = dict(only_if or {}, _id=id)
+        files = get_db()['fs.files'].delete_one(filter, session=session)
+        if not files.deleted_count:
+            return 0, 0
+        variants = [variant["_id"] for variant in get_db()['fs.files'].find(
+            {"metadata.variantOf": id}, {"_id": 1}, session=session)]
+        if variants:
+            get_db()['fs.files'].delete_many(
+                {"_id": {"$in": variants}}, session=session)
+        chunks = get_db()['fs.chunks'].delete_many(
+            {"files_id": {"$in": [id] + variants}}, session=session)
+        return 1 + len(variants), chunks.deleted_count
     except (pm.errors.CursorNotFound, InvalidId):
-        LOG.error("Error occurred with deleting file {id}")
+        LOG.error(f"Error occurred with deleting file {id}")
         return None
 
 
+@timed(db_function_seconds)
 def fetch_file(id):
-    # open_download_stream_by_name
+    """
+    Open a stored file for streaming. The returned GridOut carries the
+    filename, length and upload date, and reads one chunk at a time.
+    """
     try:
         id = convert_to_object_id(id)
-        gfs = gridfs.GridFSBucket(client[DB_NAME])
-        grid_out = gfs.open_download_stream(id)
-        image = grid_out.read()
-        filename = client[DB_NAME]['fs.files'].find_one({"_id": id})
-        return (BytesIO(image), filename["filename"])
+        try:
+            gfs = gridfs.GridFSBucket(get_replica_db())
+            return gfs.open_download_stream(id)
+        except gridfs.errors.NoFile:
+            if not MONGO_REPLICA_READS:
+                raise
+            # just uploaded, not replicated yet
+            gfs = gridfs.GridFSBucket(get_db())
+            return gfs.open_download_stream(id)
     except (pm.errors.CursorNotFound, InvalidId, gridfs.errors.NoFile):
         LOG.error("trouble fetching file")
         return
+
+
+@timed(db_function_seconds)
+def fetch_file_variant(id, variant):
+    """
+    Open the `variant` of a stored image for streaming, None if the file
+    has no such variant
+    """
+    try:
+        filter = {"metadata.variantOf": convert_to_object_id(id),
+                  "metadata.variant": variant}
+    except InvalidId:
+        return None
+    # on a lagging secondary the original would be served, and cached as
+    # immutable, under the variant's URL
+    found = get_db()['fs.files'].find_one(filter, {"_id": 1})
+    if found is None:
+        return None
+    return fetch_file(found["_id"])
@@ -0,0 +1,186 @@
+"""
+This buffers crowd-sourced factor submissions in memory and writes them
+to MongoDB in batches, one bulk write per window instead of one write per
+submission.
+"""
+import atexit
+import logging
+import os
+import threading
+import time
+import uuid
+
+from db.models import SPOT_FACTORS
+
+LOG = logging.getLogger(__name__)
+
+# seconds between flushes, 0 writes every submission straight through
+FACTOR_BUFFER_WINDOW = float(os.environ.get("FACTOR_BUFFER_WINDOW", 0))
+
+
+class FactorBuffer:
+    """
+    Pending factor submissions merged per spot and per day.
+    `write` gets a list of (spot_id, day, count, sums) and a batch id and
+    must persist them, it is called from a background thread every
+    `window` seconds and once more at shutdown. It returns the updates
+    that were not applied, which are merged back into the buffer, and
+    raises when it can't tell what was applied: the same batch is then
+    written again under the same id, so `write` must skip updates already
+    applied with that id.
+    """
+
+    def __init__(self, write, window=FACTOR_BUFFER_WINDOW):
+        self.write = write
+        self.window = window
+        self.submissions = 0
+        self.flushes = 0
+        self.flushed_submissions = 0
+        self.last_flush_latency = 0
+        self.max_flush_latency = 0
+        self._pending = {}
+        self._inflight = {}
+        # (batch id, batch) whose write has to be retried
+        self._retry = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        # tells this process's buffer from other workers' in generation()
+        self._token = None
+
+    @property
+    def enabled(self):
+        return self.window > 0
+
+    def add(self, spot_id, day, sums, count=1):
+        self._merge(spot_id, day, sums, count)
+        self._ensure_started()
+
+    def _merge(self, spot_id, day, sums, count, new=True):
+        with self._lock:
+            if new:
+                self.submissions += count
+            entry = self._pending.get((spot_id, day))
+            if entry is None:
+                entry = self._pending[(spot_id, day)] = [
+                    0, dict.fromkeys(SPOT_FACTORS, 0)]
+            entry[0] += count
+            for f_field in SPOT_FACTORS:
+                entry[1][f_field] += sums[f_field]
+
+    def pending(self, spot_id, day):
+        """
+        Return (count, sums) not yet written for a spot, or None
+        """
+        key = (spot_id, day)
+        with self._lock:
+            batches = [self._pending, self._inflight]
+            if self._retry is not None:
+                batches.append(self._retry[1])
+            entries = [batch[key] for batch in batches if key in batch]
+        if not entries:
+            return None
+        count = sum(entry[0] for entry in entries)
+        sums = {f_field: sum(entry[1][f_field] for entry in entries)
+                for f_field in SPOT_FACTORS}
+        return count, sums
+
+    def generation(self):
+        """
+        None when nothing is waiting to be written, otherwise a string
+        that changes with every submission added to this buffer
+        """
+        with self._lock:
+            if not (self._pending or self._inflight or self._retry):
+                return None
+            return f"{self._token}.{self.submissions}"
+
+    def flush(self):
+        """
+        Write the batch left to retry, if any, then everything pending.
+        Returns the number of spot updates written.
+        """
+        with self._flush_lock:
+            written = 0
+            if self._retry is not None:
+                batch_id, batch = self._retry
+                if not self._write(batch_id, batch):
+                    return 0
+                written += len(batch)
+            with self._lock:
+                batch, self._pending = self._pending, {}
+                # still visible to pending() until the write lands
+                self._inflight = batch
+            if batch and self._write(uuid.uuid4().hex, batch):
+                written += len(batch)
+            return written
+
+    def _write(self, batch_id, batch):
+        updates = [(spot_id, day, count, sums)
+                   for (spot_id, day), (count, sums) in batch.items()]
+        start = time.perf_counter()
+        try:
+            failed = self.write(updates, batch_id) or []
+        except Exception as error:
+            LOG.error(f"Factor buffer flush failed, retrying batch "
+                      f"{batch_id}: {error}")
+            with self._lock:
+                self._retry = (batch_id, batch)
+                self._inflight = {}
+            return False
+        with self._lock:
+            self._retry = None
+            self._inflight = {}
+        for spot_id, day, count, sums in failed:
+            self._merge(spot_id, day, sums, count, new=False)
+        latency = time.perf_counter() - start
+        self.flushes += 1
+        self.flushed_submissions += sum(update[2] for update in updates) \
+            - sum(update[2] for update in failed)
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._pid == os.getpid():
+            self._thread.join(self.window + 5)
+        self.flush()
+
+    def stats(self):
+        with self._lock:
+            batches = [self._pending]
+            if self._retry is not None:
+                batches.append(self._retry[1])
+            depth = sum(len(batch) for batch in batches)
+            submissions = sum(entry[0] for batch in batches
+                              for entry in batch.values())
+        return {
+            "window": self.window,
+            "depth": depth,
+            "pending_submissions": submissions,
+            "flushes": self.flushes,
+            "flushed_submissions": self.flushed_submissions,
+            "last_flush_ms": round(self.last_flush_latency * 1000, 3),
+            "max_flush_ms": round(self.max_flush_latency * 1000, 3)
+        }
+
+    def _ensure_started(self):
+        # started lazily so each forked worker runs its own flusher
+        if self._pid == os.getpid() and not self._stop.is_set():
+            return
+        with self._lock:
+            if self._pid == os.getpid() and not self._stop.is_set():
+                return
+            self._pid = os.getpid()
+            self._token = uuid.uuid4().hex[:8]
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stop.wait(self.window):
+            self.flush()
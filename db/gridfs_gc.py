@@ -0,0 +1,225 @@
+"""
+This reclaims GridFS space that no spot can reach any more:
+- chunks whose file document is gone
+- uploads no spot references through spotImageFile or its spotImage URL,
+  with their image variants, and variants whose upload is gone
+Files and chunks younger than --min-age are left alone, they may belong
+to an upload whose spot isn't saved yet. Candidates are checked against
+the spots again right before each batch is deleted, and a file is only
+deleted if its metadata.refCount hasn't changed since the scan.
+Run it by hand or from a scheduler:
+    python -m db.gridfs_gc --dry-run   report what would be deleted
+    python -m db.gridfs_gc             delete it
+"""
+import argparse
+import logging
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+from bson import ObjectId
+
+LOG = logging.getLogger(__name__)
+
+BATCH_SIZE = 100
+# files and chunk groups deleted per second
+RATE = 200
+MIN_AGE = timedelta(hours=1)
+
+
+def cutoff_id(min_age):
+    """
+    ObjectIds below this one were generated more than `min_age` ago
+    """
+    return ObjectId.from_datetime(datetime.now(timezone.utc) - min_age)
+
+
+def is_older(id, cutoff):
+    return isinstance(id, ObjectId) and id < cutoff
+
+
+def image_file_ids(spot):
+    """
+    Ids (as strings) of the GridFS files a spot document points to.
+    Any /file/ URL counts, whichever deployment (URLNAME) stored it.
+    """
+    ids = set()
+    if spot.get("spotImageFile"):
+        ids.add(str(spot["spotImageFile"]))
+    image = spot.get("spotImage")
+    if isinstance(image, str) and "/file/" in image:
+        ids.add(image.rsplit("/", 1)[-1])
+    return ids
+
+
+def referenced_files(db, among=None):
+    """
+    Ids (as strings) of the GridFS files referenced by any spot,
+    only looking for those in `among` if given
+    """
+    filter = {}
+    if among is not None:
+        among = [str(id) for id in among]
+        filter = {"$or": [
+            {"spotImageFile": {"$in": among}},
+            {"spotImage": {"$regex": "/file/(%s)$" % "|".join(
+                re.escape(id) for id in among)}}]}
+    referenced = set()
+    for spot in db["spots"].find(filter, {"spotImage": 1,
+                                          "spotImageFile": 1}):
+        referenced |= image_file_ids(spot)
+    return referenced
+
+
+def find_orphan_chunks(db, min_age=MIN_AGE):
+    """
+    Return [(files_id, chunk count, bytes)] of chunks without a file
+    """
+    pipeline = [
+        {"$match": {"files_id": {"$lt": cutoff_id(min_age)}}},
+        {"$group": {"_id": "$files_id", "chunks": {"$sum": 1},
+                    "bytes": {"$sum": {"$binarySize": "$data"}}}},
+        {"$lookup": {"from": "fs.files", "localField": "_id",
+                     "foreignField": "_id", "as": "file"}},
+        {"$match": {"file": {"$size": 0}}},
+    ]
+    return [(group["_id"], group["chunks"], group["bytes"])
+            for group in db["fs.chunks"].aggregate(pipeline,
+                                                   allowDiskUse=True)]
+
+
+def find_unreferenced_files(db, min_age=MIN_AGE):
+    """
+    Return [(file id, bytes, refCount)] of uploads no spot references and
+    of image variants whose upload is unreferenced or gone, refCount None
+    for files without one
+    """
+    referenced = referenced_files(db)
+    uploads, variants = {}, []
+    for file in db["fs.files"].find(
+            {}, {"length": 1, "metadata.variantOf": 1,
+                 "metadata.refCount": 1}):
+        metadata = file.get("metadata") or {}
+        entry = (file["length"], metadata.get("refCount"))
+        if metadata.get("variantOf") is None:
+            uploads[file["_id"]] = entry
+        else:
+            variants.append((file["_id"], metadata["variantOf"], entry))
+    cutoff = cutoff_id(min_age)
+    unreferenced = {id: entry for id, entry in uploads.items()
+                    if is_older(id, cutoff) and str(id) not in referenced}
+    kept = uploads.keys() - unreferenced.keys()
+    return [(id,) + entry for id, entry in unreferenced.items()] + [
+        (id,) + entry for id, variant_of, entry in variants
+        if variant_of not in kept and is_older(id, cutoff)]
+
+
+def unchanged(id, ref_count):
+    """
+    Filter matching file `id` only while its refCount is `ref_count`
+    """
+    if ref_count is None:
+        return {"_id": id, "metadata.refCount": {"$exists": False}}
+    return {"_id": id, "metadata.refCount": ref_count}
+
+
+def batches(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def throttle(started, count, rate):
+    """
+    Sleep long enough for `count` deletions since `started` to stay
+    under `rate` per second
+    """
+    if rate:
+        delay = count / rate - (time.monotonic() - started)
+        if delay > 0:
+            time.sleep(delay)
+
+
+def collect(db, dry_run=False, batch_size=BATCH_SIZE, rate=RATE,
+            min_age=MIN_AGE):
+    """
+    Delete orphan chunks and unreferenced files in batches of
+    `batch_size`, at most `rate` per second.
+    Returns counts and bytes of what was (or, with `dry_run`, would be)
+    reclaimed.
+    """
+    report = {"orphan_chunks": 0, "orphan_chunk_bytes": 0,
+              "files": 0, "file_chunks": 0, "file_bytes": 0}
+
+    orphans = find_orphan_chunks(db, min_age)
+    LOG.info("Found chunks of %d missing files", len(orphans))
+    started = time.monotonic()
+    for count, batch in enumerate(batches(orphans, batch_size), 1):
+        ids = [files_id for files_id, _, _ in batch]
+        if dry_run:
+            report["orphan_chunks"] += sum(chunks for _, chunks, _ in batch)
+        else:
+            # the file of a chunk never comes back, nothing to re-check
+            deleted = db["fs.chunks"].delete_many({"files_id": {"$in": ids}})
+            report["orphan_chunks"] += deleted.deleted_count
+            throttle(started, count * batch_size, rate)
+        report["orphan_chunk_bytes"] += sum(size for _, _, size in batch)
+
+    unreferenced = find_unreferenced_files(db, min_age)
+    LOG.info("Found %d unreferenced files", len(unreferenced))
+    started = time.monotonic()
+    for count, batch in enumerate(batches(unreferenced, batch_size), 1):
+        # a spot may have started using one of them since the scan
+        referenced = referenced_files(db, [id for id, _, _ in batch])
+        batch = [file for file in batch if str(file[0]) not in referenced]
+        if not batch:
+            continue
+        ids = [id for id, _, _ in batch]
+        if dry_run:
+            report["files"] += len(ids)
+            report["file_chunks"] += db["fs.chunks"].count_documents(
+                {"files_id": {"$in": ids}})
+        else:
+            files = db["fs.files"].delete_many({"$or": [
+                unchanged(id, ref_count) for id, _, ref_count in batch]})
+            # files whose refCount changed were acquired, keep their chunks
+            kept = {file["_id"] for file in db["fs.files"].find(
+                {"_id": {"$in": ids}}, {"_id": 1})}
+            batch = [file for file in batch if file[0] not in kept]
+            chunks = db["fs.chunks"].delete_many(
+                {"files_id": {"$in": [id for id, _, _ in batch]}})
+            report["files"] += files.deleted_count
+            report["file_chunks"] += chunks.deleted_count
+            throttle(started, count * batch_size, rate)
+        report["file_bytes"] += sum(length for _, length, _ in batch)
+
+    report["bytes"] = report["orphan_chunk_bytes"] + report["file_bytes"]
+    return report
+
+
+def main():
+    import db.db_connect as dbc
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--dry-run", action="store_true",
+                        help="only report what would be deleted")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--rate", type=float, default=RATE,
+                        help="deletions per second, 0 for no limit")
+    parser.add_argument("--min-age", type=float,
+                        default=MIN_AGE.total_seconds() / 3600,
+                        help="hours before an upload can be collected")
+    args = parser.parse_args()
+
+    report = collect(dbc.get_db(), dry_run=args.dry_run,
+                     batch_size=args.batch_size, rate=args.rate,
+                     min_age=timedelta(hours=args.min_age))
+    verb = "would reclaim" if args.dry_run else "reclaimed"
+    print(f"orphan chunks  {report['orphan_chunks']:8} "
+          f"({report['orphan_chunk_bytes']} bytes)")
+    print(f"files          {report['files']:8} "
+          f"({report['file_chunks']} chunks, {report['file_bytes']} bytes)")
+    print(f"{verb} {report['bytes']} bytes")
+
+
+if __name__ == "__main__":
+    main()
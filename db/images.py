@@ -0,0 +1,53 @@
+"""
+This resizes uploaded spot images into the variants clients download
+instead of the original: a thumbnail, a list card and a full-screen size,
+all as WebP. Pillow is optional, without it only the original is stored.
+"""
+import io
+import os
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+# variant name -> longest side in pixels, never upscaled
+IMAGE_VARIANTS = {"thumb": 160, "card": 480, "full": 1600}
+IMAGE_QUALITY = int(os.environ.get("IMAGE_QUALITY", 80))
+VARIANT_FORMAT = "WEBP"
+VARIANT_CONTENT_TYPE = "image/webp"
+VARIANT_EXTENSION = "webp"
+
+
+def available():
+    return Image is not None
+
+
+def make_variants(data, variants=IMAGE_VARIANTS, quality=IMAGE_QUALITY):
+    """
+    Return {variant name: (WebP bytes, width, height)} for image `data`,
+    bytes or a seekable file. Raises ValueError if `data` isn't an image
+    Pillow can read.
+    """
+    if isinstance(data, bytes):
+        data = io.BytesIO(data)
+    try:
+        image = Image.open(data)
+        # let the JPEG decoder scale down while decoding
+        largest = max(variants.values())
+        image.draft("RGB", (largest, largest))
+        image = ImageOps.exif_transpose(image)
+        has_alpha = image.mode in ("RGBA", "LA", "PA") or (
+            image.mode == "P" and "transparency" in image.info)
+        image = image.convert("RGBA" if has_alpha else "RGB")
+    except (OSError, Image.DecompressionBombError) as error:
+        raise ValueError(f"Not a readable image: {error}")
+
+    resized = {}
+    # largest first, each variant is resized from the previous one
+    for name, size in sorted(variants.items(), key=lambda item: -item[1]):
+        image.thumbnail((size, size), Image.LANCZOS)
+        output = io.BytesIO()
+        image.save(output, VARIANT_FORMAT, quality=quality, method=4)
+        resized[name] = (output.getvalue(), image.width, image.height)
+    return resized
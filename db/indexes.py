@@ -0,0 +1,150 @@
+"""
+This declares the MongoDB indexes the API relies on and builds them.
+Building is idempotent, so it is safe to run at every startup
+(ENSURE_INDEXES=1) or by hand:
+    python -m db.indexes            build missing indexes
+    python -m db.indexes --report   list missing and unused indexes
+"""
+import argparse
+import logging
+import threading
+
+import pymongo as pm
+
+LOG = logging.getLogger(__name__)
+
+# collection -> [(index name, keys, options)]
+INDEXES = {
+    "spots": [
+        # makes a duplicate spotName a DuplicateKeyError in create_spot
+        ("spotName_unique", [("spotName", pm.ASCENDING)],
+         {"unique": True,
+          "partialFilterExpression": {"spotName": {"$type": "string"}}}),
+        # the {"spotName": {"$exists": True}} filter of get_all_spots
+        ("spotName_exists", [("spotName", pm.ASCENDING),
+                             ("_id", pm.ASCENDING)],
+         {"partialFilterExpression": {"spotName": {"$exists": True}}}),
+    ],
+    "reviews": [
+        # reviews of a spot, paginated by _id
+        ("spotID_id", [("spotID", pm.ASCENDING), ("_id", pm.ASCENDING)], {}),
+        ("userID", [("userID", pm.ASCENDING)], {}),
+    ],
+    "fs.files": [
+        # the names GridFS itself gives these indexes, so both agree
+        ("filename_1_uploadDate_1", [("filename", pm.ASCENDING),
+                                     ("uploadDate", pm.ASCENDING)], {}),
+        # image variants of an upload, see fetch_file_variant
+        ("variantOf_variant", [("metadata.variantOf", pm.ASCENDING),
+                               ("metadata.variant", pm.ASCENDING)],
+         {"partialFilterExpression": {
+             "metadata.variantOf": {"$exists": True}}}),
+        # one referenced upload per content hash, see acquire_file
+        ("sha256_unique", [("metadata.sha256", pm.ASCENDING)],
+         {"unique": True,
+          "partialFilterExpression": {"metadata.refCount": {"$gt": 0}}}),
+    ],
+    "fs.chunks": [
+        ("files_id_1_n_1", [("files_id", pm.ASCENDING),
+                            ("n", pm.ASCENDING)],
+         {"unique": True}),
+    ],
+}
+
+
+def missing_indexes(db):
+    """
+    Return [(collection, index name)] declared but not present, under its
+    name or as the same index under another name
+    """
+    missing = []
+    for collection, indexes in INDEXES.items():
+        existing = db[collection].index_information().items()
+        missing += [(collection, name) for name, keys, options in indexes
+                    if not any(name == existing_name
+                               or same_index(keys, options, info)
+                               for existing_name, info in existing)]
+    return missing
+
+
+def same_index(keys, options, info):
+    """
+    Whether `info` (from index_information) is the index declared with
+    `keys` and `options`
+    """
+    def normalize(keys):
+        return [(field, direction if isinstance(direction, str)
+                 else int(direction)) for field, direction in keys]
+
+    return (normalize(keys) == normalize(info["key"])
+            and options.get("unique", False) == info.get("unique", False)
+            and options.get("partialFilterExpression")
+            == info.get("partialFilterExpression"))
+
+
+def unused_indexes(db):
+    """
+    Return [(collection, index name, since)] not used since `since`,
+    according to $indexStats (counters restart with the server)
+    """
+    unused = []
+    for collection in INDEXES:
+        for stats in db[collection].aggregate([{"$indexStats": {}}]):
+            if stats["name"] != "_id_" and stats["accesses"]["ops"] == 0:
+                unused.append((collection, stats["name"],
+                               stats["accesses"]["since"]))
+    return unused
+
+
+def ensure_indexes(db):
+    """
+    Build every declared index that is missing.
+    Returns [(collection, index name, error)] for indexes that failed,
+    e.g. a unique index over existing duplicates.
+    """
+    failed = []
+    for collection, name in missing_indexes(db):
+        keys, options = next((keys, options)
+                             for index_name, keys, options
+                             in INDEXES[collection] if index_name == name)
+        LOG.info(f"Building index {name} on {collection}")
+        try:
+            db[collection].create_index(keys, name=name, background=True,
+                                        **options)
+        except pm.errors.OperationFailure as error:
+            LOG.error(f"Unable to build index {name} on {collection}: "
+                      f"{error}")
+            failed.append((collection, name, str(error)))
+    return failed
+
+
+def ensure_indexes_in_background(db):
+    thread = threading.Thread(target=ensure_indexes, args=(db,),
+                              daemon=True)
+    thread.start()
+    return thread
+
+
+def main():
+    import db.db_connect as dbc
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[1])
+    parser.add_argument("--report", action="store_true",
+                        help="only list missing and unused indexes")
+    args = parser.parse_args()
+
+    db = dbc.get_db()
+    if args.report:
+        for collection, name in missing_indexes(db):
+            print(f"missing  {collection}.{name}")
+        for collection, name, since in unused_indexes(db):
+            print(f"unused   {collection}.{name} (since {since})")
+        return
+    for collection, name, error in ensure_indexes(db):
+        print(f"failed   {collection}.{name}: {error}")
+    for collection, name in missing_indexes(db):
+        print(f"missing  {collection}.{name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+This broadcasts "spot X changed" events to every worker so that each can
+drop what it cached about the spot. Writes in db/data.py publish events,
+caches and feeds subscribe to them.
+
+INVALIDATION_BACKEND selects how events reach the other workers:
+    local           only this process sees them (one worker, tests)
+    changestream    every worker watches the spots collection through a
+                    MongoDB change stream (needs a replica set, e.g. Atlas)
+Review writes bump the version of their spot, so they show up in the
+spots change stream too.
+"""
+import logging
+import os
+import threading
+
+import pymongo as pm
+
+from db.models import FACTOR_FIELDS
+
+LOG = logging.getLogger(__name__)
+
+INVALIDATION_BACKEND = os.environ.get("INVALIDATION_BACKEND", "local")
+# seconds to wait before reopening a change stream that failed
+RETRY_DELAY = 1
+# "The $changeStream stage is only supported on replica sets"
+NOT_REPLICA_SET = 40573
+# written along with the other fields, never what a subscriber caches
+BOOKKEEPING_FIELDS = {"spotVersion", "factorBatches"}
+LIVE_FIELDS = set(FACTOR_FIELDS) - BOOKKEEPING_FIELDS
+
+
+def spot_event(spot_id, meta=True, factors=True, reviews=False):
+    """
+    What changed about a spot: its metadata, its live factors and/or its
+    reviews
+    """
+    return {"spotID": str(spot_id), "meta": meta, "factors": factors,
+            "reviews": reviews}
+
+
+class LocalBus:
+    """
+    Delivers published events to the subscribers of this process
+    """
+    backend = "local"
+
+    def __init__(self):
+        self.published = 0
+        self.received = 0
+        self._subscribers = []
+        self._lock = threading.Lock()
+
+    def subscribe(self, callback):
+        """
+        Call `callback(event)` for every event, returns `callback`
+        """
+        with self._lock:
+            self._subscribers = self._subscribers + [callback]
+        return callback
+
+    def unsubscribe(self, callback):
+        with self._lock:
+            self._subscribers = [subscriber for subscriber
+                                 in self._subscribers
+                                 if subscriber is not callback]
+
+    def publish(self, event):
+        self.published += 1
+        self._dispatch(event)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def stats(self):
+        return {"backend": self.backend, "published": self.published,
+                "received": self.received,
+                "subscribers": len(self._subscribers)}
+
+    def _dispatch(self, event):
+        for callback in self._subscribers:
+            try:
+                callback(event)
+            except Exception as error:
+                LOG.error(f"Invalidation subscriber failed: {error}")
+
+
+class ChangeStreamBus(LocalBus):
+    """
+    Publishing delivers to this process right away, so a worker reads its
+    own writes, and every worker gets the change from the change stream
+    of `get_collection()` a moment later. Subscribers must therefore
+    tolerate seeing an event twice.
+    """
+    backend = "changestream"
+
+    def __init__(self, get_collection):
+        super().__init__()
+        self.get_collection = get_collection
+        self.resume_token = None
+        self.errors = 0
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        # once per process, forked workers need their own watcher
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def stats(self):
+        stats = super().stats()
+        stats["errors"] = self.errors
+        stats["watching"] = bool(self._thread and self._thread.is_alive())
+        return stats
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self._watch()
+            except pm.errors.OperationFailure as error:
+                if error.code == NOT_REPLICA_SET:
+                    LOG.error("Change streams need a replica set, "
+                              "other workers won't see invalidations")
+                    return
+                self._failed(error)
+            except pm.errors.PyMongoError as error:
+                self._failed(error)
+
+    def _watch(self):
+        collection = self.get_collection()
+        with collection.watch(resume_after=self.resume_token) as stream:
+            while not self._stop.is_set():
+                change = stream.try_next()
+                if change is None:
+                    continue
+                self.resume_token = stream.resume_token
+                event = to_spot_event(change)
+                if event is not None:
+                    self.received += 1
+                    self._dispatch(event)
+
+    def _failed(self, error):
+        self.errors += 1
+        LOG.error(f"Change stream failed, reopening: {error}")
+        self._stop.wait(RETRY_DELAY)
+
+
+def to_spot_event(change):
+    """
+    Turn a change stream document of the spots collection into an event,
+    None if nothing a subscriber cares about changed
+    """
+    operation = change["operationType"]
+    if operation not in ("insert", "update", "replace", "delete"):
+        return None
+    spot_id = change["documentKey"]["_id"]
+    if operation != "update":
+        return spot_event(spot_id)
+    description = change.get("updateDescription", {})
+    fields = {path.split(".")[0] for path
+              in list(description.get("updatedFields", {}))
+              + description.get("removedFields", [])}
+    fields -= BOOKKEEPING_FIELDS
+    if not fields:
+        # a review write bumped only the version of its spot
+        return spot_event(spot_id, meta=False, factors=False, reviews=True)
+    return spot_event(spot_id, meta=bool(fields - LIVE_FIELDS),
+                      factors=bool(fields & LIVE_FIELDS))
+
+
+def get_bus(get_collection):
+    """
+    Bus chosen by INVALIDATION_BACKEND, `get_collection` returns the spots
+    collection to watch
+    """
+    if INVALIDATION_BACKEND == "changestream":
+        return ChangeStreamBus(get_collection)
+    return LocalBus()
@@ -1,16 +1,24 @@
 SPOT_FACTORS = ["factorAvailability", "factorNoiseLevel",
                 "factorTemperature", "factorAmbiance"]
 
+FACTOR_FIELDS = SPOT_FACTORS + ["numFactorEntries", "factorDate",
+                                "factorSums", "spotVersion"]
+
 RESET_FACTORS = {"factorAvailability": 0,
                  "factorNoiseLevel": 0,
                  "factorTemperature": 0,
                  "factorAmbiance": 0,
                  "numFactorEntries": 0,
+                 "factorSums": {"factorAvailability": 0,
+                                "factorNoiseLevel": 0,
+                                "factorTemperature": 0,
+                                "factorAmbiance": 0},
                  "factorDate": ""}
 
 FULL_SPOT_DOCUMENT = {
     "spotName": "",
     "spotImage": "",
+    "spotImageFile": "",
     "spotAddress": "",
     "spotCapacity": "",
     "spotCreation": "",
@@ -20,16 +28,21 @@ FULL_SPOT_DOCUMENT = {
     "factorTemperature": 0,
     "factorAmbiance": 0,
     "numFactorEntries": 0,
-    "factorDate": ""
+    "factorSums": {},
+    "factorDate": "",
+    "spotVersion": 0,
+    "metaVersion": 0
 }
 
 LIGHT_SPOT_DOCUMENT = {
     "spotName": "",
     "spotImage": "",
+    "spotImageFile": "",
     "spotAddress": "",
     "spotCapacity": "",
     "spotCreation": "",
     "spotUpdate": "",
+    "metaVersion": 0,
 }
 
 REVIEW_DOCUMENT = {
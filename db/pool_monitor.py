@@ -0,0 +1,97 @@
+"""
+This counts MongoDB connection pool events, to size the pool from
+utilization and the time requests wait to check out a connection.
+"""
+import threading
+import time
+
+from pymongo import monitoring
+
+
+class PoolMonitor(monitoring.ConnectionPoolListener):
+    """
+    Connection pool listener for one MongoClient, `max_pool_size` is the
+    size configured on the client (0 = unbounded)
+    """
+
+    def __init__(self, max_pool_size=0):
+        self.max_pool_size = max_pool_size
+        self.open = 0
+        self.checked_out = 0
+        self.max_checked_out = 0
+        self.checkouts = 0
+        self.checkout_failures = 0
+        self.wait_time = 0
+        self.max_wait_time = 0
+        self.pool_clears = 0
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def connection_check_out_started(self, event):
+        self._local.started = time.perf_counter()
+
+    def connection_checked_out(self, event):
+        wait = self._waited()
+        with self._lock:
+            self.checkouts += 1
+            self.checked_out += 1
+            self.max_checked_out = max(self.max_checked_out,
+                                       self.checked_out)
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+
+    def connection_check_out_failed(self, event):
+        wait = self._waited()
+        with self._lock:
+            self.checkout_failures += 1
+            self.wait_time += wait
+            self.max_wait_time = max(self.max_wait_time, wait)
+
+    def connection_checked_in(self, event):
+        with self._lock:
+            self.checked_out -= 1
+
+    def connection_created(self, event):
+        with self._lock:
+            self.open += 1
+
+    def connection_closed(self, event):
+        with self._lock:
+            self.open -= 1
+
+    def pool_cleared(self, event):
+        self.pool_clears += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def stats(self):
+        attempts = self.checkouts + self.checkout_failures
+        return {
+            "max_pool_size": self.max_pool_size,
+            "open": self.open,
+            "checked_out": self.checked_out,
+            "max_checked_out": self.max_checked_out,
+            "utilization": (round(self.checked_out / self.max_pool_size, 3)
+                            if self.max_pool_size else None),
+            "checkouts": self.checkouts,
+            "checkout_failures": self.checkout_failures,
+            "avg_wait_ms": (round(self.wait_time / attempts * 1000, 3)
+                            if attempts else 0),
+            "max_wait_ms": round(self.max_wait_time * 1000, 3),
+            "pool_clears": self.pool_clears
+        }
+
+    def _waited(self):
+        started = getattr(self._local, "started", None)
+        self._local.started = None
+        return time.perf_counter() - started if started else 0
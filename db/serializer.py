@@ -0,0 +1,47 @@
+"""
+This turns MongoDB documents into JSON-ready python objects in one pass,
+instead of encoding them to a string and decoding them again.
+"""
+from datetime import datetime
+
+import bson.json_util as bsutil
+from bson import ObjectId
+
+SCALARS = {str, int, float, bool, type(None)}
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_datetime(value):
+    """
+    Fast path for the naive UTC datetimes pymongo returns, formatted the
+    way bsutil.default does. Everything else goes through bsutil.
+    """
+    if value.tzinfo is not None or value < EPOCH:
+        return bsutil.default(value)
+    millis = value.microsecond // 1000
+    fraction = f".{millis:03d}" if millis else ""
+    return {"$date": f"{value.isoformat(timespec='seconds')}{fraction}Z"}
+
+
+def to_json(value):
+    """
+    Return `value` with BSON types (ObjectId, datetime, ...) replaced by
+    their extended JSON wire form. The result is the same as
+    json.loads(json.dumps(value, default=bsutil.default)).
+    """
+    kind = type(value)
+    if kind in SCALARS:
+        return value
+    if kind is dict:
+        return {key: item if type(item) in SCALARS else to_json(item)
+                for key, item in value.items()}
+    if kind is ObjectId:
+        return {"$oid": str(value)}
+    if kind is datetime:
+        return encode_datetime(value)
+    if isinstance(value, (list, tuple)):
+        return [item if type(item) in SCALARS else to_json(item)
+                for item in value]
+    if isinstance(value, dict):
+        return to_json(dict(value))
+    return to_json(bsutil.default(value))
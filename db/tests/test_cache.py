@@ -0,0 +1,84 @@
+"""
+This file holds the tests for cache.py.
+"""
+
+from unittest import TestCase
+import time
+
+from db.cache import Cache, MemoryBackend, RedisBackend
+
+
+class FakeRedis:
+    """
+    A stand-in for the redis-py client methods RedisBackend uses
+    """
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value, expires = self.data.get(key, (None, 0))
+        return value if expires > time.time() else None
+
+    def set(self, key, value, ex):
+        self.data[key] = (value.encode(), time.time() + ex)
+
+    def delete(self, *keys):
+        for key in keys:
+            self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        return [key for key in self.data if key.startswith(match[:-1])]
+
+
+class CacheTestCase(TestCase):
+    def test_hits_and_misses(self):
+        cache = Cache("spots", 60)
+        self.assertIsNone(cache.get("a"))
+        cache.set("a", {"spotName": "A"})
+        self.assertEqual(cache.get("a"), {"spotName": "A"})
+        stats = cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"]), (1, 1))
+        self.assertEqual(stats["hit_ratio"], 0.5)
+
+    def test_versions(self):
+        cache = Cache("spots", 60, RedisBackend(FakeRedis()))
+        cache.set("a", {"spotName": "A"}, "1.2")
+        self.assertEqual(cache.get("a", "1.2"), {"spotName": "A"})
+        self.assertEqual(cache.get("a"), {"spotName": "A"})
+        self.assertIsNone(cache.get("a", "1.3"))
+        self.assertEqual(cache.stats()["misses"], 1)
+
+    def test_expiry(self):
+        cache = Cache("spots", 0.01)
+        cache.set("a", {"spotName": "A"})
+        time.sleep(0.02)
+        self.assertIsNone(cache.get("a"))
+
+    def test_bounded_size(self):
+        cache = Cache("spots", 60, MemoryBackend(max_size=2))
+        for key in ("a", "b", "c"):
+            cache.set(key, {"spotName": key})
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.stats()["size"], 2)
+        self.assertEqual(cache.stats()["evictions"], 1)
+
+    def test_invalidate(self):
+        cache = Cache("spots", 60)
+        cache.set("a", {"spotName": "A"})
+        cache.set("all", [{"spotName": "A"}])
+        cache.invalidate("a", "all")
+        self.assertIsNone(cache.get("a"))
+        self.assertIsNone(cache.get("all"))
+
+    def test_shared_backend(self):
+        redis = FakeRedis()
+        worker_1 = Cache("spots", 60, RedisBackend(redis))
+        worker_2 = Cache("spots", 60, RedisBackend(redis))
+        worker_1.set("a", {"spotName": "A"})
+        self.assertEqual(worker_2.get("a"), {"spotName": "A"})
+        worker_2.invalidate("a")
+        self.assertIsNone(worker_1.get("a"))
+        worker_1.set("b", {"spotName": "B"})
+        worker_2.clear()
+        self.assertEqual(redis.data, {})
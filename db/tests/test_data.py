@@ -2,9 +2,13 @@
 This file holds the tests for db.py.
 """
 
-from unittest import TestCase, skip
+from unittest import TestCase, skip, skipUnless
+from concurrent.futures import ThreadPoolExecutor
 import db.data as db
 import db_connect as dbc
+import db.images as images
+import db.invalidation as invalidation
+import indexes
 from io import BytesIO
 from pymongo.results import UpdateResult, DeleteResult
 import bson.json_util as bsutil
@@ -57,6 +61,9 @@ class DBTestCase(TestCase):
                 "userID": "abcde"
         }
         self.spot_id = dbc.create_spot(self.TEST_SPOT_DOC)
+        # fixtures are written through db_connect, bypassing invalidation
+        db.spot_meta_cache.clear()
+        db.spot_factor_cache.clear()
         self.TEST_REVIEW_DOC["spotID"] = self.spot_id
         self.review_id = dbc.create_review(self.spot_id, self.TEST_REVIEW_DOC)
         print(self.spot_id, self.review_id)
@@ -86,12 +93,45 @@ class DBTestCase(TestCase):
         reviews = db.get_review_by_spot(self.spot_id)
         self.assertIsInstance(reviews, list)
     
+    def test_get_review_pages(self):
+        for _ in range(2):
+            db.add_review(self.spot_id, "PAGE", None, 5, "abcde")
+        first_page = db.get_review_by_spot(self.spot_id, limit=2,
+                                           fields=["reviewTitle"])
+        self.assertEqual(len(first_page), 2)
+        self.assertNotIn("reviewText", first_page[0])
+        cursor = db.get_review_cursor(first_page, 2)
+        self.assertIsNotNone(cursor)
+        last_page = db.get_review_by_spot(self.spot_id, limit=2, after=cursor)
+        self.assertEqual(len(last_page), 1)
+        self.assertIsNone(db.get_review_cursor(last_page, 2))
+        newest = db.get_review_by_spot(self.spot_id, limit=1, order="desc")
+        self.assertEqual(newest[0]["reviewTitle"], "PAGE")
+
+    def test_spot_detail_embeds_review_count(self):
+        spot = db.get_spot_detail(self.spot_id)
+        self.assertEqual(spot["reviewCount"], 1)
+        self.assertEqual(len(spot["reviews"]), 1)
+
     def test_add_delete_spot(self):
         testAddSpot = db.add_spot(None, None, None, None, None)
         print(f"{testAddSpot=}")
         self.assertIsInstance(testAddSpot, str)
         testDeleteSpot = db.delete_spot(testAddSpot)
-        self.assertIsInstance(testDeleteSpot, DeleteResult)
+        self.assertEqual(testDeleteSpot["spots"], 1)
+
+    def test_delete_spot_cascade(self):
+        db.add_review(self.spot_id, None, None, None, "abcd")
+        # large enough to be stored in several chunks
+        fileID = dbc.save_file("fakefile", BytesIO(b"a" * 600 * 1024))
+        dbc.update_spot(self.spot_id,
+                        {"spotImage": f"{dbc.URLNAME}/file/{fileID}"})
+        deleted = db.delete_spot(self.spot_id)
+        self.assertEqual(deleted, {"spots": 1, "reviews": 2,
+                                   "files": 1, "chunks": 3})
+        self.assertEqual(db.get_review_by_spot(self.spot_id), db.NOT_FOUND)
+        self.assertEqual(db.get_file(str(fileID)), db.NOT_FOUND)
+        self.assertEqual(db.delete_spot(self.spot_id), db.NOT_FOUND)
     
     def test_update_spot(self):
         testUpdateSpot = db.update_spot(self.spot_id, "TEST UPDATE SPOT", None, None, None, None)
@@ -103,6 +143,156 @@ class DBTestCase(TestCase):
         testGetSpotDetail = db.get_spot_detail(self.spot_id)
         self.assertIsInstance(testGetSpotDetail, dict)
     
+    def test_stale_factors_reset_on_read(self):
+        spot = db.get_spot_detail(self.spot_id)
+        self.assertEqual(spot["factorAvailability"], 0)
+        self.assertEqual(spot["numFactorEntries"], 0)
+        spots = [s for s in db.get_spots() if s["_id"]["$oid"] == self.spot_id]
+        self.assertEqual(spots[0]["factorAvailability"], 0)
+        # reads don't write the reset back
+        stored = dbc.get_db()['spots'].find_one(
+            {"_id": dbc.convert_to_object_id(self.spot_id)})
+        self.assertEqual(stored["factorDate"], "2022-05-09")
+        self.assertEqual(stored["factorAvailability"],
+                         TEST_FACTOR_AVAILABILITY)
+
+    def test_update_spot_factors(self):
+        factors = {"factorAvailability": 5, "factorNoiseLevel": 1,
+                   "factorTemperature": 7, "factorAmbiance": 0}
+        response = db.update_spot_factors(self.spot_id, factors)
+        self.assertEqual(str(response), self.spot_id)
+        spot = db.get_spot_detail(self.spot_id)
+        # the stale 2022-05-09 factors are dropped, values are clamped
+        self.assertEqual(spot["numFactorEntries"], 1)
+        self.assertEqual(spot["factorAvailability"], 5)
+        self.assertEqual(spot["factorTemperature"], 5)
+        self.assertEqual(spot["factorAmbiance"], 0)
+
+    def test_concurrent_factor_updates(self):
+        low = {"factorAvailability": 1, "factorNoiseLevel": 1,
+               "factorTemperature": 1, "factorAmbiance": 1}
+        high = {"factorAvailability": 5, "factorNoiseLevel": 5,
+                "factorTemperature": 5, "factorAmbiance": 5}
+        submissions = [low, high] * 25
+        with ThreadPoolExecutor(max_workers=10) as pool:
+            list(pool.map(lambda factors: db.update_spot_factors(
+                self.spot_id, factors), submissions))
+        spot = db.get_spot_detail(self.spot_id)
+        self.assertEqual(spot["numFactorEntries"], len(submissions))
+        self.assertEqual(spot["factorSums"]["factorAvailability"], 150)
+        self.assertEqual(spot["factorAvailability"], 3)
+
+    def test_update_spot_factors_not_found(self):
+        factors = {"factorAvailability": 1, "factorNoiseLevel": 1,
+                   "factorTemperature": 1, "factorAmbiance": 1}
+        response = db.update_spot_factors("000000000000000000000000", factors)
+        self.assertEqual(response, db.NOT_FOUND)
+
+    def test_buffered_factor_updates(self):
+        factors = {"factorAvailability": 4, "factorNoiseLevel": 4,
+                   "factorTemperature": 4, "factorAmbiance": 4}
+        db.factor_buffer.window = 60
+        try:
+            spots_etag = db.get_spots_etag()
+            db.update_spot_factors(self.spot_id, factors)
+            pending_etag = db.get_spots_etag()
+            self.assertNotEqual(pending_etag, spots_etag)
+            db.update_spot_factors(self.spot_id, factors)
+            self.assertNotEqual(db.get_spots_etag(), pending_etag)
+            # pending submissions are visible before they are written
+            spot = db.get_spot_detail(self.spot_id)
+            self.assertEqual(spot["numFactorEntries"], 2)
+            self.assertEqual(spot["factorAvailability"], 4)
+            pending_etag = db.get_spots_etag()
+            db.factor_buffer.flush()
+            self.assertNotIn(db.get_spots_etag(),
+                             (spots_etag, pending_etag))
+        finally:
+            db.factor_buffer.window = 0
+            db.factor_buffer.stop()
+        spot = dbc.fetch_spot_details(self.spot_id)
+        self.assertEqual(spot["numFactorEntries"], 2)
+
+    def test_factor_batch_written_once(self):
+        sums = {"factorAvailability": 4, "factorNoiseLevel": 4,
+                "factorTemperature": 4, "factorAmbiance": 4}
+        updates = [(self.spot_id, dbc.get_today(), 2, sums)]
+        self.assertEqual(dbc.bulk_update_spot_factors(updates, "batch-1"), [])
+        # a retry after a lost reply
+        dbc.bulk_update_spot_factors(updates, "batch-1")
+        spot = dbc.fetch_spot_details(self.spot_id)
+        self.assertEqual(spot["numFactorEntries"], 2)
+        self.assertNotIn("factorBatches", spot)
+        stale = [(self.spot_id, "2020-01-01", 1, sums)]
+        self.assertEqual(dbc.bulk_update_spot_factors(stale, "batch-2"), [])
+
+    def test_spot_etags_follow_writes(self):
+        spots_etag = db.get_spots_etag()
+        spot_etag = db.get_spot_etag(self.spot_id)
+        meta_version, live_version = db.get_spots_version()
+        db.update_spot_factors(self.spot_id, {
+            "factorAvailability": 1, "factorNoiseLevel": 1,
+            "factorTemperature": 1, "factorAmbiance": 1})
+        self.assertNotEqual(db.get_spots_etag(), spots_etag)
+        self.assertNotEqual(db.get_spot_etag(self.spot_id), spot_etag)
+        # factor writes keep the cached spot metadata valid
+        self.assertEqual(db.get_spots_version(),
+                         (meta_version, live_version + 1))
+        spots_etag = db.get_spots_etag()
+        spot_etag = db.get_spot_etag(self.spot_id)
+        db.add_review(self.spot_id, None, None, None, "abcd")
+        self.assertNotEqual(db.get_spots_etag(), spots_etag)
+        self.assertNotEqual(db.get_spot_etag(self.spot_id), spot_etag)
+        self.assertIsNone(db.get_spot_etag("000000000000000000000000"))
+
+    def test_spot_cache(self):
+        db.get_spot_detail(self.spot_id)
+        hits = db.spot_meta_cache.hits
+        db.get_spot_detail(self.spot_id)
+        self.assertEqual(db.spot_meta_cache.hits, hits + 1)
+        db.update_spot(self.spot_id, "TEST CACHED SPOT", None, None, None,
+                       None)
+        spot = db.get_spot_detail(self.spot_id)
+        self.assertEqual(spot["spotName"], "TEST CACHED SPOT")
+        db.update_spot_factors(self.spot_id, {
+            "factorAvailability": 5, "factorNoiseLevel": 5,
+            "factorTemperature": 5, "factorAmbiance": 5})
+        spots = [s for s in db.get_spots() if s["_id"]["$oid"] == self.spot_id]
+        self.assertEqual(spots[0]["factorAvailability"], 5)
+        self.assertEqual(spots[0]["spotName"], "TEST CACHED SPOT")
+
+    def test_spot_changed_by_another_worker(self):
+        spot = db.get_spot_detail(self.spot_id)
+        dbc.update_spot(self.spot_id, {"spotName": "TEST REMOTE SPOT"})
+        self.assertEqual(db.get_spot_detail(self.spot_id)["spotName"],
+                         spot["spotName"])
+        db.on_spot_changed(invalidation.spot_event(self.spot_id))
+        self.assertEqual(db.get_spot_detail(self.spot_id)["spotName"],
+                         "TEST REMOTE SPOT")
+
+    def test_factor_writes_keep_cached_metadata(self):
+        db.get_spot_detail(self.spot_id, db.get_spot_version(self.spot_id))
+        db.update_spot_factors(self.spot_id, {
+            "factorAvailability": 3, "factorNoiseLevel": 3,
+            "factorTemperature": 3, "factorAmbiance": 3})
+        hits = db.spot_meta_cache.hits
+        spot = db.get_spot_detail(self.spot_id,
+                                  db.get_spot_version(self.spot_id))
+        self.assertEqual(db.spot_meta_cache.hits, hits + 1)
+        self.assertEqual(spot["factorAvailability"], 3)
+
+    def test_versioned_reads_skip_older_entries(self):
+        db.get_spots(db.get_spots_version())
+        db.get_spot_detail(self.spot_id, db.get_spot_version(self.spot_id))
+        # written by another worker, its invalidation not received yet
+        dbc.update_spot(self.spot_id, {"spotName": "TEST REMOTE SPOT"})
+        spot = db.get_spot_detail(self.spot_id,
+                                  db.get_spot_version(self.spot_id))
+        self.assertEqual(spot["spotName"], "TEST REMOTE SPOT")
+        spots = [s for s in db.get_spots(db.get_spots_version())
+                 if s["_id"]["$oid"] == self.spot_id]
+        self.assertEqual(spots[0]["spotName"], "TEST REMOTE SPOT")
+
     def test_get_avergage(self):
         avg = db.get_average(0, 1, 5)
         self.assertEqual(avg, 2.5)
@@ -123,6 +313,110 @@ class DBTestCase(TestCase):
     def test_get_file(self):
         fileID = dbc.save_file("fakefile", BytesIO(b"abcde"))
         file = db.get_file(str(fileID))
-        self.assertIsInstance(file, tuple)
-        self.assertIsInstance(file[0], BytesIO)
-        self.assertIsInstance(file[1], str)
\ No newline at end of file
+        self.assertEqual(file.filename, "fakefile")
+        self.assertEqual(file.length, 5)
+        self.assertEqual(file.read(), b"abcde")
+
+    @skipUnless(images.available(), "needs Pillow")
+    def test_image_variants(self):
+        from PIL import Image
+        photo = BytesIO()
+        Image.new("RGB", (3000, 2000), "red").save(photo, "JPEG")
+        photo.seek(0)
+        photo.filename = "photo.jpg"
+        file_id = db.save_image(photo)
+        card = db.get_file(file_id, "card")
+        self.assertEqual(card.filename, "photo.card.webp")
+        self.assertEqual(card.metadata["width"], 480)
+        self.assertEqual(card.metadata["contentType"], "image/webp")
+        self.assertEqual(db.get_file(file_id).filename, "photo.jpg")
+        self.assertEqual(dbc.delete_file(file_id)[0], 4)
+        self.assertEqual(db.get_file(file_id, "thumb"), db.NOT_FOUND)
+
+    def test_file_without_variants(self):
+        upload = BytesIO(b"not an image")
+        upload.filename = "notes.txt"
+        file_id = db.save_image(upload)
+        self.assertEqual(db.get_file(file_id, "card").filename, "notes.txt")
+        dbc.delete_file(file_id)
+
+    def test_duplicate_uploads_stored_once(self):
+        uploads = []
+        for name in ("first.jpg", "second.jpg"):
+            upload = BytesIO(b"same photo")
+            upload.filename = name
+            uploads.append(upload)
+        first_id = db.save_image(uploads[0])
+        self.assertEqual(db.save_image(uploads[1]), first_id)
+        self.assertEqual(db.get_file(first_id).metadata["refCount"], 2)
+        self.assertEqual(dbc.release_file(first_id), (0, 0))
+        self.assertEqual(db.get_file(first_id).metadata["refCount"], 1)
+        self.assertEqual(dbc.release_file(first_id), (1, 1))
+        self.assertEqual(db.get_file(first_id), db.NOT_FOUND)
+
+    def test_update_spot_releases_old_image(self):
+        upload = BytesIO(b"old photo")
+        upload.filename = "old.jpg"
+        db.update_spot(self.spot_id, "IMAGE SPOT", None, None, None, upload)
+        old_id = db.get_spot_detail(self.spot_id)["spotImageFile"]
+        # the same photo uploaded again keeps a single reference
+        upload = BytesIO(b"old photo")
+        upload.filename = "again.jpg"
+        db.update_spot(self.spot_id, "IMAGE SPOT", None, None, None, upload)
+        self.assertEqual(db.get_file(old_id).metadata["refCount"], 1)
+        # an unchanged image URL keeps the file
+        db.update_spot(self.spot_id, "IMAGE SPOT", None, None,
+                       f"{dbc.URLNAME}/file/{old_id}", None)
+        self.assertEqual(db.get_spot_detail(self.spot_id)["spotImageFile"],
+                         old_id)
+        upload = BytesIO(b"new photo")
+        upload.filename = "new.jpg"
+        db.update_spot(self.spot_id, "IMAGE SPOT", None, None, None, upload)
+        self.assertEqual(db.get_file(old_id), db.NOT_FOUND)
+        new_id = db.get_spot_detail(self.spot_id)["spotImageFile"]
+        self.assertEqual(db.delete_spot(self.spot_id)["files"], 1)
+        self.assertEqual(db.get_file(new_id), db.NOT_FOUND)
+
+    def test_spots_sharing_an_upload(self):
+        upload = BytesIO(b"shared photo")
+        upload.filename = "shared.jpg"
+        db.update_spot(self.spot_id, "SHARING SPOT", None, None, None, upload)
+        shared = db.get_spot_detail(self.spot_id)
+        other_id = db.add_spot("OTHER SHARING SPOT", None, None,
+                               shared["spotImage"], None)
+        self.assertEqual(db.get_spot_detail(other_id)["spotImageFile"],
+                         shared["spotImageFile"])
+        self.assertEqual(
+            db.get_file(shared["spotImageFile"]).metadata["refCount"], 2)
+        self.assertEqual(db.delete_spot(other_id)["files"], 0)
+        self.assertEqual(db.get_file(shared["spotImageFile"]).read(),
+                         b"shared photo")
+        self.assertEqual(db.delete_spot(self.spot_id)["files"], 1)
+        self.assertEqual(db.get_file(shared["spotImageFile"]), db.NOT_FOUND)
+
+    def test_spots_sharing_a_legacy_file(self):
+        file_id = str(dbc.save_file("legacy.jpg", BytesIO(b"legacy")))
+        url = f"{dbc.URLNAME}/file/{file_id}"
+        dbc.update_spot(self.spot_id, {"spotImage": url})
+        other_id = db.add_spot("OTHER LEGACY SPOT", None, None, url, None)
+        # both spots now hold a reference
+        self.assertEqual(db.get_file(file_id).metadata["refCount"], 2)
+        self.assertEqual(db.get_spot_detail(self.spot_id)["spotImageFile"],
+                         file_id)
+        self.assertEqual(db.delete_spot(self.spot_id)["files"], 0)
+        self.assertEqual(db.delete_spot(other_id)["files"], 1)
+        self.assertEqual(db.get_file(file_id), db.NOT_FOUND)
+
+    def test_concurrent_duplicate_upload(self):
+        indexes.ensure_indexes(client[dbc.DB_NAME])
+        first, second = dbc.open_upload("a.jpg"), dbc.open_upload("b.jpg")
+        for stream in (first, second):
+            stream.write(b"uploaded twice at once")
+        metadata = {"sha256": first.sha256.hexdigest(), "refCount": 1}
+        file_id = first.finish(metadata)
+        # the second upload missed acquire_file before the first finished
+        self.assertIsNone(second.finish(metadata))
+        second.close()
+        self.assertEqual(client[dbc.DB_NAME]["fs.chunks"].count_documents(
+            {"files_id": second.file_id}), 0)
+        dbc.release_file(file_id)
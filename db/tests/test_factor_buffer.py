@@ -0,0 +1,93 @@
+"""
+This file holds the tests for factor_buffer.py.
+"""
+
+from unittest import TestCase
+
+from db.factor_buffer import FactorBuffer
+
+TEST_SPOT_ID = "000000000000000000000001"
+TEST_DAY = "2022-05-09"
+TEST_FACTORS = {"factorAvailability": 1, "factorNoiseLevel": 2,
+                "factorTemperature": 3, "factorAmbiance": 4}
+
+
+class FactorBufferTestCase(TestCase):
+    def setUp(self):
+        self.writes = []
+        self.batch_ids = []
+        self.buffer = FactorBuffer(self.write, window=60)
+
+    def write(self, updates, batch_id):
+        self.writes.append(updates)
+        self.batch_ids.append(batch_id)
+
+    def tearDown(self):
+        self.buffer.stop()
+
+    def test_submissions_merge_per_spot(self):
+        self.buffer.add(TEST_SPOT_ID, TEST_DAY, TEST_FACTORS)
+        self.buffer.add(TEST_SPOT_ID, TEST_DAY, TEST_FACTORS)
+        count, sums = self.buffer.pending(TEST_SPOT_ID, TEST_DAY)
+        self.assertEqual(count, 2)
+        self.assertEqual(sums["factorAmbiance"], 8)
+        self.assertEqual(self.buffer.stats()["depth"], 1)
+        self.assertEqual(self.writes, [])
+
+    def test_generation(self):
+        self.assertIsNone(self.buffer.generation())
+        self.buffer.add(TEST_SPOT_ID, TEST_DAY, TEST_FACTORS)
+        generation = self.buffer.generation()
+        self.buffer.add(TEST_SPOT_ID, TEST_DAY, TEST_FACTORS)
+        self.assertNotIn(self.buffer.generation(), (None, generation))
+        self.buffer.flush()
+        self.assertIsNone(self.buffer.generation())
+
+    def test_flush_writes_one_batch(self):
+        self.buffer.add(TEST_SPOT_ID, TEST_DAY, TEST_FACTORS)
+        self.buffer.add("000000000000000000000002", TEST_DAY, TEST_FACTORS)
+        self.assertEqual(self.buffer.flush(), 2)
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(len(self.writes[0]), 2)
+        self.assertIsNone(self.buffer.pending(TEST_SPOT_ID, TEST_DAY))
+        self.assertEqual(self.buffer.stats()["flushed_submissions"], 2)
+
+    def test_stop_flushes(self):
+        self.buffer.add(TEST_SPOT_ID, TEST_DAY, TEST_FACTORS)
+        self.buffer.stop()
+        self.assertEqual(self.writes[0][0][:3], (TEST_SPOT_ID, TEST_DAY, 1))
+
+    def test_failed_flush_keeps_submissions(self):
+        failed_ids = []
+
+        def fail(updates, batch_id):
+            failed_ids.append(batch_id)
+            raise ConnectionError("mongo is down")
+
+        self.buffer.write = fail
+        self.buffer.add(TEST_SPOT_ID, TEST_DAY, TEST_FACTORS)
+        self.assertEqual(self.buffer.flush(), 0)
+        count, _ = self.buffer.pending(TEST_SPOT_ID, TEST_DAY)
+        self.assertEqual(count, 1)
+        self.buffer.add(TEST_SPOT_ID, TEST_DAY, TEST_FACTORS)
+        self.buffer.write = self.write
+        self.assertEqual(self.buffer.flush(), 2)
+        # the failed batch is written again as it was, under the same id,
+        # so updates that did land aren't applied twice
+        self.assertEqual(self.batch_ids[0], failed_ids[0])
+        self.assertEqual(self.writes[0][0][2], 1)
+        self.assertEqual(self.writes[1][0][2], 1)
+        self.assertNotEqual(self.batch_ids[1], failed_ids[0])
+        self.assertIsNone(self.buffer.pending(TEST_SPOT_ID, TEST_DAY))
+
+    def test_only_failed_updates_are_merged_back(self):
+        other_spot_id = "000000000000000000000002"
+        self.buffer.write = lambda updates, batch_id: [
+            update for update in updates if update[0] == other_spot_id]
+        self.buffer.add(TEST_SPOT_ID, TEST_DAY, TEST_FACTORS)
+        self.buffer.add(other_spot_id, TEST_DAY, TEST_FACTORS)
+        self.buffer.flush()
+        self.assertIsNone(self.buffer.pending(TEST_SPOT_ID, TEST_DAY))
+        self.assertEqual(self.buffer.pending(other_spot_id, TEST_DAY)[0], 1)
+        self.assertEqual(self.buffer.stats()["flushed_submissions"], 1)
+        self.buffer.write = self.write
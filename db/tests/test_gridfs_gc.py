@@ -0,0 +1,84 @@
+"""
+This file holds the tests for gridfs_gc.py.
+"""
+
+from datetime import timedelta
+from unittest import TestCase, mock
+from bson import Binary, ObjectId
+from gridfs import GridFS
+import db_connect as dbc
+import gridfs_gc
+
+# collect files however recent they are
+ANY_AGE = timedelta(minutes=-1)
+# collect works on a whole database, give it one holding only the fixtures
+GC_DB_NAME = f"{dbc.DB_NAME}_gc_test"
+
+client = dbc.get_client()
+
+
+class GridFSGCTestCase(TestCase):
+    def setUp(self):
+        client.drop_database(GC_DB_NAME)
+        self.db = client[GC_DB_NAME]
+        self.fs = GridFS(self.db)
+        self.kept_id = self.fs.put(
+            b"kept photo", filename="photo.jpg",
+            metadata={"sha256": "kept", "refCount": 1})
+        self.legacy_id = self.fs.put(b"legacy", filename="legacy.jpg")
+        self.db["spots"].insert_many([
+            {"spotName": "TEST GC SPOT", "spotImageFile": str(self.kept_id),
+             "spotImage": f"{dbc.URLNAME}/file/{self.kept_id}"},
+            {"spotName": "TEST GC LEGACY SPOT", "spotImageFile": None,
+             "spotImage": f"{dbc.URLNAME}/file/{self.legacy_id}"}])
+        # large enough to be stored in several chunks
+        self.unused_id = self.fs.put(b"a" * 600 * 1024,
+                                     filename="unused.jpg")
+        self.orphan_id = ObjectId()
+        self.db["fs.chunks"].insert_many([
+            {"files_id": self.orphan_id, "n": n, "data": Binary(b"b" * 10)}
+            for n in range(2)])
+
+    def tearDown(self):
+        client.drop_database(GC_DB_NAME)
+
+    def chunk_count(self, file_id):
+        return self.db["fs.chunks"].count_documents({"files_id": file_id})
+
+    def test_dry_run(self):
+        report = gridfs_gc.collect(self.db, dry_run=True, min_age=ANY_AGE)
+        self.assertEqual(report["orphan_chunks"], 2)
+        self.assertEqual(report["orphan_chunk_bytes"], 20)
+        self.assertEqual(report["files"], 1)
+        self.assertEqual(report["file_chunks"], 3)
+        self.assertEqual(report["bytes"], 20 + 600 * 1024)
+        self.assertEqual(self.db["fs.chunks"].count_documents(
+            {"files_id": {"$in": [self.orphan_id, self.unused_id]}}), 5)
+
+    def test_collect(self):
+        report = gridfs_gc.collect(self.db, batch_size=1, rate=0,
+                                   min_age=ANY_AGE)
+        self.assertEqual(report["orphan_chunks"], 2)
+        self.assertEqual((report["files"], report["file_chunks"]), (1, 3))
+        self.assertIsNone(self.db["fs.files"].find_one(
+            {"_id": self.unused_id}))
+        self.assertEqual(self.chunk_count(self.unused_id), 0)
+        self.assertEqual(self.chunk_count(self.orphan_id), 0)
+        self.assertEqual(self.fs.get(self.kept_id).read(), b"kept photo")
+        self.assertEqual(self.fs.get(self.legacy_id).read(), b"legacy")
+
+    def test_acquired_since_the_scan(self):
+        scanned = gridfs_gc.find_unreferenced_files(self.db, ANY_AGE)
+        self.assertEqual([file[0] for file in scanned], [self.unused_id])
+        # an upload of the same content took the file over
+        self.db["fs.files"].update_one(
+            {"_id": self.unused_id}, {"$set": {"metadata.refCount": 1}})
+        with mock.patch.object(gridfs_gc, "find_unreferenced_files",
+                               return_value=scanned):
+            report = gridfs_gc.collect(self.db, rate=0, min_age=ANY_AGE)
+        self.assertEqual((report["files"], report["file_chunks"]), (0, 0))
+        self.assertEqual(self.chunk_count(self.unused_id), 3)
+
+    def test_recent_files_are_kept(self):
+        report = gridfs_gc.collect(self.db, dry_run=True)
+        self.assertEqual((report["files"], report["orphan_chunks"]), (0, 0))
@@ -0,0 +1,54 @@
+"""
+This file holds the tests for images.py.
+"""
+
+from unittest import TestCase, skipUnless
+from io import BytesIO
+
+import images
+
+if images.available():
+    from PIL import Image
+
+
+def encode(image, format):
+    output = BytesIO()
+    image.save(output, format)
+    return output.getvalue()
+
+
+@skipUnless(images.available(), "needs Pillow")
+class ImagesTestCase(TestCase):
+    def test_variant_sizes(self):
+        photo = encode(Image.new("RGB", (4000, 3000), "blue"), "JPEG")
+        variants = images.make_variants(photo)
+        sizes = {name: (width, height)
+                 for name, (_, width, height) in variants.items()}
+        self.assertEqual(sizes, {"full": (1600, 1200), "card": (480, 360),
+                                 "thumb": (160, 120)})
+        for content, _, _ in variants.values():
+            self.assertEqual(Image.open(BytesIO(content)).format, "WEBP")
+
+    def test_never_upscaled(self):
+        icon = encode(Image.new("RGB", (100, 50), "blue"), "PNG")
+        for _, width, height in images.make_variants(icon).values():
+            self.assertEqual((width, height), (100, 50))
+
+    def test_keeps_transparency(self):
+        logo = encode(Image.new("RGBA", (600, 600), (0, 0, 0, 0)), "PNG")
+        content, _, _ = images.make_variants(logo)["card"]
+        self.assertEqual(Image.open(BytesIO(content)).mode, "RGBA")
+
+    def test_exif_orientation(self):
+        portrait = Image.new("RGB", (800, 600), "green")
+        exif = portrait.getexif()
+        # rotated 90 degrees by the camera
+        exif[0x0112] = 6
+        output = BytesIO()
+        portrait.save(output, "JPEG", exif=exif)
+        _, width, height = images.make_variants(output.getvalue())["card"]
+        self.assertEqual((width, height), (360, 480))
+
+    def test_not_an_image(self):
+        with self.assertRaises(ValueError):
+            images.make_variants(b"not an image")
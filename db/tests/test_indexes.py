@@ -0,0 +1,51 @@
+"""
+This file holds the tests for indexes.py.
+"""
+
+from unittest import TestCase
+import db.data as db
+import db_connect as dbc
+import indexes
+
+TEST_SPOT_NAME = "TEST_DATA UNIQUE SPOT NAME"
+
+client = dbc.get_client()
+
+
+class IndexesTestCase(TestCase):
+    def setUp(self):
+        self.db = client[dbc.DB_NAME]
+        self.spot_ids = []
+
+    def tearDown(self):
+        for spot_id in self.spot_ids:
+            dbc.delete_spot(spot_id)
+
+    def test_ensure_indexes(self):
+        self.assertEqual(indexes.ensure_indexes(self.db), [])
+        self.assertEqual(indexes.missing_indexes(self.db), [])
+        # building again is a no-op
+        self.assertEqual(indexes.ensure_indexes(self.db), [])
+
+    def test_gridfs_indexes(self):
+        # GridFS builds these itself when it stores the first file
+        dbc.delete_file(dbc.save_file("fakefile", b"abc"))
+        self.assertEqual(indexes.ensure_indexes(self.db), [])
+        self.assertNotIn(("fs.chunks", "files_id_1_n_1"),
+                         indexes.missing_indexes(self.db))
+
+    def test_same_index_under_another_name(self):
+        info = {"key": [("files_id", 1.0), ("n", 1.0)], "unique": True}
+        keys = [("files_id", 1), ("n", 1)]
+        self.assertTrue(indexes.same_index(keys, {"unique": True}, info))
+        self.assertFalse(indexes.same_index(keys, {}, info))
+
+    def test_duplicate_spot_name(self):
+        indexes.ensure_indexes(self.db)
+        spot_id = db.add_spot(TEST_SPOT_NAME, None, None, None, None)
+        self.assertIsInstance(spot_id, str)
+        self.spot_ids.append(spot_id)
+        response = db.add_spot(TEST_SPOT_NAME, None, None, None, None)
+        if isinstance(response, str):
+            self.spot_ids.append(response)
+        self.assertEqual(response, db.DUPLICATE)
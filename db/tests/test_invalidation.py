@@ -0,0 +1,128 @@
+"""
+This file holds the tests for invalidation.py.
+"""
+
+from unittest import TestCase
+import threading
+
+import pymongo as pm
+from bson import ObjectId
+
+import db.invalidation as invalidation
+
+SPOT_ID = ObjectId()
+
+
+class FakeStream:
+    """
+    A change stream replaying `changes`, then waiting for more
+    """
+
+    def __init__(self, changes):
+        self.changes = list(changes)
+        self.resume_token = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def try_next(self):
+        if not self.changes:
+            return None
+        change = self.changes.pop(0)
+        if isinstance(change, Exception):
+            raise change
+        self.resume_token = {"_data": change["_id"]}
+        return change
+
+
+class FakeCollection:
+    def __init__(self, *streams):
+        self.streams = list(streams)
+        self.resumed_after = []
+
+    def watch(self, resume_after=None):
+        self.resumed_after.append(resume_after)
+        return self.streams.pop(0) if self.streams else FakeStream([])
+
+
+def change(number, operation, updated=None):
+    change = {"_id": str(number), "operationType": operation,
+              "documentKey": {"_id": SPOT_ID}}
+    if updated is not None:
+        change["updateDescription"] = {"updatedFields": updated,
+                                       "removedFields": []}
+    return change
+
+
+class InvalidationTestCase(TestCase):
+    def test_local_bus(self):
+        bus = invalidation.LocalBus()
+        events = []
+        callback = bus.subscribe(events.append)
+        bus.publish(invalidation.spot_event(SPOT_ID))
+        bus.unsubscribe(callback)
+        bus.publish(invalidation.spot_event(SPOT_ID))
+        self.assertEqual(events, [{"spotID": str(SPOT_ID), "meta": True,
+                                   "factors": True, "reviews": False}])
+
+    def test_failing_subscriber(self):
+        bus = invalidation.LocalBus()
+        events = []
+        bus.subscribe(lambda event: 1 / 0)
+        bus.subscribe(events.append)
+        bus.publish(invalidation.spot_event(SPOT_ID))
+        self.assertEqual(len(events), 1)
+
+    def test_to_spot_event(self):
+        event = invalidation.to_spot_event(
+            change(1, "update", {"spotName": "A", "spotVersion": 2}))
+        self.assertEqual((event["meta"], event["factors"]), (True, False))
+        event = invalidation.to_spot_event(
+            change(1, "update", {"factorSums.factorAmbiance": 4,
+                                 "numFactorEntries": 1}))
+        self.assertEqual((event["meta"], event["factors"]), (False, True))
+        # a buffered factor flush records its batch id
+        event = invalidation.to_spot_event(
+            change(1, "update", {"factorSums": {"factorAmbiance": 4},
+                                 "numFactorEntries": 2, "spotVersion": 4,
+                                 "factorBatches": ["abc"]}))
+        self.assertEqual((event["meta"], event["factors"]), (False, True))
+        event = invalidation.to_spot_event(
+            change(1, "update", {"spotVersion": 3}))
+        self.assertEqual((event["meta"], event["factors"], event["reviews"]),
+                         (False, False, True))
+        event = invalidation.to_spot_event(change(1, "delete"))
+        self.assertEqual((event["meta"], event["factors"]), (True, True))
+        self.assertIsNone(invalidation.to_spot_event(change(1, "drop")))
+
+    def test_change_stream_bus(self):
+        collection = FakeCollection(
+            FakeStream([change(1, "insert"),
+                        pm.errors.ConnectionFailure("stepdown")]),
+            FakeStream([change(2, "update", {"spotVersion": 1})]))
+        bus = invalidation.ChangeStreamBus(lambda: collection)
+        received = threading.Semaphore(0)
+        events = []
+
+        def on_event(event):
+            events.append(event)
+            received.release()
+
+        bus.subscribe(on_event)
+        original_delay, invalidation.RETRY_DELAY = invalidation.RETRY_DELAY, 0
+        try:
+            bus.start()
+            for _ in range(2):
+                self.assertTrue(received.acquire(timeout=5))
+        finally:
+            bus.stop()
+            invalidation.RETRY_DELAY = original_delay
+        self.assertEqual([event["reviews"] for event in events],
+                         [False, True])
+        # reopened after the failure where it left off
+        self.assertEqual(collection.resumed_after[:2], [None, {"_data": "1"}])
+        self.assertEqual(bus.stats()["errors"], 1)
+        self.assertEqual(bus.stats()["received"], 2)
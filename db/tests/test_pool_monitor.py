@@ -0,0 +1,86 @@
+"""
+This file holds the tests for pool_monitor.py and the client lifecycle in
+db_connect.py.
+"""
+
+from unittest import TestCase
+import threading
+
+import pymongo as pm
+from pymongo import monitoring
+
+import db_connect as dbc
+from pool_monitor import PoolMonitor
+
+ADDRESS = ("localhost", 27017)
+
+
+class PoolMonitorTestCase(TestCase):
+    def setUp(self):
+        self.monitor = PoolMonitor(max_pool_size=4)
+
+    def check_out(self, connection_id):
+        self.monitor.connection_check_out_started(
+            monitoring.ConnectionCheckOutStartedEvent(ADDRESS))
+        self.monitor.connection_checked_out(
+            monitoring.ConnectionCheckedOutEvent(ADDRESS, connection_id, 0))
+
+    def check_in(self, connection_id):
+        self.monitor.connection_checked_in(
+            monitoring.ConnectionCheckedInEvent(ADDRESS, connection_id))
+
+    def test_utilization(self):
+        self.check_out(1)
+        self.check_out(2)
+        self.check_in(1)
+        stats = self.monitor.stats()
+        self.assertEqual(stats["checked_out"], 1)
+        self.assertEqual(stats["max_checked_out"], 2)
+        self.assertEqual(stats["utilization"], 0.25)
+        self.assertEqual(stats["checkouts"], 2)
+
+    def test_failed_checkout(self):
+        self.monitor.connection_check_out_started(
+            monitoring.ConnectionCheckOutStartedEvent(ADDRESS))
+        self.monitor.connection_check_out_failed(
+            monitoring.ConnectionCheckOutFailedEvent(ADDRESS, "timeout", 0))
+        stats = self.monitor.stats()
+        self.assertEqual(stats["checkout_failures"], 1)
+        self.assertGreater(stats["max_wait_ms"], 0)
+
+    def test_concurrent_checkouts(self):
+        threads = [threading.Thread(target=self.check_out, args=(i,))
+                   for i in range(50)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.monitor.stats()["checked_out"], 50)
+
+
+class ClientLifecycleTestCase(TestCase):
+    def test_client_options(self):
+        client = pm.MongoClient(connect=False, **dbc.client_options())
+        self.assertEqual(client.options.pool_options.max_pool_size,
+                         dbc.MONGO_MAX_POOL_SIZE)
+        client.close()
+
+    def test_replica_reads(self):
+        self.assertEqual(dbc.get_db().read_preference,
+                         pm.ReadPreference.PRIMARY)
+        self.assertEqual(dbc.get_replica_db().read_preference.mongos_mode,
+                         dbc.get_db().read_preference.mongos_mode)
+        dbc.MONGO_REPLICA_READS = True
+        try:
+            read_preference = dbc.get_replica_db().read_preference
+        finally:
+            dbc.MONGO_REPLICA_READS = False
+        self.assertEqual(read_preference.mongos_mode, "secondaryPreferred")
+        self.assertEqual(read_preference.max_staleness,
+                         dbc.MONGO_MAX_STALENESS_SECONDS)
+
+    def test_one_client_per_process(self):
+        client = dbc.get_client()
+        self.assertIs(dbc.get_client(), client)
+        dbc.forget_client()
+        self.assertIsNot(dbc.get_client(), client)
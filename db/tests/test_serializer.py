@@ -0,0 +1,38 @@
+"""
+This file holds the tests for serializer.py.
+"""
+
+from unittest import TestCase
+import json
+from datetime import datetime
+
+import bson.json_util as bsutil
+from bson import ObjectId
+
+from db.serializer import to_json
+
+
+class SerializerTestCase(TestCase):
+    def test_matches_round_trip(self):
+        doc = {
+            "_id": ObjectId(),
+            "spotName": "TEST_DATA SPOT NAME",
+            "spotUpdate": datetime(2022, 5, 9, 12, 30),
+            "factorAvailability": 2.5,
+            "numFactorEntries": 2,
+            "spotImage": None,
+            "tags": ["quiet", ObjectId()],
+            "nested": {"fileID": ObjectId(), "ok": True}
+        }
+        expected = json.loads(json.dumps(doc, default=bsutil.default))
+        self.assertEqual(to_json(doc), expected)
+
+    def test_datetime_matches_bsutil(self):
+        for value in (datetime(2022, 5, 9),
+                      datetime(2022, 5, 9, 1, 2, 3, 4567),
+                      datetime(1969, 12, 31, 23, 59)):
+            self.assertEqual(to_json(value), bsutil.default(value))
+
+    def test_object_id_wire_form(self):
+        oid = ObjectId()
+        self.assertEqual(to_json({"_id": oid}), {"_id": {"$oid": str(oid)}})
@@ -0,0 +1,73 @@
+"""
+This file holds the tests for uploads.py.
+"""
+
+import hashlib
+from unittest import TestCase
+import db_connect as dbc
+import uploads
+
+
+class SniffTestCase(TestCase):
+    def test_images(self):
+        self.assertEqual(uploads.sniff_content_type(b"\xff\xd8\xff\xe0"),
+                         "image/jpeg")
+        self.assertEqual(uploads.sniff_content_type(b"\x89PNG\r\n\x1a\n"),
+                         "image/png")
+        self.assertEqual(uploads.sniff_content_type(b"GIF89a"), "image/gif")
+        self.assertEqual(
+            uploads.sniff_content_type(b"RIFF\x00\x00\x00\x00WEBPVP8 "),
+            "image/webp")
+
+    def test_client_type_is_ignored(self):
+        self.assertEqual(uploads.sniff_content_type(b"<html><script>"),
+                         uploads.DEFAULT_CONTENT_TYPE)
+        self.assertEqual(uploads.sniff_content_type(b""),
+                         uploads.DEFAULT_CONTENT_TYPE)
+
+
+class GridFSUploadTestCase(TestCase):
+    def setUp(self):
+        self.db = dbc.get_db()
+
+    def chunk_count(self, file_id):
+        return self.db["fs.chunks"].count_documents({"files_id": file_id})
+
+    def test_finish(self):
+        upload = dbc.open_upload("photo.png")
+        for _ in range(3):
+            upload.write(b"\x89PNG\r\n\x1a\n" + b"a" * 200 * 1024)
+        self.assertEqual(upload.content_type, "image/png")
+        file_id = upload.finish({"contentType": upload.content_type})
+        upload.seek(0)
+        self.assertEqual(hashlib.sha256(upload.read()).digest(),
+                         upload.sha256.digest())
+        upload.close()
+        file = dbc.fetch_file(file_id)
+        self.assertEqual(file.length, 3 * (8 + 200 * 1024))
+        self.assertEqual(file.metadata["contentType"], "image/png")
+        dbc.delete_file(file_id)
+
+    def test_chunks_written_as_they_fill(self):
+        upload = dbc.open_upload("photo.jpg")
+        upload.write(b"a" * 600 * 1024)
+        # two full chunks stored, only the rest held in memory
+        self.assertEqual(self.chunk_count(upload.file_id), 2)
+        self.assertLess(len(upload._buffer), upload.chunk_size)
+        upload.close()
+
+    def test_close_unfinished(self):
+        upload = dbc.open_upload("unused.bin")
+        upload.write(b"a" * 600 * 1024)
+        upload.close()
+        self.assertIsNone(self.db["fs.files"].find_one(
+            {"_id": upload.file_id}))
+        self.assertEqual(self.chunk_count(upload.file_id), 0)
+
+    def test_too_large(self):
+        upload = dbc.open_upload("large.bin", max_size=300 * 1024)
+        upload.write(b"a" * 200 * 1024)
+        with self.assertRaises(uploads.UploadTooLarge):
+            upload.write(b"a" * 200 * 1024)
+        self.assertTrue(upload.closed)
+        self.assertEqual(self.chunk_count(upload.file_id), 0)
@@ -0,0 +1,151 @@
+"""
+This streams an upload into GridFS while the request body is parsed:
+each part is written chunk by chunk, so an upload holds at most one
+GridFS chunk (255 kB) in memory however large it is, and is hashed and
+checked against MAX_UPLOAD_SIZE on the way. The content type is sniffed
+from the first bytes, never taken from the client.
+"""
+import hashlib
+import os
+from datetime import datetime, timezone
+
+from bson import Binary, ObjectId
+from gridfs import DEFAULT_CHUNK_SIZE, GridFSBucket
+from pymongo.errors import DuplicateKeyError
+
+MAX_UPLOAD_SIZE = int(os.environ.get("MAX_UPLOAD_SIZE", 10 * 1024 * 1024))
+SNIFF_SIZE = 16
+DEFAULT_CONTENT_TYPE = "application/octet-stream"
+# leading bytes -> content type
+SIGNATURES = [
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+]
+
+
+class UploadTooLarge(Exception):
+    # not a ValueError, werkzeug's form parser would swallow it
+    def __init__(self, max_size):
+        super().__init__(f"Uploads are limited to {max_size} bytes")
+        self.max_size = max_size
+
+
+def sniff_content_type(head):
+    """
+    Content type of a file starting with `head`, the octet-stream default
+    for anything that isn't a known image format
+    """
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, content_type in SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return DEFAULT_CONTENT_TYPE
+
+
+class GridFSUpload:
+    """
+    Writable file streaming into the GridFS collections of `db`, one chunk
+    document per `chunk_size` bytes (pymongo's GridIn would buffer tens of
+    megabytes of chunks before inserting them). The file document is only
+    created by `finish`, `close` before that deletes what was written.
+    """
+
+    def __init__(self, db, filename, max_size=MAX_UPLOAD_SIZE,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        self.db = db
+        self.filename = filename
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.file_id = ObjectId()
+        self.length = 0
+        self.head = b""
+        self.sha256 = hashlib.sha256()
+        self.finished = False
+        self.closed = False
+        self._buffer = bytearray()
+        self._chunk_number = 0
+        self._download = None
+
+    @property
+    def content_type(self):
+        return sniff_content_type(self.head)
+
+    def write(self, data):
+        self.length += len(data)
+        if self.max_size and self.length > self.max_size:
+            self.close()
+            raise UploadTooLarge(self.max_size)
+        if len(self.head) < SNIFF_SIZE:
+            self.head += data[:SNIFF_SIZE - len(self.head)]
+        self.sha256.update(data)
+        self._buffer += data
+        while len(self._buffer) >= self.chunk_size:
+            self._write_chunk(self._buffer[:self.chunk_size])
+            del self._buffer[:self.chunk_size]
+        return len(data)
+
+    def finish(self, metadata=None):
+        """
+        Store the file document, with `metadata`, and return its id.
+        Returns None if a file with the same unique metadata is stored.
+        """
+        if self._buffer:
+            self._write_chunk(self._buffer)
+            self._buffer = bytearray()
+        file = {"_id": self.file_id, "length": self.length,
+                "chunkSize": self.chunk_size,
+                "uploadDate": datetime.now(timezone.utc),
+                "filename": self.filename}
+        if metadata is not None:
+            file["metadata"] = metadata
+        try:
+            self.db["fs.files"].insert_one(file)
+        except DuplicateKeyError:
+            # a unique index (see db/indexes.py "sha256_unique") already
+            # has this content, the chunks stay until `close`
+            return None
+        self.finished = True
+        return self.file_id
+
+    def seek(self, offset, whence=0):
+        # the form parser rewinds every file part it has written
+        if self.finished:
+            return self._reader().seek(offset, whence)
+        return 0
+
+    def tell(self):
+        return self._reader().tell() if self.finished else self.length
+
+    def read(self, size=-1):
+        if not self.finished:
+            raise OSError("Upload not finished")
+        return self._reader().read(size)
+
+    def readline(self, size=-1):
+        if not self.finished:
+            raise OSError("Upload not finished")
+        return self._reader().readline(size)
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._download is not None:
+            self._download.close()
+        if not self.finished:
+            self.db["fs.chunks"].delete_many({"files_id": self.file_id})
+
+    def _write_chunk(self, data):
+        self.db["fs.chunks"].insert_one({
+            "files_id": self.file_id, "n": self._chunk_number,
+            "data": Binary(bytes(data))})
+        self._chunk_number += 1
+
+    def _reader(self):
+        if self._download is None:
+            self._download = GridFSBucket(self.db).open_download_stream(
+                self.file_id)
+        return self._download
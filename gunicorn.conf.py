@@ -0,0 +1,26 @@
+"""
+Gunicorn settings, read from the environment so one Procfile serves every
+deployment mode:
+    GUNICORN_WORKER_CLASS   gthread (default), gevent or sync
+    WEB_CONCURRENCY         worker processes
+    GUNICORN_THREADS        threads per gthread worker
+    GUNICORN_CONNECTIONS    concurrent connections per gevent worker
+The endpoints spend most of their time waiting on MongoDB, GridFS and
+Auth0, so gevent or gthread workers serve many requests per process where
+a sync worker serves one. /spots/stream needs one of them, a sync worker
+would be blocked for as long as a client stays connected, so the stream
+answers 503 on sync workers.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 8000)}"
+worker_class = os.environ.get("GUNICORN_WORKER_CLASS", "gthread")
+workers = int(os.environ.get("WEB_CONCURRENCY", 2))
+# more than one thread turns a sync worker into gthread
+threads = int(os.environ.get("GUNICORN_THREADS",
+                             16 if worker_class == "gthread" else 1))
+worker_connections = int(os.environ.get("GUNICORN_CONNECTIONS", 500))
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 30))
+# the gevent worker patches the standard library before it imports the
+# app, preloading would import pymongo and start threads unpatched
+preload_app = False